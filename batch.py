@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+
+import os, json, inspect, multiprocessing, multiprocessing.connection
+
+import drivers.input
+import drivers.output
+
+from process import Process
+
+# Converts many books in a single run. Each line of a batch manifest is a JSON
+# object describing one book, using the following keys (which mirror
+# epubtool.py's command line options):
+#
+# input, output, inputDriver, outputDriver, title, author, publisher, lang,
+# copyrightYear, pubDate, coverPath, includeCopyright, isFiction
+#
+# A book can also list variants: other editions built from the same parsed
+# manuscript, each of which is an object with its own output and any keys it
+# overrides (other than input and inputDriver), plus options to pass to its
+# output driver on top of the batch's. For example, to also build an ARC with
+# a generated cover and an edition without a copyright page:
+#
+# "variants": [
+# 	{"output": "arc.epub", "coverPath": "generate", "options": {"compression": "fast"}},
+# 	{"output": "nocopyright.epub", "includeCopyright": false}
+# ]
+#
+# Each book is converted in its own process forked from the batch, with up to
+# jobs of them running at once. The drivers are imported and their templates
+# loaded once, before forking, so every process inherits them instead of
+# loading them again. A book that fails to convert, or whose process crashes
+# outright, is reported without affecting the rest of the batch.
+class Batch:
+
+	# Keys every book in the manifest must have, either on its own line or as
+	# a default passed to the constructor
+	requiredKeys = [
+		'input', 'output', 'inputDriver', 'title', 'author', 'lang',
+		'copyrightYear', 'pubDate', 'coverPath'
+	]
+
+	##########################################################################
+
+	# Constructor. Defaults are applied to every book in the manifest that
+	# doesn't set them itself. Jobs is the number of books that will be
+	# converted at once, and inputOptions and outputOptions are passed along
+	# as keyword arguments to every input and output driver. If streaming is
+	# True, books are converted one chapter at a time (see process.py.)
+	def __init__(self, defaults = None, jobs = 1, inputOptions = None,
+	outputOptions = None, streaming = False):
+
+		self.__defaults = {'outputDriver': 'epub', 'includeCopyright': True, 'isFiction': True}
+		if defaults:
+			self.__defaults.update(defaults)
+
+		self.__jobs = jobs if jobs >= 1 else (os.cpu_count() or 1)
+		self.__inputOptions = inputOptions if inputOptions else {}
+		self.__outputOptions = outputOptions if outputOptions else {}
+		self.__streaming = streaming
+
+		# One entry per line in the manifest
+		self.__books = []
+
+	##########################################################################
+
+	# Reads a manifest of books to convert. Lines that can't be parsed are
+	# kept so that they can be reported as failures once the batch runs.
+	def load(self, manifestPath):
+
+		with open(manifestPath, 'r') as manifest:
+
+			for lineNumber, line in enumerate(manifest, 1):
+
+				if not line.strip():
+					continue
+
+				book = dict(self.__defaults)
+				book['line'] = lineNumber
+
+				try:
+
+					settings = json.loads(line)
+
+					if not isinstance(settings, dict):
+						raise ValueError('line must be a JSON object')
+
+					book.update(settings)
+
+					missingKeys = [key for key in self.requiredKeys if not book.get(key)]
+					if missingKeys:
+						raise ValueError('missing ' + ', '.join(missingKeys))
+
+					_validateVariants(book.get('variants', []), book['outputDriver'])
+
+				except ValueError as error:
+					book['error'] = 'Invalid manifest entry: ' + str(error)
+
+				self.__books.append(book)
+
+	##########################################################################
+
+	# Converts every book in the manifest and returns a list of results, one
+	# for each book, in manifest order. A callback, if given, is called with
+	# each result as soon as that book is finished.
+	def run(self, callback = None):
+
+		results = [None] * len(self.__books)
+
+		def finish(index, result):
+			results[index] = result
+			if callback:
+				callback(result)
+
+		pending = []
+
+		for index, book in enumerate(self.__books):
+			if 'error' in book:
+				finish(index, _bookResult(book, book['error']))
+			else:
+				pending.append(index)
+
+		# Load everything that can be shared between books before forking, so
+		# that the workers inherit it instead of each loading it themselves.
+		driverClasses = set()
+
+		for index in pending:
+			for edition in _getEditions(self.__books[index]):
+				try:
+					driverClasses.update(_getDriverClasses(edition))
+				except ValueError:
+					pass
+
+		# If warming up a driver fails, it'll fail again for each book that
+		# uses it, and that's where the error will be reported.
+		for DriverClass in driverClasses:
+			try:
+				DriverClass.warmup()
+			except Exception:
+				pass
+
+		# Like the drivers, the batch relies on fork so that each book's
+		# process inherits warm state. Everywhere else, books are converted
+		# one at a time.
+		if (
+			self.__jobs > 1 and len(pending) > 1 and
+			'fork' in multiprocessing.get_all_start_methods()
+		):
+
+			self.__runForked(pending, finish)
+
+		else:
+			for index in pending:
+				finish(index, convertBook(self.__books[index], self.__inputOptions, self.__outputOptions, self.__streaming))
+
+		return results
+
+	##########################################################################
+
+	# Converts each book in its own forked process, running at most jobs of
+	# them at once, and calls finish with each book's index and result as
+	# soon as it's done. A process that dies outright (it was killed, or a
+	# native library crashed) only takes its own book down with it.
+	def __runForked(self, pending, finish):
+
+		forkContext = multiprocessing.get_context('fork')
+		queue = list(pending)
+		running = {}
+
+		while queue or running:
+
+			while queue and len(running) < self.__jobs:
+
+				index = queue.pop(0)
+				resultConnection, childConnection = forkContext.Pipe(False)
+				process = forkContext.Process(target = _convertBookInProcess, args = (
+					childConnection, self.__books[index], self.__inputOptions,
+					self.__outputOptions, self.__streaming
+				))
+
+				process.start()
+				childConnection.close()
+				running[resultConnection] = (index, process)
+
+			# A connection becomes ready once its process either sends back a
+			# result or exits without sending anything
+			for resultConnection in multiprocessing.connection.wait(list(running)):
+
+				index, process = running.pop(resultConnection)
+
+				try:
+					result = resultConnection.recv()
+				except EOFError:
+					result = None
+
+				resultConnection.close()
+				process.join()
+
+				if result is None:
+					result = _bookResult(self.__books[index],
+						'Worker process failed: exited with code ' + str(process.exitcode))
+
+				finish(index, result)
+
+##############################################################################
+
+# Returns the input and output driver classes for a book in the manifest.
+def _getDriverClasses(book):
+
+	try:
+		InputDriverClass = getattr(drivers.input, book['inputDriver'].lower().capitalize())
+	except AttributeError:
+		raise ValueError('Input driver ' + book['inputDriver'].lower().capitalize() + ' is not supported.')
+
+	return InputDriverClass, _getOutputDriverClass(book['outputDriver'])
+
+##############################################################################
+
+# Returns the output driver class with the given name.
+def _getOutputDriverClass(outputDriver):
+
+	try:
+		return getattr(drivers.output, outputDriver.lower().capitalize())
+	except AttributeError:
+		raise ValueError('Output driver ' + outputDriver.lower().capitalize() + ' is not supported.')
+
+##############################################################################
+
+# Returns the names of the options an output driver accepts (its keyword
+# arguments), or None if it accepts anything.
+def _getOptionNames(OutputDriverClass):
+
+	optionNames = set()
+
+	for parameter in inspect.signature(OutputDriverClass.__init__).parameters.values():
+
+		if inspect.Parameter.VAR_KEYWORD == parameter.kind:
+			return None
+
+		if parameter.default is not inspect.Parameter.empty:
+			optionNames.add(parameter.name)
+
+	return optionNames
+
+##############################################################################
+
+# Makes sure a book's variants (see the top of this file) are well formed,
+# including that their options are ones their output driver accepts.
+# outputDriver is the book's own output driver, which variants use unless
+# they set their own. Raises ValueError if they aren't.
+def _validateVariants(variants, outputDriver):
+
+	if not isinstance(variants, list):
+		raise ValueError('variants must be a list')
+
+	for variant in variants:
+
+		if not isinstance(variant, dict) or not variant.get('output'):
+			raise ValueError('every variant must be an object with an output')
+
+		if 'input' in variant or 'inputDriver' in variant or 'variants' in variant:
+			raise ValueError('variants can\'t change the input')
+
+		if not isinstance(variant.get('options', {}), dict):
+			raise ValueError('variant options must be an object')
+
+		OutputDriverClass = _getOutputDriverClass(variant.get('outputDriver', outputDriver))
+
+		optionNames = _getOptionNames(OutputDriverClass)
+
+		if optionNames is not None:
+
+			unknownOptions = sorted(set(variant.get('options', {})) - optionNames)
+
+			if unknownOptions:
+				raise ValueError(OutputDriverClass.__name__ + ' output driver doesn\'t support ' + ', '.join(unknownOptions))
+
+##############################################################################
+
+# Converts a single book in a process forked by Batch and sends its result
+# back through connection.
+def _convertBookInProcess(connection, book, inputOptions, outputOptions, streaming):
+
+	try:
+		connection.send(convertBook(book, inputOptions, outputOptions, streaming))
+	finally:
+		connection.close()
+
+##############################################################################
+
+# Returns every edition of a book that should be built: the book itself,
+# followed by each of its variants with the book's settings filled in.
+def _getEditions(book):
+
+	return [book] + [dict(book, **variant) for variant in book.get('variants', [])]
+
+##############################################################################
+
+# Builds the result reported for a single book. Error is None on success.
+def _bookResult(book, error = None):
+
+	return {
+		'line': book.get('line'),
+		'input': book.get('input'),
+		'output': book.get('output'),
+		'success': error is None,
+		'error': error
+	}
+
+##############################################################################
+
+# Converts a single book from the manifest and returns its result. Any error
+# is caught and reported in the result rather than raised, so that one bad
+# book can't take down the rest of the batch.
+def convertBook(book, inputOptions = None, outputOptions = None, streaming = False):
+
+	process = None
+
+	try:
+
+		InputDriverClass = _getDriverClasses(book)[0]
+		inputDriver = InputDriverClass(**(inputOptions if inputOptions else {}))
+
+		# Every edition of the book is built from a single parse
+		editions = _getEditions(book)
+		outputDrivers = []
+
+		for edition in editions:
+
+			OutputDriverClass = _getDriverClasses(edition)[1]
+
+			outputDrivers.append(OutputDriverClass(edition['lang'], edition.get('publisher') or edition['author'],
+				edition['author'], edition['title'], edition['pubDate'], str(edition['copyrightYear']),
+				edition['includeCopyright'], edition['isFiction'], edition['coverPath'],
+				**dict(outputOptions if outputOptions else {}, **edition.get('options', {}))))
+
+		process = Process(inputDriver, outputDrivers, streaming)
+		process.open(book['input'])
+		process.convert([edition['output'] for edition in editions])
+		process.cleanup()
+
+		return _bookResult(book)
+
+	except Exception as error:
+
+		if process:
+			process.cleanup()
+
+		return _bookResult(book, str(error) if str(error) else error.__class__.__name__)
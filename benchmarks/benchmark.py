@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks each stage of the conversion pipeline on synthetic manuscripts
+# (see corpus.py) and prints the results as JSON, so that runs from different
+# commits, or with different versions of PyRTFDOM, can be compared. Example:
+#
+# ./benchmarks/benchmark.py --chapters 150 --repeat 5 --output before.json
+
+import os, io, sys, json, time, shutil, zipfile, argparse, platform
+import tempfile, contextlib, statistics, subprocess, tracemalloc
+
+# Let the benchmark be run from anywhere, just like epubtool.py
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+import corpus
+
+from drivers.input import Rtf, Scrivener
+from drivers.output import Epub
+from drivers.output.container import ZipContainer, DirectoryContainer, COMPRESSION_PRESETS
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Benchmark the conversion pipeline on synthetic manuscripts.')
+
+parser.add_argument('--chapters', type=int, default=40, help='Number of chapters in each manuscript (default: 40)')
+parser.add_argument('--parts', type=int, default=4, help='Number of parts the Scrivener project\'s chapters are divided into (default: 4)')
+parser.add_argument('--paragraphs', type=int, default=100, help='Paragraphs per chapter (default: 100)')
+parser.add_argument('--words', type=int, default=80, help='Words per paragraph (default: 80)')
+parser.add_argument('--noFootnotes', action='store_true', default=False, help='Don\'t generate footnotes in the Scrivener project')
+parser.add_argument('--jobs', type=int, default=1, help='Value of --jobs to benchmark with (default: 1)')
+parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each stage (default: 3)')
+parser.add_argument('--seed', type=int, default=1, help='Random seed used to generate the manuscripts (default: 1)')
+parser.add_argument('--tmp', default=None, help='Directory to generate manuscripts and output in (default: a new temporary directory)')
+parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout')
+
+args = parser.parse_args()
+
+###############################################################################
+
+# Runs a stage once and returns how long it took. If traceMemory is True, also
+# returns the peak amount of memory Python allocated while it was running.
+# Progress messages printed by the drivers are swallowed.
+def measure(stage, traceMemory = False):
+
+	state = stage['setup']() if 'setup' in stage else None
+
+	if traceMemory:
+		tracemalloc.start()
+
+	wallStart = time.perf_counter()
+	cpuStart = time.process_time()
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		stage['run'](state)
+
+	result = {
+		'wall': time.perf_counter() - wallStart,
+		'cpu': time.process_time() - cpuStart
+	}
+
+	if traceMemory:
+		result['peakMemory'] = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	if 'teardown' in stage:
+		stage['teardown'](state)
+
+	return result
+
+###############################################################################
+
+# Times a stage args.repeat times, then runs it once more with tracemalloc
+# enabled to measure its peak memory use. The memory run isn't included in
+# the timings, since tracing slows everything down.
+def benchmark(stage):
+
+	runs = [measure(stage) for run in range(args.repeat)]
+	memoryRun = measure(stage, True)
+
+	wallTimes = [run['wall'] for run in runs]
+	cpuTimes = [run['cpu'] for run in runs]
+	bestWall = min(wallTimes)
+
+	result = {
+		'wall': {'min': bestWall, 'median': statistics.median(wallTimes), 'max': max(wallTimes)},
+		'cpu': {'min': min(cpuTimes), 'median': statistics.median(cpuTimes), 'max': max(cpuTimes)},
+		'peakMemory': memoryRun['peakMemory'],
+		'chapters': stage['chapters'],
+		'bytes': stage['bytes']
+	}
+
+	if 'outputBytes' in stage:
+		result['outputBytes'] = stage['outputBytes']()
+
+	if bestWall > 0:
+		result['chaptersPerSecond'] = stage['chapters'] / bestWall
+		result['megabytesPerSecond'] = stage['bytes'] / bestWall / 1000000
+
+	return result
+
+###############################################################################
+
+# Returns the total size of every file under a directory.
+def directorySize(path):
+
+	return sum(
+		os.path.getsize(os.path.join(root, filename))
+		for root, dirs, files in os.walk(path) for filename in files
+	)
+
+###############################################################################
+
+# Returns the commit being benchmarked, if we're running from a git checkout.
+def currentCommit():
+
+	try:
+		return subprocess.check_output(
+			['git', 'rev-parse', 'HEAD'], cwd = repoPath,
+			stderr = subprocess.DEVNULL, universal_newlines = True
+		).strip()
+
+	except Exception:
+		return None
+
+###############################################################################
+
+# Returns a new Epub output driver for the benchmark book.
+def newEpub(coverPath):
+
+	return Epub('en-US', 'Benchmark Press', 'Jane Doe', 'Benchmark', '2020-01-01',
+		'2020', True, True, coverPath, jobs = args.jobs)
+
+###############################################################################
+
+tmpPath = args.tmp if args.tmp else tempfile.mkdtemp(prefix = 'epubtools-benchmark-')
+os.makedirs(tmpPath, exist_ok = True)
+
+# The images in the shared project's DOM live in its driver's temporary
+# directory, so the driver is only cleaned up once every stage has run
+projectDriver = None
+
+try:
+
+	chaptersPerPart = max(1, args.chapters // max(1, args.parts))
+	scrivenerChapters = chaptersPerPart * max(1, args.parts)
+
+	rtfPath = corpus.generateRtf(os.path.join(tmpPath, 'benchmark.rtf'),
+		args.chapters, args.paragraphs, args.words, args.seed)
+
+	projectPath = corpus.generateScrivenerProject(os.path.join(tmpPath, 'benchmark.scriv'),
+		max(1, args.parts), chaptersPerPart, args.paragraphs, args.words,
+		not args.noFootnotes, args.seed)
+
+	coverPath = corpus.generateCover(os.path.join(tmpPath, 'cover.png'), seed = args.seed)
+	epubPath = os.path.join(tmpPath, 'benchmark.epub')
+
+	# Every stage after parsing works from the same parsed Scrivener project
+	def parseProject():
+		driver = Scrivener(jobs = args.jobs)
+		driver.open(projectPath)
+		driver.parse()
+		return driver
+
+	with contextlib.redirect_stdout(io.StringIO()):
+		projectDriver = parseProject()
+		projectDOM = projectDriver.DOMRoot
+		epubDriver = newEpub(coverPath)
+		epubDriver.transform(projectDOM, epubPath)
+		epubDriver.cleanup()
+
+	with zipfile.ZipFile(epubPath) as epubFile:
+		epubMembers = [(name, epubFile.read(name)) for name in epubFile.namelist() if 'mimetype' != name]
+
+	epubMemberBytes = sum(len(data) for name, data in epubMembers)
+
+	# Stages shared by the two zip benchmarks
+	def stageBook():
+		stagingPath = tempfile.mkdtemp(dir = tmpPath)
+		shutil.rmtree(stagingPath)
+		container = DirectoryContainer(epubPath, stagingPath)
+		for name, data in epubMembers:
+			container.write(name, data)
+		return container
+
+	def streamBook(compressLevel):
+		container = ZipContainer(epubPath, 'benchmark', compressLevel = compressLevel,
+			threads = args.jobs if args.jobs >= 1 else (os.cpu_count() or 1))
+		for name, data in epubMembers:
+			container.write(name, data)
+		container.close()
+
+	stages = {
+
+		'Rtf.parse': {
+			'setup': lambda: Rtf(jobs = args.jobs),
+			'run': lambda driver: (driver.open(rtfPath), driver.parse()),
+			'teardown': lambda driver: driver.cleanup(),
+			'chapters': args.chapters,
+			'bytes': os.path.getsize(rtfPath)
+		},
+
+		'Scrivener.parse': {
+			'setup': lambda: Scrivener(jobs = args.jobs),
+			'run': lambda driver: (driver.open(projectPath), driver.parse()),
+			'teardown': lambda driver: driver.cleanup(),
+			'chapters': scrivenerChapters,
+			'bytes': directorySize(os.path.join(projectPath, 'Files', 'Docs'))
+		},
+
+		'Epub.transform': {
+			'setup': lambda: newEpub(coverPath),
+			'run': lambda driver: driver.transform(projectDOM, epubPath),
+			'teardown': lambda driver: driver.cleanup(),
+			'chapters': scrivenerChapters,
+			'bytes': directorySize(os.path.join(projectPath, 'Files', 'Docs'))
+		},
+
+		# Zipping a book that was staged on disk, like Epub.__zipBook used to
+		# (and --stageOnDisk still does)
+		'Epub.zip.stagedOnDisk': {
+			'setup': stageBook,
+			'run': lambda container: container.close(),
+			'teardown': lambda container: container.cleanup(),
+			'chapters': scrivenerChapters,
+			'bytes': epubMemberBytes
+		},
+
+		# Streaming the same files straight into the archive
+		'Epub.zip.streamed': {
+			'run': lambda state: streamBook(COMPRESSION_PRESETS['default']),
+			'chapters': scrivenerChapters,
+			'bytes': epubMemberBytes,
+			'outputBytes': lambda: os.path.getsize(epubPath)
+		}
+	}
+
+	# And at each of the other compression presets
+	for preset, compressLevel in COMPRESSION_PRESETS.items():
+
+		if 'default' != preset:
+			stages['Epub.zip.streamed.' + preset] = {
+				'run': lambda state, compressLevel = compressLevel: streamBook(compressLevel),
+				'chapters': scrivenerChapters,
+				'bytes': epubMemberBytes,
+				'outputBytes': lambda: os.path.getsize(epubPath)
+			}
+
+	results = {
+		'commit': currentCommit(),
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'settings': {
+			'chapters': args.chapters,
+			'parts': args.parts,
+			'paragraphs': args.paragraphs,
+			'words': args.words,
+			'footnotes': not args.noFootnotes,
+			'jobs': args.jobs,
+			'repeat': args.repeat,
+			'seed': args.seed
+		},
+		'stages': {name: benchmark(stage) for name, stage in stages.items()}
+	}
+
+	try:
+		import resource
+		results['maxRSS'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if 'darwin' == sys.platform else 1024)
+	except ImportError:
+		pass
+
+	output = json.dumps(results, indent = 4, sort_keys = True)
+
+	if args.output:
+		with open(args.output, 'w') as outputFile:
+			outputFile.write(output + '\n')
+	else:
+		print(output)
+
+finally:
+
+	if projectDriver:
+		projectDriver.cleanup()
+
+	if not args.tmp:
+		shutil.rmtree(tmpPath, ignore_errors = True)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures how long it takes to package books at each compression preset (see
+# drivers/output/container.py) and how big the results are, so that presets
+# can be compared on real books. Every file in each of the given EPUBs is
+# written back out into a new archive, just like the Epub driver would write
+# it, and the results are printed as JSON. Example:
+#
+# ./benchmarks/compression.py --repeat 5 catalogue/*.epub
+
+import os, sys, json, time, shutil, zipfile, argparse, platform, tempfile, statistics
+
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+from drivers.output.container import ZipContainer, COMPRESSION_PRESETS
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Compare compression presets on existing e-books.')
+
+parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs of each preset (default: 3)')
+parser.add_argument('--threads', type=int, default=1, help='Number of threads used to compress large files (default: 1, 0 = one per CPU core)')
+parser.add_argument('--output', default=None, help='Write the JSON results to this file instead of stdout')
+parser.add_argument('EPUB', nargs='+', help='E-books to repackage')
+
+args = parser.parse_args()
+
+threads = args.threads if args.threads >= 1 else (os.cpu_count() or 1)
+
+###############################################################################
+
+# Returns every file in an e-book except for its mimetype, which every
+# container writes out by itself.
+def readMembers(epubPath):
+
+	with zipfile.ZipFile(epubPath) as epubFile:
+		return [(name, epubFile.read(name)) for name in epubFile.namelist() if 'mimetype' != name]
+
+###############################################################################
+
+# Writes a book's files into a new archive at the given compression level and
+# returns how long it took and how big the archive is.
+def package(members, outputPath, compressLevel):
+
+	wallStart = time.perf_counter()
+
+	container = ZipContainer(outputPath, 'compression', compressLevel = compressLevel, threads = threads)
+
+	for name, data in members:
+		container.write(name, data)
+
+	container.close()
+
+	return time.perf_counter() - wallStart, os.path.getsize(outputPath)
+
+###############################################################################
+
+tmpPath = tempfile.mkdtemp(prefix = 'epubtools-compression-')
+
+try:
+
+	books = [(epubPath, readMembers(epubPath)) for epubPath in args.EPUB]
+	uncompressedBytes = sum(len(data) for epubPath, members in books for name, data in members)
+	originalBytes = sum(os.path.getsize(epubPath) for epubPath in args.EPUB)
+
+	results = {
+		'python': platform.python_version(),
+		'platform': platform.platform(),
+		'cpus': os.cpu_count(),
+		'settings': {'books': len(books), 'repeat': args.repeat, 'threads': threads},
+		'uncompressedBytes': uncompressedBytes,
+		'originalBytes': originalBytes,
+		'presets': {}
+	}
+
+	for preset, compressLevel in COMPRESSION_PRESETS.items():
+
+		wallTimes = []
+		outputBytes = 0
+
+		for run in range(args.repeat):
+
+			runWall = 0
+			outputBytes = 0
+
+			for index, (epubPath, members) in enumerate(books):
+				wall, size = package(members, os.path.join(tmpPath, str(index) + '.epub'), compressLevel)
+				runWall += wall
+				outputBytes += size
+
+			wallTimes.append(runWall)
+
+		bestWall = min(wallTimes)
+
+		results['presets'][preset] = {
+			'level': compressLevel,
+			'wall': {'min': bestWall, 'median': statistics.median(wallTimes), 'max': max(wallTimes)},
+			'outputBytes': outputBytes,
+			'ratio': outputBytes / uncompressedBytes if uncompressedBytes else None,
+			'comparedToOriginal': outputBytes / originalBytes if originalBytes else None,
+			'megabytesPerSecond': uncompressedBytes / bestWall / 1000000 if bestWall > 0 else None
+		}
+
+	output = json.dumps(results, indent = 4, sort_keys = True)
+
+	if args.output:
+		with open(args.output, 'w') as outputFile:
+			outputFile.write(output + '\n')
+	else:
+		print(output)
+
+finally:
+	shutil.rmtree(tmpPath, ignore_errors = True)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+import os, zlib, random, struct
+
+# Generates synthetic manuscripts for the benchmarks. Everything is derived
+# from a seeded random number generator, so the same settings always produce
+# byte-for-byte the same files, and results can be compared across commits.
+
+# Words used to build paragraphs. A few of them contain characters that the
+# Epub driver has to escape.
+WORDS = [
+	'the', 'of', 'and', 'a', 'to', 'in', 'is', 'was', 'that', 'for', 'it',
+	'with', 'as', 'his', 'her', 'on', 'be', 'at', 'by', 'had', 'not', 'are',
+	'but', 'from', 'or', 'have', 'an', 'they', 'which', 'one', 'you', 'were',
+	'lantern', 'harbor', 'whispered', 'quietly', 'midnight', 'letter',
+	'staircase', 'remembered', 'forgotten', 'window', 'river', 'shadow',
+	'don\u2019t', '\u201cwait\u201d', 'well\u2026', 'then\u2014', 'Acme\u2122'
+]
+
+##############################################################################
+
+# Escapes a string for inclusion in an RTF document.
+def rtfEscape(text):
+
+	escaped = ''
+
+	for char in text:
+
+		if char in '\\{}':
+			escaped += '\\' + char
+		elif ord(char) > 127:
+			escaped += '\\u' + str(ord(char)) + '?'
+		else:
+			escaped += char
+
+	return escaped
+
+##############################################################################
+
+# Returns the RTF markup for a single paragraph of the given length, with a
+# bit of bold and italic formatting mixed in.
+def rtfParagraph(rng, words, footnoteIDs = None):
+
+	markup = ''
+
+	for index in range(words):
+
+		word = rtfEscape(rng.choice(WORDS))
+		roll = rng.random()
+
+		if roll < 0.03:
+			markup += '{\\b ' + word + '}'
+		elif roll < 0.06:
+			markup += '{\\i ' + word + '}'
+		else:
+			markup += word
+
+		# Scrivener footnotes are hyperlink fields pointing at a comment
+		if footnoteIDs is not None and roll > 0.995:
+			footnoteID = 'FN' + str(len(footnoteIDs))
+			footnoteIDs.append(footnoteID)
+			markup += '{\\field{\\*\\fldinst{HYPERLINK "scrivcmt://' + footnoteID + '"}}{\\fldrslt ' + word + '}}'
+
+		markup += ' '
+
+	return '\\pard ' + markup.rstrip() + '\\par\n'
+
+##############################################################################
+
+# Returns the header that starts every RTF document we generate.
+def rtfHeader():
+
+	return '{\\rtf1\\ansi\\deff0{\\fonttbl{\\f0 Times New Roman;}}\n'
+
+##############################################################################
+
+# Writes a single RTF document containing the given number of chapters. Every
+# chapter starts with a title paragraph that has a page break before it, which
+# is how the Rtf input driver splits the document into chapters. Returns the
+# path of the generated file.
+def generateRtf(path, chapters = 20, paragraphs = 100, words = 80, seed = 1):
+
+	rng = random.Random(seed)
+
+	with open(path, 'w', encoding = 'ascii') as rtfFile:
+
+		rtfFile.write(rtfHeader())
+
+		for chapter in range(1, chapters + 1):
+
+			rtfFile.write('\\pard\\pagebb Chapter ' + str(chapter) + '\\par\n')
+
+			for paragraph in range(paragraphs):
+				rtfFile.write(rtfParagraph(rng, words))
+
+		rtfFile.write('}\n')
+
+	return path
+
+##############################################################################
+
+# Writes a Scrivener project with the given number of parts, each containing
+# chaptersPerPart chapters, plus a research folder that the Scrivener driver
+# should ignore. If footnotes is True, some words are turned into footnotes
+# stored in each chapter's .comments file. Returns the path to the project.
+def generateScrivenerProject(path, parts = 4, chaptersPerPart = 5,
+paragraphs = 100, words = 80, footnotes = True, seed = 1):
+
+	rng = random.Random(seed)
+	docsPath = os.path.join(path, 'Files', 'Docs')
+	os.makedirs(docsPath)
+
+	binderItems = ''
+	nextID = 1
+
+	for part in range(1, parts + 1):
+
+		chapterItems = ''
+
+		for chapter in range(1, chaptersPerPart + 1):
+
+			footnoteIDs = [] if footnotes else None
+
+			with open(os.path.join(docsPath, str(nextID) + '.rtf'), 'w', encoding = 'ascii') as rtfFile:
+
+				rtfFile.write(rtfHeader())
+
+				for paragraph in range(paragraphs):
+					rtfFile.write(rtfParagraph(rng, words, footnoteIDs))
+
+				rtfFile.write('}\n')
+
+			if footnoteIDs:
+
+				with open(os.path.join(docsPath, str(nextID) + '.comments'), 'w', encoding = 'ascii') as commentsFile:
+
+					commentsFile.write('<?xml version="1.0" encoding="UTF-8"?>\n<Comments>\n')
+
+					for footnoteID in footnoteIDs:
+						commentsFile.write(
+							'<Comment ID="' + footnoteID + '" Footnote="Yes">' +
+							rtfHeader().replace('\n', '') + rtfParagraph(rng, 20).replace('\n', '') +
+							'}</Comment>\n'
+						)
+
+					commentsFile.write('</Comments>\n')
+
+			chapterItems += (
+				'<BinderItem ID="' + str(nextID) + '" Type="Text">' +
+				'<Title>Chapter ' + str(chapter) + '</Title></BinderItem>\n'
+			)
+
+			nextID += 1
+
+		binderItems += (
+			'<BinderItem ID="P' + str(part) + '" Type="Folder">' +
+			'<Title>Part ' + str(part) + '</Title><Children>\n' +
+			chapterItems + '</Children></BinderItem>\n'
+		)
+
+	with open(os.path.join(path, 'Benchmark.scrivx'), 'w', encoding = 'utf-8') as scrivxFile:
+		scrivxFile.write(
+			'<?xml version="1.0" encoding="UTF-8"?>\n<ScrivenerProject>\n<Binder>\n' +
+			'<BinderItem ID="0" Type="DraftFolder"><Title>Draft</Title><Children>\n' +
+			binderItems + '</Children></BinderItem>\n' +
+			'<BinderItem ID="R" Type="ResearchFolder"><Title>Research</Title></BinderItem>\n' +
+			'</Binder>\n</ScrivenerProject>\n'
+		)
+
+	return path
+
+##############################################################################
+
+# Writes a noisy PNG image to use as the book's cover. PNG is simple enough to
+# generate without any imaging libraries, and the noise keeps it from
+# compressing down to nothing. Returns the path to the generated file.
+def generateCover(path, width = 600, height = 900, seed = 1):
+
+	rng = random.Random(seed)
+
+	def chunk(chunkType, data):
+		return (
+			struct.pack('>I', len(data)) + chunkType + data +
+			struct.pack('>I', zlib.crc32(chunkType + data) & 0xffffffff)
+		)
+
+	# Each row starts with a filter type byte of 0 (no filtering)
+	rows = b''.join(
+		b'\0' + rng.randbytes(width * 3)
+		for row in range(height)
+	)
+
+	with open(path, 'wb') as coverFile:
+		coverFile.write(
+			b'\x89PNG\r\n\x1a\n' +
+			chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+			chunk(b'IDAT', zlib.compress(rows)) +
+			chunk(b'IEND', b'')
+		)
+
+	return path
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compares the Epub driver's single-pass escaping of manuscript text against
+# the one str.replace() per special character that it used to do, and against
+# str.translate(), over the text of a full-length novel. Since the result
+# depends heavily on how often special characters occur, each is timed on
+# both the synthetic manuscript text (where they're common) and the same text
+# with them removed. Example:
+#
+# ./benchmarks/escape.py --words 120000
+
+import os, sys, json, random, timeit, argparse
+
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+import corpus
+
+from drivers.output import Epub
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Benchmark escaping of text for XHTML output.')
+
+parser.add_argument('--words', type=int, default=100000, help='Number of words in the novel (default: 100000)')
+parser.add_argument('--runLength', type=int, default=12, help='Average number of words in each run of text, i.e. between two changes in formatting (default: 12)')
+parser.add_argument('--repeat', type=int, default=5, help='Number of timed runs (default: 5)')
+parser.add_argument('--seed', type=int, default=1, help='Random seed used to generate the novel (default: 1)')
+
+args = parser.parse_args()
+
+###############################################################################
+
+# How text used to be escaped. It didn't handle &, < and >.
+def replaceEach(runs):
+
+	for run in runs:
+		for char in Epub.specialChars.keys():
+			run = run.replace(char, Epub.specialChars[char])
+
+# A translation table, which also escapes everything in a single pass
+translationTable = str.maketrans(Epub.escapedChars)
+
+def translate(runs):
+
+	for run in runs:
+		run.translate(translationTable)
+
+# How text is escaped now (see Epub._escape)
+def regex(runs):
+
+	for run in runs:
+		Epub.escapedCharsRegex.sub(lambda match: Epub.escapedChars[match.group()], run)
+
+###############################################################################
+
+# Split the novel into runs of text the way PyRTFDOM would, so each string
+# that gets escaped is about as long as a real text node.
+rng = random.Random(args.seed)
+runs = []
+wordsLeft = args.words
+
+while wordsLeft > 0:
+	runWords = min(wordsLeft, rng.randint(1, args.runLength * 2))
+	runs.append(' '.join(rng.choice(corpus.WORDS) for word in range(runWords)))
+	wordsLeft -= runWords
+
+plainRuns = [Epub.escapedCharsRegex.sub('', run) for run in runs]
+
+results = {
+	'words': args.words,
+	'runs': len(runs),
+	'characters': sum(len(run) for run in runs)
+}
+
+for textName, text in [('manuscript', runs), ('plain', plainRuns)]:
+
+	results[textName] = {}
+
+	for name, function in [('replaceEach', replaceEach), ('translate', translate), ('regex', regex)]:
+		results[textName][name] = min(timeit.repeat(lambda: function(text), number = 1, repeat = args.repeat))
+
+print(json.dumps(results, indent = 4))
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Measures how much memory the e-book's DOM takes up. A synthetic manuscript
+# (see corpus.py) is parsed with PyRTFDOM, and the resulting tree is measured
+# before and after being converted to EbookNodes. Example:
+#
+# ./benchmarks/nodes.py --chapters 150
+
+import os, sys, json, shutil, argparse, tempfile, tracemalloc
+
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+import corpus
+
+from pyrtfdom.dom import RTFDOM
+from drivers.domnode import EbookNode
+
+###############################################################################
+
+parser = argparse.ArgumentParser(description='Measure the memory used by the e-book\'s DOM.')
+
+parser.add_argument('--chapters', type=int, default=40, help='Number of chapters in the manuscript (default: 40)')
+parser.add_argument('--paragraphs', type=int, default=100, help='Paragraphs per chapter (default: 100)')
+parser.add_argument('--words', type=int, default=80, help='Words per paragraph (default: 80)')
+parser.add_argument('--seed', type=int, default=1, help='Random seed used to generate the manuscript (default: 1)')
+
+args = parser.parse_args()
+
+###############################################################################
+
+# Returns the number of nodes in a tree and the total size in bytes of every
+# object reachable from them: the nodes themselves, their __dict__s, their
+# attributes and lists of children, and their values. Objects that are shared
+# between nodes, like interned node types, are only counted once.
+def measureTree(rootNode):
+
+	seen = set()
+	nodeCount = 0
+	totalBytes = 0
+
+	def count(obj):
+
+		nonlocal totalBytes
+
+		if id(obj) not in seen:
+			seen.add(id(obj))
+			totalBytes += sys.getsizeof(obj)
+
+	nodes = [rootNode]
+
+	while nodes:
+
+		node = nodes.pop()
+		nodeCount += 1
+
+		count(node)
+		count(node.nodeType)
+		count(node.value)
+		count(node.attributes)
+		count(node.children)
+
+		if hasattr(node, '__dict__'):
+			count(node.__dict__)
+
+		for key, value in node.attributes.items():
+			count(key)
+			count(value)
+
+		nodes.extend(node.children)
+
+	return {'nodes': nodeCount, 'bytes': totalBytes, 'bytesPerNode': totalBytes / nodeCount}
+
+###############################################################################
+
+tmpPath = tempfile.mkdtemp(prefix = 'epubtools-nodes-')
+
+try:
+
+	rtfPath = corpus.generateRtf(os.path.join(tmpPath, 'nodes.rtf'),
+		args.chapters, args.paragraphs, args.words, args.seed)
+
+	domTree = RTFDOM()
+	domTree.openFile(rtfPath)
+	domTree.parse()
+
+	# Measure how much memory the converted tree allocates on top of
+	# PyRTFDOM's, which is still alive
+	tracemalloc.start()
+	ebookRoot = EbookNode.fromRTFDOM(domTree.rootNode)
+	convertedMemory = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+
+	results = {
+		'settings': {
+			'chapters': args.chapters,
+			'paragraphs': args.paragraphs,
+			'words': args.words,
+			'seed': args.seed
+		},
+		'pyrtfdom': measureTree(domTree.rootNode),
+		'ebookNode': measureTree(ebookRoot)
+	}
+
+	results['ebookNode']['allocated'] = convertedMemory
+	results['reduction'] = 1 - results['ebookNode']['bytes'] / results['pyrtfdom']['bytes']
+
+	print(json.dumps(results, indent = 4))
+
+finally:
+	shutil.rmtree(tmpPath, ignore_errors = True)
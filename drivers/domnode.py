@@ -1,14 +1,136 @@
 # -*- coding: utf-8 -*-
 
-from pyrtfdom import elements
+import sys, types
 
 # I'm using a DOM-like structure to represent the contents of an e-book
-# internally. Since I'm already making heavy use of my PyRTFDOM library and
-# already have all that code written, I'm just going to extend its DOMElement
-# class so I can define a couple extra types and also maintain compatibility
-# with the data I parse using PyRTFDOM.
-class EbookNode(elements.DOMElement):
+# internally. It has the same shape as the trees PyRTFDOM produces (nodeType,
+# value, attributes, parent and children), so that output drivers can walk
+# it the same way, but a novel can easily contain hundreds of thousands of
+# nodes, so it's stored much more compactly:
+#
+# * Nodes use __slots__ instead of a per-instance __dict__.
+# * Nodes without attributes (which is almost all of them) share a single
+#   read-only empty mapping instead of having a dict each. To give a node
+#   attributes, assign a new dict to node.attributes.
+# * Nodes without children share an empty tuple until their first child is
+#   appended.
+# * Node types are interned, so every node of the same type points to the same
+#   string.
+#
+# Input drivers should convert whatever PyRTFDOM hands them with
+# EbookNode.fromRTFDOM() before adding it to the e-book's DOM.
 
-	def __init__(self, nodeType):
+# Shared by every node that doesn't have any attributes
+EMPTY_ATTRIBUTES = types.MappingProxyType({})
 
-		super().__init__(nodeType)
+# Shared by every node that doesn't have any children
+EMPTY_CHILDREN = ()
+
+class EbookNode:
+
+	__slots__ = ('nodeType', 'value', 'attributes', 'parent', 'children')
+
+	##########################################################################
+
+	# Constructor
+	def __init__(self, nodeType, value = None, attributes = None):
+
+		self.nodeType = sys.intern(nodeType) if nodeType else nodeType
+		self.value = value
+		self.attributes = attributes if attributes else EMPTY_ATTRIBUTES
+		self.parent = None
+		self.children = EMPTY_CHILDREN
+
+	##########################################################################
+
+	# Returns a copy of a tree parsed by PyRTFDOM (or of any other tree with the
+	# same shape) made out of EbookNodes. The copy is detached from the
+	# original node's parent. The tree is walked iteratively, since
+	# formatting can be nested arbitrarily deep.
+	@classmethod
+	def fromRTFDOM(cls, rootNode):
+
+		rootCopy = cls(rootNode.nodeType, rootNode.value, rootNode.attributes)
+		nodes = [(rootNode, rootCopy)]
+
+		while nodes:
+
+			node, nodeCopy = nodes.pop()
+
+			if node.children:
+
+				nodeCopy.children = []
+
+				for child in node.children:
+
+					childCopy = cls(child.nodeType, child.value, child.attributes)
+					childCopy.parent = nodeCopy
+					nodeCopy.children.append(childCopy)
+
+					if child.children:
+						nodes.append((child, childCopy))
+
+		return rootCopy
+
+	##########################################################################
+
+	def appendChild(self, childNode):
+
+		childNode.parent = self
+
+		if self.children:
+			self.children.append(childNode)
+		else:
+			self.children = [childNode]
+
+	##########################################################################
+
+	def childCount(self):
+
+		return len(self.children)
+
+	##########################################################################
+
+	# Makes the tree rooted at this node read-only, so that it can be shared by
+	# several output drivers (see process.py) without any of them changing it
+	# out from under the others. Lists of children become tuples and
+	# attributes become read-only mappings, so appending a child or setting an
+	# attribute raises an exception.
+	def freeze(self):
+
+		nodes = [self]
+
+		while nodes:
+
+			node = nodes.pop()
+
+			if node.attributes and not isinstance(node.attributes, types.MappingProxyType):
+				node.attributes = types.MappingProxyType(node.attributes)
+
+			if node.children:
+				node.children = tuple(node.children)
+				nodes.extend(node.children)
+
+	##########################################################################
+
+	# Pickles nodes (see drivers/input/chaptercache.py and the worker pools in
+	# the input and output drivers) without the shared empty attributes and
+	# children, which can't be pickled themselves and are restored on load.
+	# Frozen attributes are pickled as regular dicts for the same reason.
+	def __getstate__(self):
+
+		return (
+			self.nodeType,
+			self.value,
+			dict(self.attributes) if self.attributes else None,
+			self.parent,
+			self.children if self.children else None
+		)
+
+	def __setstate__(self, state):
+
+		nodeType, self.value, attributes, self.parent, children = state
+
+		self.nodeType = sys.intern(nodeType) if nodeType else nodeType
+		self.attributes = attributes if attributes else EMPTY_ATTRIBUTES
+		self.children = children if children else EMPTY_CHILDREN
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+
+import os, pickle, hashlib, binascii
+
+import pyrtfdom
+
+from exception import InputException
+
+# Bump this whenever a change to an input driver would produce a different
+# chapter DOM for the same source files, so that stale entries are ignored.
+CACHE_FORMAT_VERSION = '3'
+
+# An on-disk cache of parsed chapters. Each entry is a pickled chapter node
+# keyed by a hash of the files it was parsed from, so an unchanged chapter can
+# skip RTF parsing entirely. When the cache grows beyond its maximum size, the
+# least recently used entries are evicted. Several processes can safely share
+# the same cache directory.
+class ChapterCache:
+
+	# Constructor. maxSize is the maximum total size of the cache in bytes.
+	def __init__(self, cachePath, maxSize = 512 * 1024 * 1024):
+
+		self.__cachePath = cachePath
+		self.__maxSize = maxSize
+
+		self.hits = 0
+		self.misses = 0
+
+		try:
+			os.makedirs(self.__cachePath, exist_ok = True)
+
+		except OSError:
+			raise InputException('Could not create chapter cache directory ' + self.__cachePath + '.')
+
+		# Sizes and last access times of every entry in the cache, used to
+		# decide what to evict without having to list the directory each time
+		self.__entries = {}
+
+		for entry in os.scandir(self.__cachePath):
+			if entry.name.endswith('.chapter') and entry.is_file():
+				stat = entry.stat()
+				self.__entries[entry.name] = {'size': stat.st_size, 'accessed': stat.st_mtime}
+
+	##########################################################################
+
+	# Returns the cache key for a chapter parsed from the given files. Files
+	# that don't exist are hashed as if they were empty, but still change the
+	# key, so that adding or removing a comments file invalidates the entry.
+	# Files are read from disk unless other functions are passed in to check
+	# whether they exist and open them in binary mode (see
+	# drivers/input/scrivenerproject.py.)
+	def key(self, filenames, fileExists = os.path.isfile, openFile = None):
+
+		digest = hashlib.sha256()
+		digest.update((CACHE_FORMAT_VERSION + ':' + str(getattr(pyrtfdom, '__version__', ''))).encode('utf-8'))
+
+		for filename in filenames:
+
+			digest.update(b'\0' + os.path.basename(filename).encode('utf-8') + b'\0')
+
+			if fileExists(filename):
+
+				with (openFile(filename) if openFile else open(filename, 'rb')) as sourceFile:
+					for block in iter(lambda: sourceFile.read(1024 * 1024), b''):
+						digest.update(block)
+
+			else:
+				digest.update(b'\1')
+
+		return digest.hexdigest()
+
+	##########################################################################
+
+	# Returns the chapter node stored under the given key, or None if there
+	# isn't one.
+	def get(self, key):
+
+		filename = key + '.chapter'
+
+		try:
+
+			with open(self.__cachePath + '/' + filename, 'rb') as cacheFile:
+				chapterNode = pickle.load(cacheFile)
+
+			# Mark the entry as recently used
+			os.utime(self.__cachePath + '/' + filename)
+
+		# A missing or unreadable entry is just a miss. If it was corrupted,
+		# it'll be overwritten once the chapter has been parsed again.
+		except Exception:
+			self.misses += 1
+			return None
+
+		if filename in self.__entries:
+			self.__entries[filename]['accessed'] = os.path.getmtime(self.__cachePath + '/' + filename)
+
+		self.hits += 1
+		return chapterNode
+
+	##########################################################################
+
+	# Stores a chapter node under the given key and evicts old entries if the
+	# cache has grown too large.
+	def put(self, key, chapterNode):
+
+		filename = key + '.chapter'
+
+		# Write to a temporary file first so that other processes never see a
+		# partially written entry.
+		tmpFilename = self.__cachePath + '/' + filename + '.' + str(binascii.hexlify(os.urandom(8))).replace("'", '')[1:]
+
+		try:
+
+			with open(tmpFilename, 'wb') as cacheFile:
+				pickle.dump(chapterNode, cacheFile, pickle.HIGHEST_PROTOCOL)
+
+			os.replace(tmpFilename, self.__cachePath + '/' + filename)
+			stat = os.stat(self.__cachePath + '/' + filename)
+
+		# Failing to write to the cache shouldn't fail the conversion.
+		except Exception:
+
+			try:
+				os.remove(tmpFilename)
+			except OSError:
+				pass
+
+			return
+
+		self.__entries[filename] = {'size': stat.st_size, 'accessed': stat.st_mtime}
+		self.__evict()
+
+	##########################################################################
+
+	# Removes the least recently used entries until the cache fits within its
+	# maximum size.
+	def __evict(self):
+
+		totalSize = sum(entry['size'] for entry in self.__entries.values())
+
+		if totalSize <= self.__maxSize:
+			return
+
+		for filename in sorted(self.__entries, key = lambda filename: self.__entries[filename]['accessed']):
+
+			if totalSize <= self.__maxSize:
+				break
+
+			try:
+				os.remove(self.__cachePath + '/' + filename)
+
+			# Another process may have already evicted it
+			except OSError:
+				pass
+
+			totalSize -= self.__entries[filename]['size']
+			del self.__entries[filename]
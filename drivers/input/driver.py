@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os
+import os, shutil, tempfile
 
 from abc import ABCMeta, abstractmethod
 from exception import InputException
@@ -14,7 +14,12 @@ class Driver:
 	##########################################################################
 
 	# Constructor
-	def __init__(self):
+	def __init__(self, jobs = 1):
+
+		# Number of worker processes a driver may use to parse its input. A
+		# value less than 1 means one worker per CPU core. Drivers that can't
+		# split their input up into independent pieces are free to ignore it.
+		self._jobs = jobs if jobs >= 1 else (os.cpu_count() or 1)
 
 		# We use a DOM-like structure to represent the contents of an ebook.
 		# Parts and chapters are all children of this node.
@@ -23,6 +28,21 @@ class Driver:
 		# Represents our current location in the ebook's "DOM" while parsing.
 		self._curDOMNode = self.DOMRoot
 
+		# Where images extracted from the input are saved until the output
+		# driver has copied them into the book (see self._createImageDir.)
+		self._imageDir = None
+
+	##########################################################################
+
+	# Does any expensive setup that can be shared between documents, such as
+	# checking for external programs, so that converting several books in the
+	# same process only has to do it once. Drivers with nothing to share don't
+	# need to override this.
+	@classmethod
+	def warmup(cls):
+
+		pass
+
 	##########################################################################
 
 	# Opens the input source for reading and throws an exception if opening
@@ -48,6 +68,68 @@ class Driver:
 
 	##########################################################################
 
+	# Yields the book's parts and chapters one at a time as (depth, node)
+	# tuples, in order. Depth is 0 for parts and for chapters that aren't
+	# inside a part, and 1 for chapters that belong to the part yielded most
+	# recently. Consumers must not rely on a part node's children, since its
+	# chapters are always yielded separately after it.
+	#
+	# By default, this just parses the whole document and then walks the DOM.
+	# Drivers that can produce one chapter at a time should override it, so
+	# that an output driver can write each chapter out and let it go before
+	# the next one is parsed.
+	def stream(self):
+
+		self.parse()
+
+		for child in self.DOMRoot.children:
+
+			yield 0, child
+
+			if 'part' == child.nodeType:
+				for chapter in child.children:
+					yield 1, chapter
+
+	##########################################################################
+
+	# Builds the ebook's DOM out of the events produced by stream(). Drivers
+	# that override stream() can implement parse() by calling this.
+	def _buildDOM(self, events):
+
+		for depth, node in events:
+
+			if 0 == depth:
+				self._curDOMNode = self.DOMRoot
+
+			self._curDOMNode.appendChild(node)
+
+			if 'part' == node.nodeType:
+				self._curDOMNode = node
+
+	##########################################################################
+
+	# Creates a temporary directory for images extracted from the input, which
+	# image nodes in the DOM point to. Drivers that extract images should call
+	# this before they start parsing (and before forking any workers, so that
+	# they all share the same directory), and call self._removeImageDir() when
+	# they clean up.
+	def _createImageDir(self):
+
+		if not self._imageDir:
+			self._imageDir = tempfile.mkdtemp(prefix = 'epubtools-images-')
+
+	##########################################################################
+
+	# Removes the directory created by self._createImageDir, along with every
+	# image in it.
+	def _removeImageDir(self):
+
+		if self._imageDir:
+			shutil.rmtree(self._imageDir, ignore_errors = True)
+			self._imageDir = None
+
+	##########################################################################
+
 	# Cleans up after parsing is complete. If there's no cleanup to do for a
 	# particular driver, just implement an empty function.
 	@abstractmethod
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+import os, time, queue, shutil, binascii, threading, subprocess
+import multiprocessing.util
+
+from exception import InputException
+
+# The uno module ships with LibreOffice rather than being installed through
+# pip, so it isn't always available. Without it, the Soffice driver falls back
+# to starting a new soffice process for every document.
+try:
+	import uno
+	from com.sun.star.beans import PropertyValue
+	unoAvailable = True
+
+except ImportError:
+	unoAvailable = False
+
+# Keeps a single headless LibreOffice/OpenOffice instance running in the
+# background and converts documents to RTF by talking to it over a UNO pipe,
+# which saves us from paying for the office suite's startup time on every
+# document. Conversions are handed to a single thread through a bounded
+# queue, so callers block instead of piling up requests when the office
+# instance falls behind. If the office instance crashes, it's restarted and the
+# conversion is tried again. If it takes longer than conversionTimeout to
+# convert a document, it's assumed to have hung: it's killed, the conversion
+# fails, and a new instance is started for the next one.
+class OfficeServer:
+
+	# How long to wait for a newly started office instance to accept
+	# connections, in seconds
+	startupTimeout = 30
+
+	# How long a single document can take to convert before the office
+	# instance is killed, in seconds
+	conversionTimeout = 300
+
+	##########################################################################
+
+	# Constructor
+	def __init__(self, tmpLocation = '/tmp', queueSize = 16):
+
+		if not unoAvailable:
+			raise InputException('The uno module that comes with LibreOffice must be installed to use a persistent office instance.')
+
+		# Generate a unique ID that can be used in /tmp to avoid collisions
+		# during concurrently running instances.
+		uid = str(binascii.hexlify(os.urandom(16))).replace("'", '')[1:]
+
+		self.__pipeName = 'epubtools_' + uid
+
+		# The office instance gets its own profile so that it doesn't fight
+		# with any other instance that might be running as the same user.
+		self.__profilePath = tmpLocation + '/' + uid + '_office'
+
+		self.__requests = queue.Queue(maxsize = queueSize)
+		self.__thread = None
+		self.__process = None
+		self.__desktop = None
+
+		# A forked child inherits this object, but not the thread that talks
+		# to the office instance, so each process has to start its own.
+		self.__pid = os.getpid()
+
+		# Shut the office instance down when the process exits. This also runs
+		# in multiprocessing workers, unlike functions registered with atexit.
+		multiprocessing.util.Finalize(None, self.shutdown, exitpriority = 10)
+
+	##########################################################################
+
+	# Returns True if this server was started by the current process.
+	def ownedByCurrentProcess(self):
+
+		return self.__pid == os.getpid()
+
+	##########################################################################
+
+	# Converts the document at inputPath to an RTF written to outputPath and
+	# blocks until the conversion is finished.
+	def convert(self, inputPath, outputPath):
+
+		if not self.__thread:
+			self.__thread = threading.Thread(target = self.__run, daemon = True)
+			self.__thread.start()
+
+		request = {
+			'inputPath': os.path.abspath(inputPath),
+			'outputPath': os.path.abspath(outputPath),
+			'done': threading.Event(),
+			'error': None
+		}
+
+		# No timeout is needed here, since a conversion that hangs is ended
+		# by its watchdog (see self.__convertDocument.)
+		self.__requests.put(request)
+		request['done'].wait()
+
+		if request['error']:
+			raise request['error']
+
+	##########################################################################
+
+	# Stops the office instance and removes its profile.
+	def shutdown(self):
+
+		if not self.ownedByCurrentProcess():
+			return
+
+		if self.__thread:
+			self.__requests.put(None)
+			self.__thread.join()
+			self.__thread = None
+
+		self.__stop()
+
+		try:
+			if os.path.exists(self.__profilePath):
+				shutil.rmtree(self.__profilePath)
+
+		# If for some reason we can't remove these files, I don't want a backend
+		# process on a server to return with an error. So we'll just silently
+		# fail and monitor /tmp from time to time to make sure it doesn't fill
+		# up with too many files.
+		except:
+			pass
+
+	##########################################################################
+
+	# Handles conversion requests one at a time until told to stop.
+	def __run(self):
+
+		while True:
+
+			request = self.__requests.get()
+
+			if request is None:
+				break
+
+			try:
+				self.__convertWithRestart(request['inputPath'], request['outputPath'])
+
+			except Exception as error:
+				request['error'] = error if isinstance(error, InputException) else InputException('Could not convert document')
+
+			request['done'].set()
+
+	##########################################################################
+
+	# Converts a document, restarting the office instance and trying one more
+	# time if it died or stopped responding.
+	def __convertWithRestart(self, inputPath, outputPath):
+
+		for attempt in range(2):
+
+			try:
+
+				if not self.__process or self.__process.poll() is not None:
+					self.__start()
+
+				self.__convertDocument(inputPath, outputPath)
+				return
+
+			# Only the document itself was bad, so restarting won't help.
+			except InputException:
+				raise
+
+			except Exception:
+
+				self.__stop()
+
+				if attempt:
+					raise
+
+	##########################################################################
+
+	# Starts a headless office instance and connects to it.
+	def __start(self):
+
+		self.__process = subprocess.Popen([
+			'soffice',
+			'--headless',
+			'--invisible',
+			'--nologo',
+			'--nodefault',
+			'--norestore',
+			'--nolockcheck',
+			'-env:UserInstallation=' + uno.systemPathToFileUrl(self.__profilePath),
+			'--accept=pipe,name=' + self.__pipeName + ';urp;StarOffice.ComponentContext'
+		], stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+
+		localContext = uno.getComponentContext()
+		resolver = localContext.ServiceManager.createInstanceWithContext(
+			'com.sun.star.bridge.UnoUrlResolver', localContext
+		)
+
+		deadline = time.monotonic() + self.startupTimeout
+
+		while True:
+
+			try:
+				context = resolver.resolve(
+					'uno:pipe,name=' + self.__pipeName + ';urp;StarOffice.ComponentContext'
+				)
+				break
+
+			except Exception:
+
+				if self.__process.poll() is not None or time.monotonic() > deadline:
+					self.__stop()
+					raise InputException('Could not start LibreOffice or OpenOffice.')
+
+				time.sleep(0.1)
+
+		self.__desktop = context.ServiceManager.createInstanceWithContext(
+			'com.sun.star.frame.Desktop', context
+		)
+
+	##########################################################################
+
+	# Stops the office instance, forcibly if it doesn't exit on its own.
+	def __stop(self):
+
+		if self.__desktop:
+
+			try:
+				self.__desktop.terminate()
+			except Exception:
+				pass
+
+			self.__desktop = None
+
+		if self.__process:
+
+			try:
+				self.__process.wait(timeout = 10)
+
+			except subprocess.TimeoutExpired:
+				self.__process.kill()
+				self.__process.wait()
+
+			self.__process = None
+
+	##########################################################################
+
+	# Asks the office instance to open a document and save it as an RTF. A
+	# watchdog kills the office instance if it takes longer than
+	# conversionTimeout, which makes whichever call is stuck waiting on it
+	# fail instead of blocking every caller forever.
+	def __convertDocument(self, inputPath, outputPath):
+
+		process = self.__process
+		hung = threading.Event()
+
+		def killHungProcess():
+			hung.set()
+			process.kill()
+
+		watchdog = threading.Timer(self.conversionTimeout, killHungProcess)
+		watchdog.daemon = True
+		watchdog.start()
+
+		try:
+
+			document = self.__desktop.loadComponentFromURL(
+				uno.systemPathToFileUrl(inputPath), '_blank', 0,
+				(self.__property('Hidden', True),)
+			)
+
+			if document is None:
+				raise InputException('Could not convert document')
+
+			try:
+				document.storeToURL(
+					uno.systemPathToFileUrl(outputPath),
+					(self.__property('FilterName', 'Rich Text Format'),)
+				)
+
+			finally:
+				document.close(True)
+
+		# The document is most likely what made the office instance hang, so
+		# it isn't tried again. A new instance is started for the next one.
+		except Exception:
+
+			if hung.is_set():
+				self.__stop()
+				raise InputException('LibreOffice or OpenOffice stopped responding while converting the document.')
+
+			raise
+
+		finally:
+			watchdog.cancel()
+
+	##########################################################################
+
+	# Builds a UNO PropertyValue.
+	def __property(self, name, value):
+
+		prop = PropertyValue()
+		prop.Name = name
+		prop.Value = value
+
+		return prop
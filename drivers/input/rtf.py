@@ -5,8 +5,10 @@ import re, os, zipfile, shutil
 from pyrtfdom.dom import RTFDOM
 from pyrtfdom import elements
 
+import instrumentation
 from exception import InputException
 from .driver import Driver
+from . import rtfpictures
 from ..domnode import EbookNode
 
 class Rtf(Driver):
@@ -30,17 +32,17 @@ class Rtf(Driver):
 
 			else:
 
-				if child.nodeType in formatElementTypes():
-					paragraphText += self.__parseRTFDOMParagraph(child)
+				if child.nodeType in formatElementTypes:
+					paragraphText += self.__extractParagraphText(child)
 
 		return paragraphText
 
 	##########################################################################
 
 	# Constructor
-	def __init__(self):
+	def __init__(self, jobs = 1):
 
-		super().__init__()
+		super().__init__(jobs)
 
 		# Initialize the RTF parser
 		self.__domTree = RTFDOM()
@@ -56,28 +58,78 @@ class Rtf(Driver):
 		if not os.path.isfile(self._inputPath):
 			raise InputException('Input path ' + self._inputPath + ' must be a file.')
 
+		self._createImageDir()
+
 	##########################################################################
 
 	def parse(self):
 
-		self.__domTree.openFile(self._inputPath)
-		self.__domTree.parse()
+		self._buildDOM(self.stream())
+
+	##########################################################################
+
+	# Splits the document into chapters at each page break and yields them one
+	# at a time. PyRTFDOM has to parse the whole document up front, so this
+	# doesn't save any memory on the input side, but it lets the output driver
+	# release each chapter as soon as it's been written.
+	#
+	# Embedded pictures, which can make up almost all of a document's size,
+	# are extracted into the image directory and cut out before the document
+	# is handed to PyRTFDOM, without ever being read into Python strings, and
+	# then put back into each chapter as image nodes (see rtfpictures.py.)
+	def stream(self):
+
+		with instrumentation.stage('parseDocument', filename = self._inputPath):
+
+			try:
+				rtfText = rtfpictures.readExtractingPictures(self._inputPath, self._imageDir)
+			except (OSError, UnicodeDecodeError):
+				raise InputException('Could not read ' + self._inputPath + '.')
+
+			if rtfText is None:
+				self.__domTree.openFile(self._inputPath)
+			else:
+				self.__domTree.openString(rtfText)
+
+			self.__domTree.parse()
 
 		curChapterNode = None
-		firstParagraph = True
 
 		for child in self.__domTree.rootNode.children:
 
-			if firstParagraph or (
+			if not curChapterNode or (
 				'pagebreakBefore' in child.attributes and
 				child.attributes['pagebreakBefore']
 			):
-				chapterTitle = self.__extractParagraphText(child)
+
+				if curChapterNode:
+					yield 0, curChapterNode
+
+				chapterTitle = rtfpictures.removeMarkers(self.__extractParagraphText(child))
 				print('Processing Chapter "' + chapterTitle + '"...')
 				curChapterNode = EbookNode('chapter')
 				curChapterNode.value = chapterTitle
-				self._curDOMNode.appendChild(curChapterNode)
-				firstParagraph = False
 
 			else:
-				curChapterNode.appendChild(child)
+
+				paragraphNode = EbookNode.fromRTFDOM(child)
+
+				if rtfText is not None:
+					rtfpictures.insertImages(paragraphNode, self._imageDir)
+
+				curChapterNode.appendChild(paragraphNode)
+
+		if curChapterNode:
+			yield 0, curChapterNode
+
+		# Every chapter has been copied into EbookNodes by now, so there's no
+		# need to hold onto PyRTFDOM's version of the document
+		self.__domTree = RTFDOM()
+
+	##########################################################################
+
+	# Removes the images extracted from the document, which the output driver
+	# is done with by now.
+	def cleanup(self):
+
+		self._removeImageDir()
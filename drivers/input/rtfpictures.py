@@ -0,0 +1,351 @@
+# -*- coding: utf-8 -*-
+
+import re, os, mmap, locale, hashlib, binascii, tempfile
+
+from ..domnode import EbookNode
+
+# Finds the pictures embedded in an RTF document and extracts them. Pictures
+# are stored as {\pict ...} groups containing the image as hex digits (or raw
+# bytes after a \binN control word), which can make an RTF export hundreds of
+# megabytes in size. The document is scanned as bytes through a memory map,
+# and each picture is decoded a chunk at a time straight into a file, so the
+# picture data never has to be read into Python strings, or even into memory
+# at all beyond what the OS pages in while it's being scanned.
+#
+# Each picture e-readers can display is saved in an image directory under a
+# name derived from a hash of its contents, so a picture that appears more
+# than once (in the same document or in different chapters of a Scrivener
+# project) is only stored once, and the picture's group is replaced in the
+# document with a marker naming the file. After the document has been parsed,
+# insertImages() turns those markers into image nodes. Pictures that can't be
+# displayed are just removed.
+
+# The start of a picture group. \pict is a control word, so it can't be
+# followed by another letter (\pictscalex, for example, is something else.)
+# Word wraps pictures in a {\*\shppict ...} group, followed by a
+# {\nonshppict ...} group holding a copy of the same picture (usually as a
+# Windows metafile) for readers that don't understand the first one. The
+# wrapper is replaced along with the picture inside of it, and the copy is
+# removed.
+pictRegex = re.compile(rb'\{(?:\\\*)?\\(pict|shppict|nonshppict)(?![a-zA-Z])')
+
+# The tokens that matter when looking for the end of a group: escaped
+# characters, braces, and \binN, which is followed by N bytes of raw binary
+# data that might contain anything, including braces.
+groupTokenRegex = re.compile(rb'\\bin(-?[0-9]+) ?|\\[\\{}]|[{}]')
+
+# The tokens that can come before a picture's data: \binN, control words
+# describing the picture (like \pngblip or \picw), control symbols, nested
+# groups (like {\*\blipuid ...}) and whitespace. The first thing that isn't
+# one of these is the start of the picture's hex digits.
+pictHeaderTokenRegex = re.compile(rb'\\bin(-?[0-9]+) ?|\\[a-zA-Z]+-?[0-9]* ?|\\[^a-zA-Z]|\{|\s+')
+
+# Hex digits are decoded this many at a time
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+# The picture formats that are kept, recognized by the first few bytes of the
+# decoded picture, along with the extension they're saved with. These are the
+# raster formats RTF can hold that are also among EPUB's core media types.
+pictureSignatures = (
+	(b'\xff\xd8\xff', 'jpg'),
+	(b'\x89PNG\r\n\x1a\n', 'png')
+)
+
+# What a picture is replaced with in the document until it's been parsed. It
+# has to survive being parsed as ordinary text.
+markerPrefix = '[epubtools-image:'
+markerSuffix = ']'
+markerRegex = re.compile(re.escape(markerPrefix) + '([0-9a-f]{64}\\.[a-z]+)' + re.escape(markerSuffix))
+
+##############################################################################
+
+# Returns True if the character at the given position is escaped by an odd
+# number of backslashes before it.
+def isEscaped(buffer, position):
+
+	backslashes = 0
+
+	while position - backslashes > 0 and 0x5c == buffer[position - backslashes - 1]:
+		backslashes += 1
+
+	return 1 == backslashes % 2
+
+##############################################################################
+
+# Returns the position just past the closing brace of the group that starts
+# at the given position, or the end of the buffer if the group is never
+# closed.
+def findGroupEnd(buffer, start):
+
+	depth = 0
+	position = start
+
+	while True:
+
+		token = groupTokenRegex.search(buffer, position)
+
+		if not token:
+			return len(buffer)
+
+		position = token.end()
+
+		if token.group(1) is not None:
+			position += max(0, int(token.group(1)))
+
+		elif b'{' == token.group():
+			depth += 1
+
+		elif b'}' == token.group():
+
+			depth -= 1
+
+			if 0 == depth:
+				return position
+
+##############################################################################
+
+# Yields the (start, end) position of every picture group in the buffer, which
+# can be bytes or anything else that supports the buffer protocol, like an
+# mmap, followed by the (start, end) position of the {\pict ...} group that
+# holds the picture's data, or (None, None) if the picture should just be
+# removed.
+def findPictures(buffer):
+
+	position = 0
+
+	while True:
+
+		match = pictRegex.search(buffer, position)
+
+		if not match:
+			return
+
+		if isEscaped(buffer, match.start()):
+			position = match.start() + 1
+			continue
+
+		end = findGroupEnd(buffer, match.start())
+
+		pictStart, pictEnd = None, None
+
+		if b'pict' == match.group(1):
+			pictStart, pictEnd = match.start(), end
+
+		elif b'shppict' == match.group(1):
+
+			pict = pictRegex.search(buffer, match.end(), end)
+
+			if pict and b'pict' == pict.group(1):
+				pictStart, pictEnd = pict.start(), findGroupEnd(buffer, pict.start())
+
+		yield match.start(), end, pictStart, pictEnd
+		position = end
+
+##############################################################################
+
+# Copies bytes from the buffer into the picture file and the hash a chunk at
+# a time. If hexDigits is True, the bytes are hex digits to be decoded first,
+# which can be broken up by whitespace. Raises ValueError if they're not
+# valid hex digits.
+def _decodePicture(view, start, end, hexDigits, pictureFile, digest):
+
+	leftover = b''
+
+	for position in range(start, end, DECODE_CHUNK_SIZE):
+
+		chunk = bytes(view[position:min(position + DECODE_CHUNK_SIZE, end)])
+
+		if hexDigits:
+
+			# A pair of hex digits can be split between two chunks
+			chunk = leftover + chunk.translate(None, b' \t\r\n')
+			leftover = chunk[len(chunk) & ~1:]
+
+			try:
+				chunk = binascii.unhexlify(chunk[:len(chunk) & ~1])
+			except binascii.Error:
+				raise ValueError('Picture contains invalid hex digits.')
+
+		pictureFile.write(chunk)
+		digest.update(chunk)
+
+	if leftover:
+		raise ValueError('Picture contains an odd number of hex digits.')
+
+##############################################################################
+
+# Decodes the {\pict ...} group at the given position and saves it in
+# imageDir. Returns the name of the file it was saved as, or None if it's not
+# in a format that can be displayed.
+def extractPicture(buffer, start, end, imageDir):
+
+	# Skip past everything that describes the picture to get to its data,
+	# which runs until the end of the group unless it's raw binary data.
+	position = pictRegex.match(buffer, start).end()
+	dataEnd = end - 1
+	hexDigits = True
+
+	while position < dataEnd:
+
+		token = pictHeaderTokenRegex.match(buffer, position, dataEnd)
+
+		if not token:
+			break
+
+		elif token.group(1) is not None:
+			position = token.end()
+			dataEnd = min(dataEnd, position + max(0, int(token.group(1))))
+			hexDigits = False
+			break
+
+		elif b'{' == token.group():
+			position = findGroupEnd(buffer, position)
+
+		else:
+			position = token.end()
+
+	digest = hashlib.sha256()
+
+	with tempfile.NamedTemporaryFile(dir = imageDir, delete = False) as pictureFile:
+
+		try:
+
+			with memoryview(buffer) as view:
+				_decodePicture(view, position, dataEnd, hexDigits, pictureFile, digest)
+
+			pictureFile.seek(0)
+			header = pictureFile.read(8)
+
+		except:
+			pictureFile.close()
+			os.remove(pictureFile.name)
+			raise
+
+	for signature, extension in pictureSignatures:
+
+		if header.startswith(signature):
+
+			# If the same picture was already extracted, this just replaces
+			# it with an identical copy
+			filename = digest.hexdigest() + '.' + extension
+			os.replace(pictureFile.name, imageDir + '/' + filename)
+
+			return filename
+
+	os.remove(pictureFile.name)
+
+	return None
+
+##############################################################################
+
+# Extracts every picture in the buffer into imageDir and returns the rest of
+# the document as bytes, with each picture replaced by a marker. Returns None
+# if the document doesn't contain any pictures, in which case it can just be
+# read as-is. Pictures that can't be decoded are removed.
+def extractPictures(buffer, imageDir):
+
+	segments = []
+	position = 0
+
+	with memoryview(buffer) as view:
+
+		for start, end, pictStart, pictEnd in findPictures(buffer):
+
+			segments.append(bytes(view[position:start]))
+			position = end
+
+			if pictStart is None:
+				continue
+
+			try:
+				filename = extractPicture(buffer, pictStart, pictEnd, imageDir)
+			except ValueError:
+				filename = None
+
+			if filename:
+				segments.append((markerPrefix + filename + markerSuffix).encode('ascii'))
+
+		if not segments:
+			return None
+
+		segments.append(bytes(view[position:]))
+
+	return b''.join(segments)
+
+##############################################################################
+
+# Reads an RTF document, extracting every embedded picture into imageDir (see
+# extractPictures()), decoded the same way open() would decode it. Returns
+# None if the document doesn't contain any pictures, in which case it can
+# just be read as-is.
+def readExtractingPictures(filename, imageDir):
+
+	with open(filename, 'rb') as rtfFile:
+
+		# mmap can't map empty files
+		try:
+			buffer = mmap.mmap(rtfFile.fileno(), 0, access = mmap.ACCESS_READ)
+		except ValueError:
+			return None
+
+		try:
+
+			rtfBytes = extractPictures(buffer, imageDir)
+
+			if rtfBytes is None:
+				return None
+
+			return rtfBytes.decode(locale.getpreferredencoding(False))
+
+		finally:
+			buffer.close()
+
+##############################################################################
+
+# Removes the markers left behind by extractPictures() from text that won't
+# have them turned into images, like a chapter's title.
+def removeMarkers(text):
+
+	return markerRegex.sub('', text)
+
+##############################################################################
+
+# Replaces the markers left behind by extractPictures() in the text nodes of
+# a tree of EbookNodes with image nodes, whose value is the name of the image
+# and whose path attribute is where the image can be found.
+def insertImages(rootNode, imageDir):
+
+	nodes = [rootNode]
+
+	while nodes:
+
+		node = nodes.pop()
+		children = []
+		replaced = False
+
+		for child in node.children:
+
+			if 'text' != child.nodeType or not child.value or markerPrefix not in child.value:
+				children.append(child)
+				nodes.append(child)
+				continue
+
+			replaced = True
+
+			pieces = markerRegex.split(child.value)
+
+			# Pieces alternate between text and the names of images
+			for index, piece in enumerate(pieces):
+
+				if 1 == index % 2:
+					newChild = EbookNode('image', piece, {'path': imageDir + '/' + piece})
+				elif piece:
+					newChild = EbookNode('text', piece, child.attributes)
+				else:
+					continue
+
+				newChild.parent = node
+				children.append(newChild)
+
+		if replaced:
+			node.children = children
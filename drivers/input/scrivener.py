@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-import os, zipfile, shutil, binascii
+import locale, collections, multiprocessing, concurrent.futures
 import xml.etree.ElementTree as ET
 
 from pyrtfdom.dom import RTFDOM
@@ -8,12 +8,70 @@ from pyrtfdom import elements
 
 from exception import InputException
 from .driver import Driver
+from .chaptercache import ChapterCache
+from . import rtfpictures
+from .scrivenerproject import DirectoryProject, ZipProject
 from ..domnode import EbookNode
 
-import util
+import util, instrumentation
+
+# The driver used by a chapter parsing worker process (see
+# Scrivener.__parseChapters.)
+_parseState = None
+
+# Initializes a chapter parsing worker process.
+def _initParseWorker(driver):
+
+	global _parseState
+	_parseState = driver
+
+# Parses a single chapter inside of a worker process.
+def _parseChapterInWorker(chapterItem):
+
+	return _parseState._parseChapter(chapterItem['title'], chapterItem['filenamePrefix'])
+
+##############################################################################
 
 class Scrivener(Driver):
 
+	# Utility method to extract all text from a node and its descendants
+	# unformatted.
+	def __extractText(self, node):
+
+		if 'text' == node.nodeType:
+			return node.value if node.value else ''
+
+		return ''.join(self.__extractText(child) for child in node.children)
+
+	##########################################################################
+
+	# Returns an index of the comments and footnotes attached to the chapter
+	# currently being parsed, mapping each comment's ID to whether or not it's
+	# a footnote and its RTF. The chapter's comments file is only parsed the
+	# first time a link to one of its comments is found.
+	def __getCommentIndex(self):
+
+		if self.__commentIndex is None:
+
+			try:
+				with self.__project.open(self._curChapterFilenamePrefix + '.comments') as commentsFile:
+					commentsXML = ET.parse(commentsFile)
+			except:
+				raise InputException('Failed to parse ' + self._curChapterFilenamePrefix + '.comments')
+
+			self.__commentIndex = {}
+
+			# If an ID is somehow used more than once, the first comment wins
+			for comment in commentsXML.iterfind('./Comment'):
+				self.__commentIndex.setdefault(comment.get('ID'), (
+					'Yes' == comment.get('Footnote'),
+					comment.text
+				))
+
+		return self.__commentIndex
+
+	##########################################################################
+
 	# Scrivener footnotes are implemented internally as a special type of
 	# hyperlink field, so I need to override this field type (and possibly
 	# others in the future.)
@@ -36,29 +94,20 @@ class Scrivener(Driver):
 			# extra custom logic to parse it out.
 			else:
 
-				# First, parse the comments XML file associated with the chapter
-				# we're currently processing.
-				try:
-					commentsXML = ET.parse(self._curChapterFilenamePrefix + '.comments')
-				except:
-					raise InputException('Failed to parse ' + self._curChapterFilenamePrefix + '.comments')
-
-				comments = commentsXML.findall("./Comment[@ID='" + href[11:] + "']")
+				# First, look up the comment in the comments XML file
+				# associated with the chapter we're currently processing.
+				comment = self.__getCommentIndex().get(href[11:])
 
 				# Comment element couldn't be found, or it's not a footnote, so
 				# instead, append the text without the footnote.
-				if (
-					not comments or
-					not comments[0].get('Footnote') or
-					'Yes' != comments[0].get('Footnote')
-				):
+				if not comment or not comment[0]:
 					dom.insertFldrslt(fldrslt)
 
 				# The footnote exists, so go ahead and append it to the DOM.
 				else:
 
 					subTree = RTFDOM()
-					subTree.openString(comments[0].text)
+					subTree.openString(comment[1])
 					subTree.parse()
 
 					curParNode = dom.curNode.parent
@@ -69,12 +118,10 @@ class Scrivener(Driver):
 						dom.removeCurNode()
 
 					# Footnote is the only element other than RTFElement that
-					# accepts paragraphs as child nodes.
-					# TODO: the call to __parseRTFDOMParagraph is a bug,
-					# but I'm going to wait to dive into this until I've
-					# fully immersed myself in the code again...
+					# accepts paragraphs as child nodes. The footnote's text
+					# attribute is the text it's anchored to.
 					footnoteNode = elements.FootnoteElement()
-					footnoteNode.attributes['text'] = self.__parseRTFDOMParagraph(RTFDOM.parseSubRTF('{' + fldrslt + '}').children[0])
+					footnoteNode.attributes['text'] = self.__extractText(RTFDOM.parseSubRTF('{' + fldrslt + '}').children[0])
 					for paraNode in subTree.rootNode.children:
 						footnoteNode.appendChild(paraNode)
 
@@ -90,63 +137,233 @@ class Scrivener(Driver):
 
 	##########################################################################
 
-	# Opens up a ZIP file for input and passes back the path to the extracted
-	# contents.
-	def __openZipInput(self, filename):
+	# Uses RTFDOM to parse an individual chapter and returns its node. The
+	# chapter isn't added to the ebook's DOM here, so that chapters can be
+	# parsed out of order (see self.__parseChapters.)
+	def _parseChapter(self, chapterTitle, filenamePrefix):
+
+		print('Processing Chapter "' + chapterTitle + '"...')
+
+		chapterNode = EbookNode('chapter')
+		chapterNode.value = chapterTitle
+
+		self._curChapterFilenamePrefix = filenamePrefix
+		self.__commentIndex = None
+
+		with instrumentation.stage('parseChapter', title = chapterTitle):
+
+			# Embedded pictures are extracted into the image directory before
+			# the chapter is parsed (see rtfpictures.py.)
+			try:
+
+				with self.__project.open(filenamePrefix + '.rtf') as rtfFile:
+					rtfBytes = rtfFile.read()
+
+				withoutPictures = rtfpictures.extractPictures(rtfBytes, self._imageDir)
+
+				if withoutPictures is not None:
+					rtfBytes = withoutPictures
+
+				self.__domTree.openString(rtfBytes.decode(locale.getpreferredencoding(False)))
+
+			except (OSError, UnicodeDecodeError):
+				raise InputException('Could not read ' + filenamePrefix + '.rtf.')
+
+			self.__domTree.parse()
+
+			for child in self.__domTree.rootNode.children:
+
+				paragraphNode = EbookNode.fromRTFDOM(child)
+
+				if withoutPictures is not None:
+					rtfpictures.insertImages(paragraphNode, self._imageDir)
+
+				chapterNode.appendChild(paragraphNode)
+
+		return chapterNode
+
+	##########################################################################
+
+	# Returns True if the node or any of its descendants is an image.
+	def __hasImages(self, node):
+
+		if 'image' == node.nodeType:
+			return True
+
+		return any(self.__hasImages(child) for child in node.children)
+
+	##########################################################################
+
+	# Starts work on a chapter. Returns the chapter's node if it was found in
+	# the chapter cache, a future if it was handed off to a worker process, or
+	# None if it still needs to be parsed (see self.__finishChapter.)
+	def __startChapter(self, chapterItem, executor):
+
+		if self.__chapterCache:
+
+			chapterItem['cacheKey'] = self.__chapterCache.key([
+				chapterItem['filenamePrefix'] + '.rtf',
+				chapterItem['filenamePrefix'] + '.comments'
+			], self.__project.exists, self.__project.open)
+
+			chapterNode = self.__chapterCache.get(chapterItem['cacheKey'])
+
+			if chapterNode:
+				print('Processing Chapter "' + chapterItem['title'] + '" (cached)...')
+				chapterNode.value = chapterItem['title']
+				return chapterNode
+
+		if executor:
+			return executor.submit(_parseChapterInWorker, chapterItem)
+
+		return None
+
+	##########################################################################
+
+	# Finishes work on a chapter started by self.__startChapter and returns the
+	# chapter's node.
+	def __finishChapter(self, chapterItem, started):
+
+		if isinstance(started, EbookNode):
+			return started
+
+		if started is None:
+			chapterNode = self._parseChapter(chapterItem['title'], chapterItem['filenamePrefix'])
+		else:
+			chapterNode = started.result()
+
+		# Chapters with images aren't cached, since the images extracted from
+		# them are removed once the book has been converted.
+		if self.__chapterCache and not self.__hasImages(chapterNode):
+			self.__chapterCache.put(chapterItem['cacheKey'], chapterNode)
+
+		return chapterNode
+
+	##########################################################################
+
+	# Parses every chapter in the list of binder items and yields the resulting
+	# chapter nodes in the same order. Chapters don't depend on each other, so
+	# if more than one job was requested, they're parsed in a pool of worker
+	# processes, each of which has its own copy of the RTF parser. Only a few
+	# chapters per worker are parsed ahead of the one being yielded, so that
+	# memory use doesn't grow with the size of the book. Chapters found in the
+	# chapter cache aren't parsed at all.
+	def __parseChapters(self, chapterItems):
+
+		executor = None
+
+		# Like the Epub output driver, this relies on worker processes
+		# inheriting the driver through fork. Everywhere else, we just parse
+		# the chapters one at a time.
+		if (
+			self._jobs > 1 and len(chapterItems) > 1 and
+			'fork' in multiprocessing.get_all_start_methods()
+		):
+			executor = concurrent.futures.ProcessPoolExecutor(
+				max_workers = self._jobs,
+				mp_context = multiprocessing.get_context('fork'),
+				initializer = _initParseWorker,
+				initargs = (self,)
+			)
+
+		# How many chapters can be in progress at once besides the one that's
+		# about to be yielded
+		lookahead = self._jobs * 2 if executor else 0
 
 		try:
 
-			os.mkdir(self.extractPath)
-			archive = zipfile.ZipFile(filename)
+			inProgress = collections.deque()
 
-			# This should be safe as of Python 2.7.4, which adds path
-			# traversal protection
-			archive.extractall(self.extractPath)
-			return self.extractPath
+			for chapterItem in chapterItems:
 
-		except OSError:
-			raise InputException('Error occurred during input ZIP extraction. This is a bug.')
+				inProgress.append((chapterItem, self.__startChapter(chapterItem, executor)))
 
-		except zipfile.BadZipfile:
-			raise InputException('Input ZIP file is invalid.')
+				if len(inProgress) > lookahead:
+					yield self.__finishChapter(*inProgress.popleft())
 
-		except:
-			raise InputException('Could not extract input ZIP file.')
+			while inProgress:
+				yield self.__finishChapter(*inProgress.popleft())
+
+		# stream() takes chapters from here one at a time and closes the
+		# generator once it has all of them, so this is the only place
+		# that's guaranteed to run once every chapter has been parsed.
+		finally:
+
+			if executor:
+				executor.shutdown(cancel_futures = True)
+
+			if self.__chapterCache:
+				print(
+					'Chapter cache: ' + str(self.__chapterCache.hits) + ' hits, ' +
+					str(self.__chapterCache.misses) + ' misses.'
+				)
 
 	##########################################################################
 
-	# Uses RTFDOM to parse an individual chapter and adds it to the ebook's DOM.
-	def __parseChapter(self, chapterTitle, filename):
+	# Recursively walks the binder and returns a flat list of the parts and
+	# chapters it contains in binder order. The first folder, if it exists,
+	# will be treated as a "part," a subdivision above chapter.
+	def __walkBinder(self, parentNode, depth = 0):
 
-		chapterNode = EbookNode('chapter')
-		chapterNode.value = chapterTitle
+		binderItems = []
+
+		for binderItem in parentNode:
+
+			chapterTitle = binderItem.find('Title').text
+
+			# Chapter
+			if 'Text' == binderItem.attrib['Type']:
+
+				binderItems.append({
+					'type': 'chapter',
+					'title': chapterTitle,
+					'filenamePrefix': 'Files/Docs/' + binderItem.attrib['ID'],
+					'depth': depth
+				})
 
-		self.__domTree.openFile(filename)
-		self.__domTree.parse()
+			elif 'Folder' == binderItem.attrib['Type']:
+
+				# We've encountered a titled part of the book containing chapters
+				if 0 == depth:
 
-		for child in self.__domTree.rootNode.children:
-			chapterNode.appendChild(child)
+					binderItems.append({
+						'type': 'part',
+						'title': chapterTitle,
+						'depth': depth
+					})
 
-		self._curDOMNode.appendChild(chapterNode)
+				children = binderItem.find('Children')
+
+				if children is not None:
+					binderItems.extend(self.__walkBinder(children, depth + 1))
+
+		return binderItems
 
 	##########################################################################
 
-	# Constructor
-	def __init__(self, tmpLocation = '/tmp'):
+	# Constructor. If chapterCachePath is set, parsed chapters are cached in
+	# that directory, which is limited to chapterCacheSize bytes. tmpLocation
+	# isn't used anymore, since zipped projects are read without being
+	# extracted.
+	def __init__(self, tmpLocation = '/tmp', jobs = 1, chapterCachePath = None,
+	chapterCacheSize = 512 * 1024 * 1024):
+
+		super().__init__(jobs)
 
-		super().__init__()
+		# Optional cache of previously parsed chapters (see chaptercache.py)
+		self.__chapterCache = ChapterCache(chapterCachePath, chapterCacheSize) if chapterCachePath else None
 
 		# Initialize the RTF parser
 		self.__domTree = RTFDOM()
 		self.__registerCustomFieldDrivers()
 
-		# Generate a unique ID that can be used in /tmp to avoid collisions
-		# during concurrently running instances.
-		self.__uid = str(binascii.hexlify(os.urandom(16))).replace("'", '')[1:]
-		self.__tmpOutputDir = tmpLocation + '/' + self.__uid
+		# Comments attached to the chapter currently being parsed (see
+		# self.__getCommentIndex)
+		self.__commentIndex = None
 
-		# Where we extract ZIP archives, if a ZIP archive was passed as input
-		self.__extractPath = self.__tmpOutputDir + '_input'
+		# The project's files, which might be in a directory or a ZIP archive
+		# (see scrivenerproject.py)
+		self.__project = None
 
 	##########################################################################
 
@@ -156,89 +373,88 @@ class Scrivener(Driver):
 
 		# Add support for ZIP archives
 		if self._inputPath.lower().endswith('.zip'):
-			self._inputPath = self.__openZipInput(self._inputPath)
+			with instrumentation.stage('openZip', filename = filename):
+				self.__project = ZipProject(self._inputPath)
+		else:
+			self.__project = DirectoryProject(self._inputPath)
+
+		self._createImageDir()
 
 	##########################################################################
 
-	# Iterates through a Scrivener project and parses each contained chapter.
-	# Recursively enters project folders. The first folder, if it exists, will
-	# be treated as a "part," a subdivision above chapter.
-	def parse(self, parentNode = False, depth = 0):
+	# Iterates through a Scrivener project and parses each contained chapter
+	# into the ebook's DOM.
+	def parse(self):
 
-		if not parentNode:
+		self._buildDOM(self.stream())
 
-			scrivxPath = False
+	##########################################################################
 
-			for filename in os.listdir(self._inputPath):
-				if filename.lower().endswith('.scrivx'):
-					scrivxPath = os.path.join(self._inputPath, filename)
-					break
+	# Iterates through a Scrivener project and yields each part and chapter in
+	# binder order. The binder is walked first to get a list of everything in
+	# the Draft Folder, and then each chapter is parsed and yielded in turn.
+	def stream(self):
 
-			if not scrivxPath:
-				raise InputException(self._inputPath + ' is not a valid Scrivener project.')
+		scrivxPath = self.__project.findScrivx()
 
-			try:
-				tree = ET.parse(scrivxPath)
-			except:
-				raise InputException('Failed to open ' + scrivxPath + ' for parsing.')
+		if not scrivxPath:
+			raise InputException(self._inputPath + ' is not a valid Scrivener project.')
 
-			parentNode = tree.getroot()
+		try:
+			with self.__project.open(scrivxPath) as scrivxFile:
+				tree = ET.parse(scrivxFile)
+		except:
+			raise InputException('Failed to open ' + scrivxPath + ' for parsing.')
 
-			if parentNode.tag != 'ScrivenerProject':
-				raise InputException(self._inputPath + ' is not a valid Scrivener project.')
+		rootNode = tree.getroot()
 
-			# We only want to process files found in the Draft Folder. Notes and
-			# other things in other zero depth folders should be ignored.
-			for binderItem in parentNode.find('Binder').findall('BinderItem'):
-				if 'DraftFolder' == binderItem.attrib['Type']:
-					self.parse(binderItem.find('Children'), depth)
-					return
+		if rootNode.tag != 'ScrivenerProject':
+			raise InputException(self._inputPath + ' is not a valid Scrivener project.')
 
-		for binderItem in parentNode:
+		# We only want to process files found in the Draft Folder. Notes and
+		# other things in other zero depth folders should be ignored.
+		binderItems = []
 
-			chapterTitle = binderItem.find('Title').text
+		for binderItem in rootNode.find('Binder').findall('BinderItem'):
+			if 'DraftFolder' == binderItem.attrib['Type']:
+				binderItems = self.__walkBinder(binderItem.find('Children'))
+				break
 
-			# Make sure root chapters always show up in the root of the table of
-			# contents. Without this line of code, if there's a previously
-			# processed part, the chapter will be added to it even if the chapter
-			# is supposed to be outside of it.
-			if 0 == depth and ('Text' == binderItem.attrib['Type'] or 'Folder' == binderItem.attrib['Type']):
-				self._curDOMNode = self.DOMRoot
+		chapterNodes = self.__parseChapters(
+			[item for item in binderItems if 'chapter' == item['type']]
+		)
 
-			# Chapter
-			if 'Text' == binderItem.attrib['Type']:
+		try:
 
-				print('Processing Chapter "' + chapterTitle + '"...')
+			for item in binderItems:
 
-				self._curChapterFilenamePrefix = self._inputPath + '/Files/Docs/' + binderItem.attrib['ID']
-				self.__parseChapter(chapterTitle, self._curChapterFilenamePrefix  + '.rtf')
+				if 'part' == item['type']:
 
-			elif 'Folder' == binderItem.attrib['Type']:
+					print('Processing Part "' + item['title'] + '"...')
 
-				# We've encountered a titled part of the book containing chapters
-				if 0 == depth:
+					partNode = EbookNode('part')
+					partNode.value = item['title']
 
-					print('Processing Part "' + chapterTitle + '"...')
+					yield 0, partNode
 
-					partNode = EbookNode('part')
-					partNode.value = chapterTitle
-					self._curDOMNode.appendChild(partNode)
-					self._curDOMNode = partNode
+				# Chapters in the root of the binder always show up in the root
+				# of the table of contents, even if there's a previously
+				# processed part.
+				else:
+					yield min(item['depth'], 1), next(chapterNodes)
 
-				self.parse(self._inputPath, binderItem.find('Children'), depth + 1)
+		# Make sure any worker processes are shut down if we're not run to the
+		# end.
+		finally:
+			chapterNodes.close()
 
 	##########################################################################
 
-	# If we extracted a ZIP archive, we need to delete those temporary files.
+	# If we opened a ZIP archive, we need to close it. Images extracted from
+	# the project are removed, too.
 	def cleanup(self):
 
-		try:
-			if os.path.exists(self.__extractPath):
-				shutil.rmtree(self.__extractPath)
+		if self.__project:
+			self.__project.close()
 
-		# If for some reason we can't remove these files, I don't want a backend
-		# process on a server to return with an error. So we'll just silently
-		# fail and monitor /tmp from time to time to make sure it doesn't fill
-		# up with too many files.
-		except:
-			pass
+		self._removeImageDir()
@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+import os, zipfile, posixpath
+
+from exception import InputException
+
+# The Scrivener driver reads projects through one of the classes below, so
+# that it doesn't have to care whether a project is a directory on disk or a
+# ZIP archive. Paths are always relative to the root of the project (the
+# directory containing the .scrivx file) and use forward slashes, like
+# 'Files/Docs/12.rtf'.
+
+##############################################################################
+
+# A Scrivener project that's a directory on disk.
+class DirectoryProject:
+
+	# Constructor
+	def __init__(self, projectPath):
+
+		self.__projectPath = projectPath
+
+	##########################################################################
+
+	# Returns the path of the project's .scrivx file, or None if there isn't
+	# one.
+	def findScrivx(self):
+
+		for filename in os.listdir(self.__projectPath):
+			if filename.lower().endswith('.scrivx'):
+				return filename
+
+		return None
+
+	##########################################################################
+
+	# Returns True if the given file exists in the project.
+	def exists(self, path):
+
+		return os.path.isfile(self.__projectPath + '/' + path)
+
+	##########################################################################
+
+	# Opens a file in the project for reading in binary mode.
+	def open(self, path):
+
+		return open(self.__projectPath + '/' + path, 'rb')
+
+	##########################################################################
+
+	# Nothing to clean up.
+	def close(self):
+
+		pass
+
+##############################################################################
+
+# A Scrivener project inside of a ZIP archive. Files are read straight out of
+# the archive as they're needed, so nothing is ever extracted to disk, and
+# research files, media and snapshots that aren't part of the draft are never
+# even decompressed. The project may either be at the root of the archive or
+# in a directory inside of it (which is what you get by compressing the .scriv
+# directory itself.)
+class ZipProject:
+
+	# Constructor
+	def __init__(self, archivePath):
+
+		self.__archivePath = archivePath
+		self.__archive = None
+		self.__archivePid = None
+
+		# Path of the project's root inside the archive, including the
+		# trailing slash
+		self.__root = ''
+		self.__scrivx = None
+
+		# Use the .scrivx file closest to the root of the archive, ignoring
+		# any that are inside of another project's files (like a backup of
+		# the project stored in its own research folder.)
+		for name in self.__getArchive().namelist():
+
+			if name.lower().endswith('.scrivx') and (
+				not self.__scrivx or
+				name.count('/') < (self.__root + self.__scrivx).count('/')
+			):
+				self.__root, self.__scrivx = posixpath.split(name)
+				self.__root = self.__root + '/' if self.__root else ''
+
+	##########################################################################
+
+	# Returns the open archive. Worker processes forked from the one that
+	# opened the archive would otherwise share its file offset, so each
+	# process opens the archive for itself.
+	def __getArchive(self):
+
+		if self.__archivePid != os.getpid():
+
+			try:
+				self.__archive = zipfile.ZipFile(self.__archivePath)
+				self.__archivePid = os.getpid()
+
+			except zipfile.BadZipfile:
+				raise InputException('Input ZIP file is invalid.')
+
+			except OSError:
+				raise InputException('Could not open input ZIP file ' + self.__archivePath + '.')
+
+		return self.__archive
+
+	##########################################################################
+
+	# Returns the path of the project's .scrivx file, or None if there isn't
+	# one.
+	def findScrivx(self):
+
+		return self.__scrivx
+
+	##########################################################################
+
+	# Returns True if the given file exists in the project.
+	def exists(self, path):
+
+		try:
+			self.__getArchive().getinfo(self.__root + path)
+			return True
+
+		except KeyError:
+			return False
+
+	##########################################################################
+
+	# Opens a file in the project for reading in binary mode.
+	def open(self, path):
+
+		try:
+			return self.__getArchive().open(self.__root + path)
+
+		except KeyError:
+			raise FileNotFoundError(path + ' does not exist in ' + self.__archivePath)
+
+	##########################################################################
+
+	# Closes the archive.
+	def close(self):
+
+		if self.__archive and self.__archivePid == os.getpid():
+			self.__archive.close()
+
+		self.__archive = None
+		self.__archivePid = None
@@ -1,55 +1,144 @@
 # -*- coding: utf-8 -*-
 
-import os, subprocess
+import os, shutil, tempfile, subprocess
+import multiprocessing.util
 
 from pyrtfdom.dom import RTFDOM
 from pyrtfdom import elements
 
+import util, instrumentation
 from exception import InputException
+from .officeserver import OfficeServer, unoAvailable
 from .rtf import Rtf
 from .driver import Driver
 from ..domnode import EbookNode
 
 class Soffice(Rtf):
 
-	# Convert document format that LibreOffice/OpenOffice understands into an RTF
-	def __docToRTF(self):
+	# A single office instance that's kept running in the background and
+	# shared by every instance of the driver in the same process, if
+	# persistentOffice was requested (see drivers/input/officeserver.py)
+	__officeServer = None
+
+	# Set once we've verified that LibreOffice or OpenOffice is installed, so
+	# that we don't have to run soffice --version for every document.
+	__sofficeInstalled = False
+
+	# The office profile used by soffice processes started by the current
+	# process, and the ID of the process that created it (see
+	# self.__getProfilePath.)
+	__profilePath = None
+	__profilePid = None
+
+	##########################################################################
+
+	# Makes sure LibreOffice or OpenOffice is installed.
+	@classmethod
+	def warmup(cls):
+
+		if Soffice.__sofficeInstalled:
+			return
 
 		try:
+			subprocess.check_output(['soffice', '--version'])
+
+		except:
+			raise AssertionError('LibreOffice or OpenOffice executable must be installed to use the Soffice driver.')
+
+		Soffice.__sofficeInstalled = True
+
+	##########################################################################
+
+	# Returns the persistent office instance for the current process, starting
+	# a new one if necessary.
+	@classmethod
+	def __getOfficeServer(cls, tmpLocation):
+
+		if not Soffice.__officeServer or not Soffice.__officeServer.ownedByCurrentProcess():
+			Soffice.__officeServer = OfficeServer(tmpLocation)
+
+		return Soffice.__officeServer
+
+	##########################################################################
+
+	# Returns the office profile used by soffice processes started by the
+	# current process. Office instances that share a profile lock each other
+	# out, so every process (including batch workers, which are forked) gets
+	# its own, which is removed when the process exits.
+	@classmethod
+	def __getProfilePath(cls, tmpLocation):
 
-			filename = os.path.splitext(os.path.split(self._inputPath)[1])[0]
+		if Soffice.__profilePid != os.getpid():
+
+			Soffice.__profilePath = tempfile.mkdtemp(prefix = 'epubtools-office-', dir = tmpLocation)
+			Soffice.__profilePid = os.getpid()
+
+			multiprocessing.util.Finalize(None, shutil.rmtree,
+				args = (Soffice.__profilePath, True), exitpriority = 10)
+
+		return Soffice.__profilePath
+
+	##########################################################################
+
+	# Convert document format that LibreOffice/OpenOffice understands into an
+	# RTF. Each conversion is written to its own temporary directory, so that
+	# documents with the same name converted at the same time can't overwrite
+	# each other.
+	def __docToRTF(self):
+
+		filename = os.path.splitext(os.path.split(self._inputPath)[1])[0]
+
+		self.__conversionPath = tempfile.mkdtemp(prefix = 'epubtools-rtf-', dir = self.__tmpPath)
+		rtfPath = self.__conversionPath + '/' + filename + '.rtf'
+
+		# Hand the document off to the long-lived office instance instead of
+		# starting a new one
+		if self.__persistentOffice:
+			self.__getOfficeServer(self.__tmpPath).convert(self._inputPath, rtfPath)
+			return rtfPath
+
+		try:
 
 			output = subprocess.check_output([
 				'soffice',
 				'--headless',
+				'-env:UserInstallation=file://' + os.path.abspath(self.__getProfilePath(self.__tmpPath)),
 				'--convert-to',
 				'rtf',
-				self._inputPath, '--outdir', self.__tmpPath
+				self._inputPath, '--outdir', self.__conversionPath
 			], universal_newlines=True)
 
 			if output.find('Error:') >= 0:
 				raise InputException('Could not convert document')
 			else:
-				return self.__tmpPath + '/' + filename + '.rtf'
+				return rtfPath
 
 		except:
 			raise InputException('Could not convert document')
 
 	##########################################################################
 
-	# Constructor
-	def __init__(self, tmpLocation = '/tmp'):
+	# Constructor. If persistentOffice is True, documents are converted by a
+	# long-lived office instance rather than a new soffice process each time,
+	# which requires LibreOffice's uno module.
+	def __init__(self, tmpLocation = '/tmp', jobs = 1, persistentOffice = False):
 
-		super().__init__()
+		super().__init__(jobs)
 
 		self.__tmpPath = tmpLocation
 		self.__requiresCleanup = False
 
-		try:
-			subprocess.check_output(['soffice', '--version'])
+		# The temporary directory the document was converted into, if it had
+		# to be converted
+		self.__conversionPath = None
 
-		except:
-			raise AssertionError('LibreOffice or OpenOffice executable must be installed to use the Soffice driver.')
+		self.warmup()
+
+		self.__persistentOffice = persistentOffice
+
+		if self.__persistentOffice and not unoAvailable:
+			util.eprint('Warning: the uno module is not installed, so a new soffice process will be started for each document.')
+			self.__persistentOffice = False
 
 	##########################################################################
 
@@ -59,8 +148,9 @@ class Soffice(Rtf):
 
 		# If it's not an RTF file, convert it to one first
 		if not filename.lower().endswith('.rtf'):
-			self._inputPath = self.__docToRTF()
 			self.__requiresCleanup = True
+			with instrumentation.stage('sofficeConversion', filename = filename):
+				self._inputPath = self.__docToRTF()
 
 	##########################################################################
 
@@ -73,8 +163,8 @@ class Soffice(Rtf):
 		if self.__requiresCleanup:
 
 			try:
-				if os.path.isfile(self._inputPath):
-					os.remove(self._inputPath)
+				if self.__conversionPath and os.path.isdir(self.__conversionPath):
+					shutil.rmtree(self.__conversionPath)
 
 			# If for some reason we can't remove these files, I don't want a backend
 			# process on a server to return with an error. So we'll just silently
@@ -82,3 +172,5 @@ class Soffice(Rtf):
 			# up with too many files.
 			except:
 				pass
+
+		super().cleanup()
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+
+import os, time, zlib, struct, hashlib, shutil, filecmp, zipfile, collections, concurrent.futures
+
+from exception import OutputException
+
+# EPUB containers are ZIP archives whose first entry must be an uncompressed
+# file called "mimetype." Output drivers write the book's files through one of
+# the container classes below, which hide whether those files are streamed
+# straight into the archive or staged on disk first.
+EPUB_MIMETYPE = 'application/epub+zip'
+
+# Compression levels that can be selected by name (see compressionLevel().)
+# "fast" is meant for ARCs and previews that are rebuilt all the time, and
+# "max" for books that are uploaded to stores.
+COMPRESSION_PRESETS = {'fast': 1, 'default': 6, 'max': 9}
+
+# Files that are already compressed, like images, fonts in WOFF format, audio
+# and video, barely shrink at all when they're deflated again, so they're
+# stored as-is instead.
+STORED_EXTENSIONS = frozenset([
+	'.jpg', '.jpeg', '.png', '.gif', '.webp', '.woff', '.woff2',
+	'.mp3', '.m4a', '.mp4', '.m4v', '.zip'
+])
+
+# Every file in the archive (other than the mimetype, which isn't allowed to
+# have one) gets a ZIP extra field holding the SHA-256 digest of its contents,
+# which incremental builds use to tell whether a file has changed since the
+# previous build (see ZipContainer.) The header ID isn't one that's assigned
+# in the ZIP specification, so other tools just skip over the field.
+DIGEST_EXTRA_ID = 0x6873
+
+# Files at least this big are compressed by a pool of threads when more than
+# one is available. zlib releases the GIL while it works, so several large
+# files can be compressed at once. Smaller files aren't worth the overhead.
+PARALLEL_COMPRESSION_SIZE = 64 * 1024
+
+##############################################################################
+
+# Returns the timestamp given to every file in deterministic mode. Following
+# the reproducible builds convention, it's taken from the SOURCE_DATE_EPOCH
+# environment variable if it's set. Otherwise, it's the earliest date a ZIP
+# archive can store (which is also where SOURCE_DATE_EPOCH is clamped to.)
+def deterministicDateTime():
+
+	try:
+		epoch = int(os.environ.get('SOURCE_DATE_EPOCH', 0))
+	except ValueError:
+		epoch = 0
+
+	return time.gmtime(max(epoch, 315532800))[:6]
+
+##############################################################################
+
+# Returns the compression level for a preset name from COMPRESSION_PRESETS or
+# a level from 0 to 9.
+def compressionLevel(preset):
+
+	if preset in COMPRESSION_PRESETS:
+		return COMPRESSION_PRESETS[preset]
+
+	elif str(preset).isdigit() and 0 <= int(preset) <= 9:
+		return int(preset)
+
+	raise OutputException('Unknown compression level ' + str(preset) + '. Use ' + ', '.join(COMPRESSION_PRESETS) + ' or a number from 0 to 9.')
+
+##############################################################################
+
+# Returns the general purpose flags the ZIP format uses to record roughly how
+# hard a deflated file was compressed (normal, maximum, fast or super fast.)
+# They're used to tell whether a file in a previous build was compressed at the
+# level we'd compress it at now.
+def _deflateFlags(level):
+
+	if level >= 8:
+		return 0x02
+	elif 1 == level:
+		return 0x06
+	elif level <= 2:
+		return 0x04
+	else:
+		return 0x00
+
+##############################################################################
+
+# Returns the ZIP extra field that records a file's SHA-256 digest.
+def _digestExtra(digest):
+
+	return struct.pack('<HH', DIGEST_EXTRA_ID, len(digest)) + digest
+
+##############################################################################
+
+# Returns the SHA-256 digest recorded in an entry's extra field, or None if it
+# doesn't have one.
+def _entryDigest(info):
+
+	extra = info.extra
+	position = 0
+
+	while position + 4 <= len(extra):
+
+		fieldId, fieldSize = struct.unpack('<HH', extra[position:position + 4])
+
+		if DIGEST_EXTRA_ID == fieldId:
+			return extra[position + 4:position + 4 + fieldSize]
+
+		position += 4 + fieldSize
+
+	return None
+
+##############################################################################
+
+# Compresses data into a raw deflate stream, the way ZIP archives store it.
+def _deflate(data, level):
+
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	return compressor.compress(data) + compressor.flush()
+
+##############################################################################
+
+# Streams every file directly into the output archive. Nothing is written to
+# disk except the archive itself, which is assembled under a temporary name
+# next to the final file and moved into place when the book is complete, so
+# a failed conversion never leaves a truncated e-book behind.
+#
+# Files are deflated at the given compression level, except for those that are
+# already compressed (see STORED_EXTENSIONS.) If more than one thread is
+# allowed, large files are compressed in the background while the rest of the
+# book is being written, but files always end up in the archive in the order
+# they were written, so the same book always produces the same archive.
+#
+# If the path to a previously built version of the same book is given, any
+# file whose contents haven't changed since that build is copied over from it
+# as-is, without being compressed again. Files are compared using the SHA-256
+# digest recorded in each entry's extra field (see DIGEST_EXTRA_ID), rather
+# than the CRC-32 the ZIP format records, since a changed file can easily end
+# up with the same CRC-32. Files from builds that predate the digests are
+# never reused.
+#
+# In deterministic mode, every file gets the same timestamp and attributes, so
+# that writing the same files in the same order always produces the same
+# archive. If the output file already exists and is identical to the new
+# archive, it isn't replaced (and unchanged is set to True), so that its
+# modification time still reflects when its contents last changed.
+class ZipContainer:
+
+	# Constructor
+	def __init__(self, filename, uid, previousFilename = None,
+	compressLevel = COMPRESSION_PRESETS['default'], threads = 1,
+	deterministic = False):
+
+		self.__filename = filename
+		self.__partialFilename = filename + '.' + uid + '.part'
+		self.__compressLevel = compressLevel
+
+		self.__deterministic = deterministic
+		self.__dateTime = deterministicDateTime() if deterministic else None
+
+		# Set by close() if the output file was already identical to the new
+		# archive (only checked in deterministic mode)
+		self.unchanged = False
+
+		# Number of files reused from the previous build and written in total
+		self.reused = 0
+		self.written = 0
+
+		# Files waiting to be added to the archive, in order, as (ZipInfo,
+		# data) pairs. Data is either bytes, a future that will return bytes
+		# once a thread is done compressing it or an iterable of blocks copied
+		# from the previous build.
+		self.__pending = collections.deque()
+		self.__compressionPool = None
+
+		if threads > 1:
+			self.__compressionPool = concurrent.futures.ThreadPoolExecutor(threads)
+
+		# Limits how many compressed files can pile up waiting for an earlier
+		# one to finish
+		self.__maxPending = threads * 2
+
+		self.__previous = None
+
+		if previousFilename:
+
+			try:
+				self.__previous = zipfile.ZipFile(previousFilename, 'r')
+
+			# If the previous build is unreadable, we just don't reuse anything
+			# from it.
+			except (OSError, zipfile.BadZipfile):
+				self.__previous = None
+
+		try:
+			self.__zipf = zipfile.ZipFile(self.__partialFilename, 'w')
+			self.__zipf.writestr(self.__newEntry('mimetype'), EPUB_MIMETYPE, compress_type = zipfile.ZIP_STORED)
+
+		except:
+			raise OutputException('Failed to write output file ' + filename)
+
+	##########################################################################
+
+	# Returns a new ZipInfo for a file about to be added to the archive, with
+	# the same timestamp and attributes zipfile would have given it, or the
+	# normalized ones in deterministic mode.
+	def __newEntry(self, path):
+
+		if self.__deterministic:
+			zinfo = zipfile.ZipInfo(path, self.__dateTime)
+			zinfo.create_system = 3
+		else:
+			zinfo = zipfile.ZipInfo(path, time.localtime(time.time())[:6])
+
+		zinfo.external_attr = 0o600 << 16
+
+		return zinfo
+
+	##########################################################################
+
+	# Returns the previous build's entry for path if its contents match the
+	# given SHA-256 digest and size and it was stored the same way, or None
+	# otherwise.
+	def __unchangedEntry(self, path, digest, size, compressType):
+
+		if not self.__previous:
+			return None
+
+		try:
+			info = self.__previous.getinfo(path)
+		except KeyError:
+			return None
+
+		if (
+			_entryDigest(info) == digest and info.file_size == size and
+			compressType == info.compress_type and
+			not info.flag_bits & 0x01 and (
+				zipfile.ZIP_STORED == compressType or
+				info.flag_bits & 0x06 == _deflateFlags(self.__compressLevel)
+			)
+		):
+			return info
+
+		return None
+
+	##########################################################################
+
+	# Yields the compressed data of an entry in the previous build, without
+	# decompressing it. This doesn't happen until the entry is actually being
+	# written, since the previous build is read from a single file handle.
+	def __readPreviousEntry(self, info):
+
+		previousFile = self.__previous.fp
+
+		# Skip past the previous entry's local file header to get to its data
+		previousFile.seek(info.header_offset)
+		header = struct.unpack(zipfile.structFileHeader, previousFile.read(zipfile.sizeFileHeader))
+		previousFile.seek(info.header_offset + zipfile.sizeFileHeader + header[10] + header[11])
+
+		remaining = info.compress_size
+
+		while remaining > 0:
+
+			block = previousFile.read(min(remaining, 1024 * 1024))
+
+			if not block:
+				raise OutputException('Previous build is truncated.')
+
+			yield block
+			remaining -= len(block)
+
+	##########################################################################
+
+	# Writes an entry whose data has already been compressed into the archive.
+	# zipfile doesn't have a public API for this, so this mirrors what
+	# ZipFile.open() does when writing a new entry.
+	def __writeRaw(self, zinfo, blocks):
+
+		self.__zipf.fp.seek(self.__zipf.start_dir)
+		zinfo.header_offset = self.__zipf.fp.tell()
+
+		self.__zipf._writecheck(zinfo)
+		self.__zipf._didModify = True
+
+		self.__zipf.fp.write(zinfo.FileHeader())
+
+		for block in blocks:
+			self.__zipf.fp.write(block)
+
+		self.__zipf.start_dir = self.__zipf.fp.tell()
+		self.__zipf.filelist.append(zinfo)
+		self.__zipf.NameToInfo[zinfo.filename] = zinfo
+
+	##########################################################################
+
+	# Writes out pending files in order until no more than maxPending are
+	# left, and then keeps going for as long as the next one is ready.
+	def __flush(self, maxPending):
+
+		while self.__pending and (
+			len(self.__pending) > maxPending or
+			not isinstance(self.__pending[0][1], concurrent.futures.Future) or
+			self.__pending[0][1].done()
+		):
+
+			zinfo, data = self.__pending.popleft()
+
+			if isinstance(data, concurrent.futures.Future):
+				data = data.result()
+
+			if isinstance(data, bytes):
+				zinfo.compress_size = len(data)
+				data = (data,)
+
+			self.__writeRaw(zinfo, data)
+
+	##########################################################################
+
+	# Adds a file to the archive. Data can be either a string, which will be
+	# encoded as UTF-8, or raw bytes.
+	def write(self, path, data):
+
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+
+		self.written += 1
+
+		if os.path.splitext(path)[1].lower() in STORED_EXTENSIONS:
+			compressType = zipfile.ZIP_STORED
+		else:
+			compressType = zipfile.ZIP_DEFLATED
+
+		digest = hashlib.sha256(data).digest()
+		size = len(data)
+		unchangedEntry = self.__unchangedEntry(path, digest, size, compressType)
+
+		if unchangedEntry:
+
+			if self.__deterministic:
+				zinfo = self.__newEntry(path)
+			else:
+				zinfo = zipfile.ZipInfo(unchangedEntry.filename, unchangedEntry.date_time)
+				zinfo.external_attr = unchangedEntry.external_attr
+				zinfo.create_system = unchangedEntry.create_system
+
+			zinfo.flag_bits = unchangedEntry.flag_bits
+			zinfo.compress_size = unchangedEntry.compress_size
+			crc = unchangedEntry.CRC
+			data = self.__readPreviousEntry(unchangedEntry)
+
+			self.reused += 1
+
+		else:
+
+			zinfo = self.__newEntry(path)
+			crc = zlib.crc32(data)
+
+			if zipfile.ZIP_DEFLATED == compressType:
+
+				zinfo.flag_bits |= _deflateFlags(self.__compressLevel)
+
+				if self.__compressionPool and len(data) >= PARALLEL_COMPRESSION_SIZE:
+					data = self.__compressionPool.submit(_deflate, data, self.__compressLevel)
+				else:
+					data = _deflate(data, self.__compressLevel)
+
+		zinfo.compress_type = compressType
+		zinfo.CRC = crc
+		zinfo.extra = _digestExtra(digest)
+		zinfo.file_size = size
+
+		self.__pending.append((zinfo, data))
+		self.__flush(self.__maxPending)
+
+	##########################################################################
+
+	# Adds an existing file on disk to the archive.
+	def copy(self, path, sourcePath):
+
+		with open(sourcePath, 'rb') as sourceFile:
+			self.write(path, sourceFile.read())
+
+	##########################################################################
+
+	# Finalizes the archive and moves it to its final destination.
+	def close(self):
+
+		try:
+
+			self.__flush(0)
+			self.__zipf.close()
+
+			if self.__compressionPool:
+				self.__compressionPool.shutdown()
+
+			if self.__previous:
+				self.__previous.close()
+
+			if (
+				self.__deterministic and os.path.isfile(self.__filename) and
+				filecmp.cmp(self.__partialFilename, self.__filename, shallow = False)
+			):
+				os.remove(self.__partialFilename)
+				self.unchanged = True
+
+			else:
+				os.replace(self.__partialFilename, self.__filename)
+
+		except:
+			raise OutputException('Failed to write output file ' + self.__filename)
+
+	##########################################################################
+
+	# Removes the partially written archive if the conversion failed before
+	# close() was called.
+	def cleanup(self):
+
+		try:
+
+			if self.__compressionPool:
+				self.__compressionPool.shutdown(cancel_futures = True)
+
+			self.__zipf.close()
+
+			if self.__previous:
+				self.__previous.close()
+
+			if os.path.isfile(self.__partialFilename):
+				os.remove(self.__partialFilename)
+
+		# See the comment in DirectoryContainer.cleanup().
+		except:
+			pass
+
+##############################################################################
+
+# Writes every file into a staging directory and then zips up the result. This
+# is slower than ZipContainer, since every file hits the disk twice, but it's
+# useful for debugging, because the unzipped book can be inspected by hand.
+# The compression level, number of threads and deterministic mode are the
+# same as ZipContainer's.
+class DirectoryContainer:
+
+	# Constructor
+	def __init__(self, filename, stagingDir,
+	compressLevel = COMPRESSION_PRESETS['default'], threads = 1,
+	deterministic = False):
+
+		self.__filename = filename
+		self.__stagingDir = stagingDir
+		self.__compressLevel = compressLevel
+		self.__threads = threads
+		self.__deterministic = deterministic
+
+		# Every file written so far, in order
+		self.__paths = {}
+
+		# See ZipContainer.unchanged
+		self.unchanged = False
+
+		# Create the book's directory structure
+		try:
+			os.mkdir(self.__stagingDir)
+			os.mkdir(self.__stagingDir + '/OEBPS')
+			os.mkdir(self.__stagingDir + '/META-INF')
+
+		except:
+			raise OutputException('Failed to create temporary output directory.')
+
+		self.write('mimetype', EPUB_MIMETYPE)
+
+	##########################################################################
+
+	# Writes a file into the staging directory, creating any subdirectories
+	# it needs (like OEBPS/images.) Data can be either a string, which will be
+	# encoded as UTF-8, or raw bytes.
+	def write(self, path, data):
+
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+
+		fullPath = self.__stagingDir + '/' + path
+
+		try:
+			os.makedirs(os.path.dirname(fullPath), exist_ok = True)
+			with open(fullPath, 'wb') as outputFile:
+				outputFile.write(data)
+
+		except:
+			raise OutputException('Failed to write ' + path + '.')
+
+		if 'mimetype' != path:
+			self.__paths[path] = True
+
+	##########################################################################
+
+	# Copies an existing file on disk into the staging directory.
+	def copy(self, path, sourcePath):
+
+		fullPath = self.__stagingDir + '/' + path
+
+		os.makedirs(os.path.dirname(fullPath), exist_ok = True)
+		shutil.copyfile(sourcePath, fullPath)
+		self.__paths[path] = True
+
+	##########################################################################
+
+	# Zips up the staging directory per the ePub specifications. Files are
+	# added in the order they were written, so that the archive doesn't depend
+	# on the order the filesystem lists them in and is laid out the same way
+	# as one streamed by ZipContainer.
+	def close(self):
+
+		zipContainer = ZipContainer(self.__filename, os.path.basename(self.__stagingDir),
+			compressLevel = self.__compressLevel, threads = self.__threads,
+			deterministic = self.__deterministic)
+
+		try:
+
+			for path in self.__paths:
+				zipContainer.copy(path, self.__stagingDir + '/' + path)
+
+			zipContainer.close()
+			self.unchanged = zipContainer.unchanged
+
+		except:
+			zipContainer.cleanup()
+			raise OutputException('Failed to write output file ' + self.__filename)
+
+	##########################################################################
+
+	# Removes the staging directory.
+	def cleanup(self):
+
+		try:
+			shutil.rmtree(self.__stagingDir)
+
+		# If this is on the backend of a server, I don't want people to get
+		# error messages about it. But /tmp should be monitored to make sure
+		# it's not filling up because this is silently failing.
+		except:
+			pass
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+
+import io, hashlib, functools, subprocess
+
+from exception import OutputException
+
+# Pillow isn't a hard requirement, since it's only needed for covers. Without
+# it, covers are generated with ImageMagick instead, which is much slower
+# because it has to be started in a separate process for every cover, and
+# covers supplied by the user are copied into the book without being resized
+# or recompressed.
+try:
+	from PIL import Image, ImageOps, ImageDraw, ImageFont
+	pillowAvailable = True
+
+except ImportError:
+	pillowAvailable = False
+
+# Generated covers are white text on a black background, with the title
+# centered in the top half of the cover and the author centered in the bottom
+# half. Sizes are in pixels.
+TITLE_FONT_SIZE = 110
+AUTHOR_FONT_SIZE = 60
+
+# Fonts to try, in order of preference, when rendering covers with Pillow.
+# Pillow looks for these in the system's font directories. If none of them
+# can be found, Pillow's built-in font is used.
+fontNames = ('DejaVuSans.ttf', 'LiberationSans-Regular.ttf', 'Arial.ttf', 'Helvetica.ttc')
+
+# The image formats a cover can be stored in without being converted (the
+# raster formats among EPUB's core media types), recognized by the first few
+# bytes of the file rather than by its extension, along with the extension and
+# media type the cover is given in the book.
+imageSignatures = (
+	(b'\xff\xd8\xff', 'JPEG'),
+	(b'\x89PNG\r\n\x1a\n', 'PNG'),
+	(b'GIF87a', 'GIF'),
+	(b'GIF89a', 'GIF')
+)
+
+imageFormats = {
+	'JPEG': ('jpg', 'image/jpeg'),
+	'PNG': ('png', 'image/png'),
+	'GIF': ('gif', 'image/gif')
+}
+
+# Image modes e-readers can be counted on to display. Covers in any other
+# mode, like CMYK JPEGs, which many e-readers show with inverted or garbled
+# colors, are always converted to RGB, even if they're small enough to be used
+# as-is.
+displayableModes = frozenset(['1', 'L', 'LA', 'P', 'PA', 'RGB', 'RGBA'])
+
+# Quality that covers are encoded with, and the lowest quality they'll be
+# encoded with to fit within the size limit before they're scaled down further
+# instead.
+JPEG_QUALITY = 90
+MIN_JPEG_QUALITY = 60
+
+# Covers that have already been processed by processCover(), keyed by a hash
+# of the original image and the limits it was processed with. Only the most
+# recently processed covers are kept.
+_processedCovers = {}
+processedCoversCacheSize = 16
+
+##############################################################################
+
+# Returns a cover for the given title and author as a JPEG of the given size.
+# Covers are cached, so that building many books by the same author (or
+# several editions of the same book, like ARCs) in one process only has to
+# render each cover once.
+@functools.lru_cache(maxsize = 16)
+def generateCover(title, author, width, height):
+
+	if pillowAvailable:
+		return _renderWithPillow(title, author, width, height)
+	else:
+		return _renderWithImageMagick(title, author, width, height)
+
+##############################################################################
+
+# Returns the font used to render text of the given size with Pillow.
+@functools.lru_cache(maxsize = None)
+def _loadFont(size):
+
+	for fontName in fontNames:
+
+		try:
+			return ImageFont.truetype(fontName, size)
+		except OSError:
+			pass
+
+	# Older versions of Pillow only have a single, fixed size built-in font
+	try:
+		return ImageFont.load_default(size)
+	except TypeError:
+		return ImageFont.load_default()
+
+##############################################################################
+
+# Breaks text into lines that fit within the given width. Words that are too
+# long to fit on a line by themselves are left on a line of their own.
+def _wrapText(draw, text, font, width):
+
+	lines = []
+
+	for word in text.split():
+
+		if lines and draw.textlength(lines[-1] + ' ' + word, font = font) <= width:
+			lines[-1] += ' ' + word
+		else:
+			lines.append(word)
+
+	return '\n'.join(lines)
+
+##############################################################################
+
+# Renders the cover in-process with Pillow.
+def _renderWithPillow(title, author, width, height):
+
+	image = Image.new('RGB', (width, height), 'black')
+	draw = ImageDraw.Draw(image)
+
+	# Leave a margin on either side of the text
+	textWidth = width * 0.9
+
+	for text, fontSize, center in (
+		(title, TITLE_FONT_SIZE, height / 4),
+		(author, AUTHOR_FONT_SIZE, height * 3 / 4)
+	):
+		font = _loadFont(fontSize)
+		draw.multiline_text(
+			(width / 2, center), _wrapText(draw, text, font, textWidth),
+			fill = 'white', font = font, anchor = 'mm', align = 'center'
+		)
+
+	cover = io.BytesIO()
+	image.save(cover, 'JPEG', quality = 90)
+
+	return cover.getvalue()
+
+##############################################################################
+
+# Escapes text so that ImageMagick's label: prints it as-is instead of
+# interpreting escape sequences, percent escapes or (if the text starts with
+# @) reading the label from a file.
+def _escapeLabel(text):
+
+	text = text.replace('\\', '\\\\').replace('%', '%%')
+
+	return '\\' + text if text.startswith('@') else text
+
+##############################################################################
+
+# Renders the cover by running ImageMagick, which writes it to stdout. The
+# arguments are passed straight to the process instead of through a shell, so
+# titles and authors can contain quotes or anything else.
+def _renderWithImageMagick(title, author, width, height):
+
+	try:
+
+		return subprocess.run([
+			'convert', '-background', 'black', '-size', str(width) + 'x' + str(height // 2),
+			'-fill', '#ffffff', '-gravity', 'center',
+			'-pointsize', str(TITLE_FONT_SIZE), 'label:' + _escapeLabel(title),
+			'-pointsize', str(AUTHOR_FONT_SIZE), 'label:' + _escapeLabel(author),
+			'-append', 'jpg:-'
+		], stdout = subprocess.PIPE, stderr = subprocess.DEVNULL, check = True).stdout
+
+	except FileNotFoundError:
+		raise OutputException('Pillow or Imagemagick must be installed before you can generate a cover.')
+
+	except subprocess.CalledProcessError:
+		raise OutputException('Imagemagick failed to generate a cover.')
+
+##############################################################################
+
+# Returns the format of an image (one of the keys of imageFormats), or None if
+# it isn't in one of those formats.
+def sniffFormat(data):
+
+	for signature, imageFormat in imageSignatures:
+		if data.startswith(signature):
+			return imageFormat
+
+	return None
+
+##############################################################################
+
+# Prepares the image at the given path for use as a cover. Returns the cover
+# and its format (one of the keys of imageFormats.) Covers are scaled down so
+# that neither dimension exceeds maxDimension pixels, since larger images can
+# crash older e-readers, and are recompressed as progressive JPEGs until
+# they're no larger than maxBytes. Covers that are already JPEG, PNG or GIF
+# images within those limits are used as-is, unless they're in a color mode
+# that e-readers can't display (see displayableModes.)
+def processCover(path, maxDimension, maxBytes):
+
+	with open(path, 'rb') as coverFile:
+		data = coverFile.read()
+
+	key = (hashlib.sha256(data).digest(), maxDimension, maxBytes)
+
+	if key not in _processedCovers:
+
+		if len(_processedCovers) >= processedCoversCacheSize:
+			del _processedCovers[next(iter(_processedCovers))]
+
+		_processedCovers[key] = _processCoverData(data, maxDimension, maxBytes)
+
+	return _processedCovers[key]
+
+##############################################################################
+
+# Does the work for processCover().
+def _processCoverData(data, maxDimension, maxBytes):
+
+	imageFormat = sniffFormat(data)
+
+	if not pillowAvailable:
+
+		if not imageFormat:
+			raise OutputException('Cover must be a JPEG, PNG or GIF image (install Pillow to convert other formats.)')
+
+		return data, imageFormat
+
+	try:
+		image = Image.open(io.BytesIO(data))
+
+	except (OSError, Image.DecompressionBombError):
+		raise OutputException('Cover is not a valid image.')
+
+	if (
+		imageFormat and image.mode in displayableModes and
+		max(image.size) <= maxDimension and len(data) <= maxBytes
+	):
+		return data, imageFormat
+
+	return _encodeJPEG(image, maxDimension, maxBytes), 'JPEG'
+
+##############################################################################
+
+# Encodes an image as a progressive JPEG that fits within the given limits,
+# lowering the quality and then the size of the image until it does.
+def _encodeJPEG(image, maxDimension, maxBytes):
+
+	# JPEGs can be decoded at a fraction of their full size, which is much
+	# faster than decoding the whole thing only to scale it down afterwards
+	image.draft('RGB', (maxDimension, maxDimension))
+	image = ImageOps.exif_transpose(image)
+
+	# JPEGs can't be transparent, so transparent areas are made white
+	if 'transparency' in image.info or image.mode in ('RGBA', 'LA', 'PA'):
+		image = image.convert('RGBA')
+		background = Image.new('RGB', image.size, 'white')
+		background.paste(image, mask = image.getchannel('A'))
+		image = background
+
+	elif 'RGB' != image.mode:
+		image = image.convert('RGB')
+
+	image.thumbnail((maxDimension, maxDimension), Image.LANCZOS)
+	quality = JPEG_QUALITY
+
+	while True:
+
+		cover = io.BytesIO()
+		image.save(cover, 'JPEG', quality = quality, progressive = True, optimize = True)
+
+		if cover.tell() <= maxBytes:
+			return cover.getvalue()
+
+		if quality > MIN_JPEG_QUALITY:
+			quality -= 10
+
+		elif min(image.size) > 16:
+			image = image.resize((image.width * 3 // 4, image.height * 3 // 4), Image.LANCZOS)
+
+		else:
+			raise OutputException('Could not compress cover to ' + str(maxBytes) + ' bytes.')
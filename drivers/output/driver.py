@@ -3,6 +3,7 @@
 import re, os
 from abc import ABCMeta, abstractmethod
 from exception import OutputException
+from ..domnode import EbookNode
 
 # Output driver base class
 class Driver:
@@ -56,6 +57,17 @@ class Driver:
 
 	##########################################################################
 
+	# Loads anything the driver needs that can be shared between books, such
+	# as templates, so that converting several books in the same process only
+	# has to do it once. Drivers with nothing to share don't need to override
+	# this.
+	@classmethod
+	def warmup(cls):
+
+		pass
+
+	##########################################################################
+
 	# Transforms the input DOM-like structure into an e-book format and writes
 	# the result to disk.
 	@abstractmethod
@@ -65,6 +77,31 @@ class Driver:
 
 	##########################################################################
 
+	# Transforms a book from the (depth, node) events yielded by an input
+	# driver's stream() method (see drivers/input/driver.py) and writes the
+	# result to disk. By default, this just puts the whole DOM back together
+	# and calls transform(). Drivers that can write out one chapter at a time
+	# should override it, so that each chapter can be released as soon as it's
+	# been written.
+	def transformStream(self, events, filename):
+
+		DOMRoot = EbookNode('ebook')
+		curNode = DOMRoot
+
+		for depth, node in events:
+
+			if 0 == depth:
+				curNode = DOMRoot
+
+			curNode.appendChild(node)
+
+			if 'part' == node.nodeType:
+				curNode = node
+
+		self.transform(DOMRoot, filename)
+
+	##########################################################################
+
 	# Cleans up after conversion is complete. If there's no cleanup to do for a
 	# particular driver, just implement an empty function.
 	@abstractmethod
@@ -4,14 +4,46 @@
 GENERATED_COVER_WIDTH=1000
 GENERATED_COVER_HEIGHT=1600
 
-import shutil, re, os, binascii
+# Default limits for covers supplied by the user. Larger covers are scaled
+# down and recompressed (see drivers/output/cover.py.)
+COVER_MAX_DIMENSION=1000
+COVER_MAX_SIZE=1024 * 1024
+
+import re, os, hashlib, binascii, collections, multiprocessing, concurrent.futures
 
-import util
 from .driver import Driver
+from .container import ZipContainer, DirectoryContainer, compressionLevel
+from .template import Template
+from .writer import TextWriter
+from .toc import TableOfContents
+from . import cover
 from exception import OutputException
 
+import instrumentation
+
 scriptPath = os.path.dirname(os.path.realpath(__file__))
 
+# The driver and sections being rendered by a chapter rendering worker process
+# (see Epub.__transformSections.)
+_renderState = None
+
+# Initializes a chapter rendering worker process.
+def _initRenderWorker(driver, sectionNodes):
+
+	global _renderState
+	_renderState = (driver, sectionNodes)
+
+# Renders the part or chapter at the given index inside of a worker process.
+def _renderSectionInWorker(index):
+
+	driver, sectionNodes = _renderState
+	return driver._renderSection(sectionNodes[index])
+
+# Renders a part or chapter that was sent to a worker process.
+def _renderNodeInWorker(sectionNode):
+
+	return _renderState[0]._renderSection(sectionNode)
+
 class Epub(Driver):
 
 	# Table of special characters that should be converted to their corresponding
@@ -29,9 +61,82 @@ class Epub(Driver):
 		"®": "&#174;"   #reg
 	}
 
+	# Everything that gets escaped in text from the manuscript: the special
+	# characters above, plus the ones that would otherwise make the output
+	# invalid XHTML. They're all matched by a single regex so that each run of
+	# text is only scanned once. (str.translate() would also do it in one
+	# pass, but it turns out to be several times slower than even calling
+	# str.replace() once per character, which doesn't copy anything when the
+	# character isn't found.)
+	escapedChars = {**specialChars, '&': '&amp;', '<': '&lt;', '>': '&gt;'}
+	escapedCharsRegex = re.compile('[' + ''.join(escapedChars.keys()) + ']')
+
+	# Template variables can end up inside double-quoted attributes (like the
+	# cover's alt text), so they also need double quotes escaped.
+	escapedAttributeChars = {**escapedChars, '"': '&quot;'}
+	escapedAttributeCharsRegex = re.compile('[' + ''.join(escapedAttributeChars.keys()) + ']')
+
+	# How each type of formatting in a paragraph is rendered
+	elementTypes = {
+		'bold': {'prefix': '<strong>', 'postfix': '</strong>'},
+		'italic': {'prefix': '<em>', 'postfix': '</em>'},
+		'underline': {'prefix': '<span style="font-decoration: underline;">', 'postfix': '</span>'},
+		'strikethrough': {'prefix': '<span style="font-decoration: line-through;">', 'postfix': '</span>'}
+	}
+
+	# Media types of the images that can appear in a book, by extension
+	imageMediaTypes = {extension: mediaType for extension, mediaType in cover.imageFormats.values()}
+
 	# A regex that defines valid characters for a chapter or part ID
 	invalidIdCharsRegex = re.compile('[^a-zA-Z0-9]')
 
+	# Templates that get filled in and written to OEBPS/
+	templateNames = ['style.css', 'book.opf', 'Cover.xhtml', 'toc.ncx', 'title.xhtml', 'toc.xhtml', 'copyright.xhtml']
+
+	# Every placeholder that can appear in a template (see
+	# self.__initTemplateVars and self.__initChaptersTemplateVars)
+	templateVarNames = [
+		'%uid', '%title', '%upperTitle', '%author', '%autLastfirst',
+		'%publisher', '%lang', '%pubdate', '%copyrightYear',
+		'%coverImageFilename', '%coverImageManifestEntry', '%copyrightPageManifestEntry',
+		'%copyrightSpineEntry', '%copyrightTocEntry',
+		'%fictionCopyrightAddition', '%chapterManifestEntries',
+		'%chapterSpineEntries', '%chapterTocEntries', '%navmap',
+		'%firstChapterFilename', '%imageManifestEntries'
+	]
+
+	# Templates are read from disk and compiled once per process and then
+	# shared by every book converted in that process.
+	__templates = {}
+
+	##########################################################################
+
+	# Reads and compiles every template ahead of time.
+	@classmethod
+	def warmup(cls):
+
+		for templateName in ['container.xml'] + Epub.templateNames:
+			Epub.__getTemplate(templateName)
+
+	##########################################################################
+
+	# Returns a compiled template, reading it from disk the first time it's
+	# requested.
+	@staticmethod
+	def __getTemplate(templateName):
+
+		if templateName not in Epub.__templates:
+
+			try:
+				templateText = open(__file__[:-3] + '/templates/' + templateName, 'r').read()
+
+			except:
+				raise OutputException('Failed to read ' + templateName + ' template.')
+
+			Epub.__templates[templateName] = Template(templateText, Epub.templateVarNames)
+
+		return Epub.__templates[templateName]
+
 	##########################################################################
 
 	# Template variables used to fill in various data fields in the ePub's files.
@@ -43,18 +148,25 @@ class Epub(Driver):
 		titleSlug = invalidAlphaNumRegex.sub('', self._bookTitle.lower())
 
 		# Variables to implement after processing chapters (in self.initChaptersTemplateVars):
-		# %firstChapterFilename, %chapterManifestEntries, %chapterSpineEntries, %chapterTocEntries, %navmap
+		# %firstChapterFilename, %chapterManifestEntries, %chapterSpineEntries, %chapterTocEntries, %navmap,
+		# %imageManifestEntries
+		# Variables that depend on the cover's format (in self.__addCover):
+		# %coverImageFilename, %coverImageManifestEntry
+		self.__uidPrefix = 'epub.' + titleSlug + '.' + authorSlug + '.'
+
+		# Everything the user supplied ends up in XML, sometimes inside
+		# attributes, so it has to be escaped like text from the manuscript
+		# and then some
 		self.__templateVars = {
-			'%uid': 'epub.' + titleSlug + '.' + authorSlug + '.' + self.__uid,
-			'%title': self._bookTitle,
-			'%upperTitle': self._bookTitle.upper(),
-			'%author': self._bookAuthor,
-			'%autLastfirst': self._bookAuthor, #TODO: split on first whitespace and add comma
-			'%publisher': self._bookPublisher,
-			'%lang': self._bookLang,
-			'%pubdate': self._pubDate,
-			'%copyrightYear': self._copyrightYear,
-			'%coverImageManifestEntry': '<item id="cover-image" href="Cover.jpg" media-type="image/jpeg" properties="cover-image" />'
+			'%uid': self.__uidPrefix + self.__uid,
+			'%title': self._escapeAttribute(self._bookTitle),
+			'%upperTitle': self._escapeAttribute(self._bookTitle.upper()),
+			'%author': self._escapeAttribute(self._bookAuthor),
+			'%autLastfirst': self._escapeAttribute(self._bookAuthor), #TODO: split on first whitespace and add comma
+			'%publisher': self._escapeAttribute(self._bookPublisher),
+			'%lang': self._escapeAttribute(self._bookLang),
+			'%pubdate': self._escapeAttribute(self._pubDate),
+			'%copyrightYear': self._escapeAttribute(self._copyrightYear)
 		}
 
 		# We may or may not want to include a separate automagically generated copyright page.
@@ -77,57 +189,58 @@ class Epub(Driver):
 
 	##########################################################################
 
-	# Helper function that populates the template variable for the list of
-	# chapters in the OPF and toc.ncx.
-	def __insertChaptersIntoOPFAndTocNcx(self, playOrder, navmap, chapterList = None, tocTabs = '\t\t\t\t\t'):
-
-		# Always start at the root
-		if not chapterList:
-			chapterList = self.__chapterLog
-
-		chapterManifestEntries = ''
-		chapterSpineEntries = ''
-		chapterTocEntries = ''
-
-		for chapter in chapterList:
-
-			chapterId = 'ch' + chapter['chapterSlug'] + str(chapter['chapterIndex']).zfill(3)
-			chapterFilename = str(chapter['chapterIndex']).zfill(3) + '_' + chapter['chapterSlug'] + '.xhtml'
-			chapterManifestEntries = chapterManifestEntries + '\t\t<item id="' + chapterId + '" media-type="application/xhtml+xml" href="' + chapterFilename + '" />\n'
-			chapterSpineEntries = chapterSpineEntries + '\t\t<itemref idref="' + chapterId + '" linear="yes" />\n'
-
-			chapterTocEntries = chapterTocEntries + tocTabs + '<li>\n'
-			chapterTocEntries = chapterTocEntries + tocTabs + '\t<a href="' + chapterFilename + '">' + chapter['chapter'] + '</a>\n'
-
-			# If we're inside of a part and need to process the chapters that
-			# are inside, do so now.
-			if chapter['children']:
-				subChapterResults = self.__insertChaptersIntoOPFAndTocNcx(playOrder, navmap, chapter['children'], tocTabs + '\t\t')
-				playOrder = subChapterResults['playOrder']
-				navmap = subChapterResults['navmap']
-				chapterManifestEntries = chapterManifestEntries + subChapterResults['chapterManifestEntries']
-				chapterSpineEntries = chapterSpineEntries + subChapterResults['chapterSpineEntries']
-				chapterTocEntries = chapterTocEntries + tocTabs + '\t<ol style="list-style-type: none;">\n' + subChapterResults['chapterTocEntries'] + tocTabs + '\t</ol>\n'
-
-			chapterTocEntries = chapterTocEntries + tocTabs + '</li>\n'
-
-			navmap = (
-				navmap + '\n\t\t<navPoint id="ch' + chapter['chapterSlug'] +
-				str(chapter['chapterIndex']).zfill(3) +
-				'" playOrder="' + str(playOrder) + '">\n' +
-				'\t\t\t<navLabel>\n\t\t\t\t<text>\n\t\t\t\t\t' + chapter['chapter'] + '\n\t\t\t\t</text>\n' +
-				'\t\t\t</navLabel>\n\t\t\t<content src="' + chapterFilename + '" />\n\t\t</navPoint>\n'
-			)
+	# Writes each part's and chapter's entries in the OPF's manifest and
+	# spine, the table of contents and toc.ncx's navmap into the TextWriters
+	# for the corresponding template variables, with one pass over the table
+	# of contents for each. Parts are listed in the navmap after the chapters
+	# they contain.
+	def __writeTocEntries(self, entries, playOrder, tocTabs = '\t\t\t\t\t'):
 
-			playOrder += 1
+		toc = self.__toc
+		manifestWrite = entries['%chapterManifestEntries'].write
+		spineWrite = entries['%chapterSpineEntries'].write
+		tocWrite = entries['%chapterTocEntries'].write
+		navmapWrite = entries['%navmap'].write
 
-		return {
-			'chapterManifestEntries': chapterManifestEntries,
-			'chapterSpineEntries': chapterSpineEntries,
-			'chapterTocEntries': chapterTocEntries,
-			'navmap': navmap,
-			'playOrder': playOrder
-		}
+		chapterIds = ['ch' + slug + str(index).zfill(3) for slug, index in zip(toc.slugs, toc.indices)]
+
+		for chapterId, chapterFilename in zip(chapterIds, toc.filenames):
+			manifestWrite('\t\t<item id="' + chapterId + '" media-type="application/xhtml+xml" href="' + chapterFilename + '" />\n')
+
+		for chapterId in chapterIds:
+			spineWrite('\t\t<itemref idref="' + chapterId + '" linear="yes" />\n')
+
+		# Entries that contain other entries get a nested list, which is
+		# closed after the last entry inside of it.
+		for position, hasChildren, closed in toc.walk():
+
+			tabs = tocTabs + '\t\t' * toc.depths[position]
+
+			tocWrite(tabs + '<li>\n')
+			tocWrite(tabs + '\t<a href="' + toc.filenames[position] + '">' + toc.titles[position] + '</a>\n')
+
+			if hasChildren:
+				tocWrite(tabs + '\t<ol style="list-style-type: none;">\n')
+			else:
+				tocWrite(tabs + '</li>\n')
+
+			for ancestor in closed:
+				tabs = tocTabs + '\t\t' * toc.depths[ancestor]
+				tocWrite(tabs + '\t</ol>\n')
+				tocWrite(tabs + '</li>\n')
+
+		for position, hasChildren, closed in toc.walk():
+
+			for navPosition in ([] if hasChildren else [position]) + list(closed):
+
+				navmapWrite(
+					'\n\t\t<navPoint id="' + chapterIds[navPosition] +
+					'" playOrder="' + str(playOrder) + '">\n' +
+					'\t\t\t<navLabel>\n\t\t\t\t<text>\n\t\t\t\t\t' + toc.titles[navPosition] + '\n\t\t\t\t</text>\n' +
+					'\t\t\t</navLabel>\n\t\t\t<content src="' + toc.filenames[navPosition] + '" />\n\t\t</navPoint>\n'
+				)
+
+				playOrder += 1
 
 	##########################################################################
 
@@ -136,12 +249,19 @@ class Epub(Driver):
 	# in the constructor like we can in the other.
 	def __initChaptersTemplateVars(self):
 
-		navmap = ''
+		entries = {
+			'%chapterManifestEntries': TextWriter(),
+			'%chapterSpineEntries': TextWriter(),
+			'%chapterTocEntries': TextWriter(),
+			'%navmap': TextWriter()
+		}
+
+		navmap = entries['%navmap']
 		playOrder = 2;
 
 		if self._includeCopyright:
-			navmap = (
-				navmap + '\n\t\t<navPoint id="copyright" playOrder="' +
+			navmap.write(
+				'\n\t\t<navPoint id="copyright" playOrder="' +
 				str(playOrder) + '">\n' + '\t\t\t<navLabel>\n\t\t\t\t<text>\n' +
 				'\t\t\t\t\tCopyright Notice\n\t\t\t\t</text>\n' +
 				'\t\t\t</navLabel>\n\t\t\t<content src="copyright.xhtml" />\n' +
@@ -149,49 +269,46 @@ class Epub(Driver):
 			)
 			playOrder += 1
 
-		navmap = (
-			navmap + '\n\t\t<navPoint id="toc" playOrder="' + str(playOrder) + '">\n' +
+		navmap.write(
+			'\n\t\t<navPoint id="toc" playOrder="' + str(playOrder) + '">\n' +
 			'\t\t\t<navLabel>\n\t\t\t\t<text>\n\t\t\t\t\tTable of Contents\n\t\t\t\t</text>\n' +
 			'\t\t\t</navLabel>\n\t\t\t<content src="toc.xhtml" />\n\t\t</navPoint>\n'
 		)
 		playOrder += 1
 
 		# Insert chapters into the OPF and toc.ncx chapter list variables.
-		chapterEntries = self.__insertChaptersIntoOPFAndTocNcx(playOrder, navmap)
+		self.__writeTocEntries(entries, playOrder)
 
-		self.__templateVars['%chapterManifestEntries'] = chapterEntries['chapterManifestEntries']
-		self.__templateVars['%chapterSpineEntries'] = chapterEntries['chapterSpineEntries']
-		self.__templateVars['%chapterTocEntries'] = chapterEntries['chapterTocEntries']
-		self.__templateVars['%navmap'] = chapterEntries['navmap']
-		self.__templateVars['%firstChapterFilename'] = str(self.__chapterLog[0]['chapterIndex']).zfill(3) + '_' + self.__chapterLog[0]['chapterSlug'] + '.xhtml'
+		for templateVar, writer in entries.items():
+			self.__templateVars[templateVar] = writer.getvalue()
 
-	##########################################################################
+		self.__templateVars['%imageManifestEntries'] = ''.join(self.__images.values())
 
-	# Takes as input a template and spits out a fully reconstituted file using
-	# the variables defined by self.__initTemplateVars.
-	def __hydrate(self, template):
+		self.__templateVars['%firstChapterFilename'] = self.__toc.filenames[0]
 
-		for var in self.__templateVars.keys():
-			template = template.replace(var, self.__templateVars[var])
+	##########################################################################
+
+	# Takes as input the name of a template and spits out a fully reconstituted
+	# file using the variables defined by self.__initTemplateVars.
+	def __hydrate(self, templateName):
 
-		return template
+		with instrumentation.stage('hydrateTemplate', template = templateName):
+			return Epub.__getTemplate(templateName).render(self.__templateVars)
 
 	##########################################################################
 
-	# Creates a specially formatted ZIP file of the book's contents, per the
-	# ePub specifications.
-	def __zipBook(self, filename):
+	# Escapes text from the manuscript for inclusion in XHTML.
+	def _escape(self, text):
 
-		try:
+		return self.escapedCharsRegex.sub(lambda match: self.escapedChars[match.group()], text)
 
-			if os.path.isfile(filename):
-				os.remove(filename)
+	##########################################################################
 
-			util.zipdirs(self.__tmpOutputDir + '/mimetype', filename, self.__tmpOutputDir, False)
-			util.zipdirs([self.__tmpOutputDir + '/META-INF', self.__tmpOutputDir + '/OEBPS'], filename, self.__tmpOutputDir)
+	# Escapes text for inclusion in XHTML or XML, either as content or as the
+	# value of a double-quoted attribute.
+	def _escapeAttribute(self, text):
 
-		except:
-			raise OutputException('Failed to write output file ' + filename)
+		return self.escapedAttributeCharsRegex.sub(lambda match: self.escapedAttributeChars[match.group()], text)
 
 	##########################################################################
 
@@ -205,7 +322,7 @@ class Epub(Driver):
 
 		XHTMLHead += '\t<head>\n'
 		XHTMLHead += '\t\t<meta charset="utf-8" />\n'
-		XHTMLHead += '\t\t<title>' + self._bookTitle + '</title>\n'
+		XHTMLHead += '\t\t<title>' + self._escape(self._bookTitle) + '</title>\n'
 		XHTMLHead += '\t\t<link rel="stylesheet" href="style.css" type="text/css" />\n'
 		XHTMLHead += '\t</head>\n\n'
 
@@ -215,9 +332,9 @@ class Epub(Driver):
 
 		XHTMLHead += '\t\t\t<header>\n'
 		if centerHeading:
-			XHTMLHead += '\t\t\t\t<h1 style="text-align: center; margin-top: 20%;">' + chapterHeading + '</h1>\n'
+			XHTMLHead += '\t\t\t\t<h1 style="text-align: center; margin-top: 20%;">' + self._escape(chapterHeading) + '</h1>\n'
 		else:
-			XHTMLHead += '\t\t\t\t<h1>' + chapterHeading + '</h1>\n'
+			XHTMLHead += '\t\t\t\t<h1>' + self._escape(chapterHeading) + '</h1>\n'
 		XHTMLHead += '\t\t\t</header>\n\n'
 
 		return XHTMLHead
@@ -235,17 +352,11 @@ class Epub(Driver):
 
 	##########################################################################
 
-	# Utility function to recursively parse an RTFDOM paragraph node into XHTML.
-	def __parseRTFDOMParagraph(self, paragraphNode, depth = 0):
-
-		elementTypes = {
-			'bold': {'prefix': '<strong>', 'postfix': '</strong>'},
-			'italic': {'prefix': '<em>', 'postfix': '</em>'},
-			'underline': {'prefix': '<span style="font-decoration: underline;">', 'postfix': '</span>'},
-			'strikethrough': {'prefix': '<span style="font-decoration: line-through;">', 'postfix': '</span>'}
-		}
+	# Utility function to recursively parse an RTFDOM paragraph node into XHTML,
+	# which is appended to the given TextWriter.
+	def __parseRTFDOMParagraph(self, paragraphNode, writer, depth = 0):
 
-		paragraphText = ''
+		write = writer.write
 
 		for child in paragraphNode.children:
 
@@ -253,238 +364,490 @@ class Epub(Driver):
 			if 'text' == child.nodeType:
 
 				if child.value:
-
-					value = child.value
-
-					# Replace special characters with their escaped equivalents
-					for char in self.specialChars.keys():
-						value = value.replace(char, self.specialChars[char])
-
-					paragraphText += value
+					write(self._escape(child.value))
 
 				# Empty paragraph
 				elif 0 == depth and 1 == len(child.parent.children):
-					paragraphText += '&#160;' # &#160; == &nbsp;
+					write('&#160;') # &#160; == &nbsp;
 
 			else:
 
-				if child.nodeType in elementTypes.keys():
-					paragraphText += elementTypes[child.nodeType]['prefix']
-					paragraphText += self.__parseRTFDOMParagraph(child, depth + 1)
-					paragraphText += elementTypes[child.nodeType]['postfix']
+				if child.nodeType in self.elementTypes:
+					write(self.elementTypes[child.nodeType]['prefix'])
+					self.__parseRTFDOMParagraph(child, writer, depth + 1)
+					write(self.elementTypes[child.nodeType]['postfix'])
 
 				elif 'hyperlink' == child.nodeType:
-					paragraphText += elementTypes['bold']['prefix']
-					paragraphText += self.__parseRTFDOMParagraph(child, depth + 1)
-					paragraphText += elementTypes['bold']['postfix']
+					write(self.elementTypes['bold']['prefix'])
+					self.__parseRTFDOMParagraph(child, writer, depth + 1)
+					write(self.elementTypes['bold']['postfix'])
+
+				# Images are written into the book separately (see
+				# self.__addImages)
+				elif 'image' == child.nodeType:
+					write('<img src="images/' + child.value + '" alt="" />')
 
 				elif 'footnote' == child.nodeType:
-					paragraphText += child.attributes['text']
-					paragraphText += '\\footnote{'
-					paragraphText += self.__parseRTFDOMParagraph(child, depth + 1)
-					paragraphText += '}'
+					write(self._escape(child.attributes['text']))
+					write('\\footnote{')
+					self.__parseRTFDOMParagraph(child, writer, depth + 1)
+					write('}')
 
 				# We allow paragraph nodes inside footnotes
 				elif 'para' == child.nodeType and 'footnote' == child.parent.nodeType:
-					paragraphText += self.__parseRTFDOMParagraph(child, depth + 1)
-					paragraphText += '\n\n'
-
-		return paragraphText
+					self.__parseRTFDOMParagraph(child, writer, depth + 1)
+					write('\n\n')
 
 	##########################################################################
 
-	# Outputs a file for the part in EPUB format.
-	def __transformPart(self, partNode):
+	# Renders the title page of a part as XHTML.
+	def _renderPart(self, partNode):
 
-		chapterFilename = self.__tmpOutputDir + '/OEBPS/' + str(self.__curChapterIndex).zfill(3) + '_' + re.compile('[^a-zA-Z0-9]').sub('', partNode.value) + '.xhtml'
-		outputXHTML  = self._getXHTMLHeader('part', partNode.value, True)
-		outputXHTML += self._getXHTMLFooter()
+		writer = TextWriter()
 
-		open(chapterFilename, 'w').write(outputXHTML)
+		writer.write(self._getXHTMLHeader('part', partNode.value, True))
+		writer.write(self._getXHTMLFooter())
 
-		# Add the part to the table of contents and update self.__curPart so
-		# that new chapters, assuming they're inside this part, will be added to
-		# it instead of to the root of the table of contents.
-		curChapter = {
-			'chapter': partNode.value,
-			'chapterSlug': self.__invalidIdCharsRegex.sub('', partName),
-			'chapterIndex': self.__curChapterIndex,
-			'children': []
-		}
-
-		self.__curChapterIndex = self.__curChapterIndex + 1
-		self.__chapterLog.append(curChapter)
-		self.__curTOCPart = curChapter['children']
+		return writer.getvalue()
 
 	##########################################################################
 
-	# Outputs a chapter in EPUB format.
-	def __transformChapter(self, chapterNode):
+	# Renders a chapter as XHTML. The chapter is returned as a single string
+	# rather than being written straight into the container, since chapters
+	# rendered by worker processes have to be sent back to the parent anyway,
+	# and incremental builds need the whole file to tell whether it changed.
+	def _renderChapter(self, chapterNode):
 
-		# Used for part of the chapter's filename
-		chapterSlug = self.invalidIdCharsRegex.sub('', chapterNode.value)
+		writer = TextWriter()
+		write = writer.write
 
 		# Add a DIV tag with the chapter's ID
 		bodyDivId = 'ch' + self.invalidIdCharsRegex.sub('', chapterNode.value)
 
-		outputXHTML = self._getXHTMLHeader('chapter', chapterNode.value)
-		outputXHTML += '\t\t\t<div id="' + bodyDivId + '">\n\n'
+		write(self._getXHTMLHeader('chapter', chapterNode.value))
+		write('\t\t\t<div id="' + bodyDivId + '">\n\n')
 
 		firstParagraph = True
 		for paragraph in chapterNode.children:
 			if firstParagraph:
-				openParagraph = '<p style="text-indent: 0;">'
+				write('\t\t\t\t<p style="text-indent: 0;">')
 			else:
-				openParagraph = '<p>'
-			outputXHTML += '\t\t\t\t' + openParagraph + self.__parseRTFDOMParagraph(paragraph) + '</p>\n'
+				write('\t\t\t\t<p>')
+			self.__parseRTFDOMParagraph(paragraph, writer)
+			write('</p>\n')
 			firstParagraph = False
 
-		outputXHTML += '\n\t\t\t</div>\n\n'
-		outputXHTML += self._getXHTMLFooter()
+		write('\n\t\t\t</div>\n\n')
+		write(self._getXHTMLFooter())
+
+		return writer.getvalue()
+
+	##########################################################################
+
+	# Renders either a part or a chapter, depending on the node's type. This
+	# doesn't touch any state other than the node itself, so it's safe to call
+	# from a worker process.
+	def _renderSection(self, sectionNode):
+
+		with instrumentation.stage('renderSection', title = sectionNode.value):
+
+			if 'part' == sectionNode.nodeType:
+				return self._renderPart(sectionNode)
+			else:
+				return self._renderChapter(sectionNode)
+
+	##########################################################################
+
+	# Adds the part to the table of contents and returns the filename it
+	# should be written to. Parts are always at the root of the table of
+	# contents.
+	def __logPart(self, partNode):
+
+		chapterSlug = self.invalidIdCharsRegex.sub('', partNode.value)
+		return 'OEBPS/' + self.__toc.add(0, self._escape(partNode.value), chapterSlug)
 
-		chapterFilename = self.__tmpOutputDir + '/OEBPS/' + str(self.__curChapterIndex).zfill(3) + '_' + chapterSlug + '.xhtml'
-		open(chapterFilename, 'w').write(outputXHTML)
+	##########################################################################
+
+	# Adds the chapter to the table of contents at the given depth (0 for the
+	# root or 1 if it's inside of a part) and returns the filename it should
+	# be written to.
+	def __logChapter(self, chapterNode, depth):
 
-		self.__curTOCPart.append({
-			'chapter': chapterNode.value,
-			'chapterSlug': chapterSlug,
-			'chapterIndex': self.__curChapterIndex,
-			'children': None
-		})
+		self.__addImages(chapterNode)
 
-		self.__curChapterIndex = self.__curChapterIndex + 1
+		# Used for part of the chapter's filename
+		chapterSlug = self.invalidIdCharsRegex.sub('', chapterNode.value)
+		return 'OEBPS/' + self.__toc.add(depth, self._escape(chapterNode.value), chapterSlug)
+
+	##########################################################################
+
+	# Writes every image in the chapter that isn't already in the book into
+	# OEBPS/images/ and adds it to the manifest. Images are named after a
+	# hash of their contents by the input driver, so an image that appears
+	# more than once, even in different chapters, is only stored once. This
+	# happens as each chapter is added to the table of contents, rather than
+	# when it's rendered, since chapters can be rendered in worker processes.
+	def __addImages(self, chapterNode):
+
+		nodes = [chapterNode]
+
+		while nodes:
+
+			node = nodes.pop()
+
+			if 'image' == node.nodeType and node.value not in self.__images:
+
+				extension = os.path.splitext(node.value)[1][1:]
+
+				if extension not in self.imageMediaTypes:
+					raise OutputException('Image ' + node.value + ' is not in a supported format.')
+
+				try:
+					with open(node.attributes['path'], 'rb') as imageFile:
+						imageData = imageFile.read()
+
+				except OSError:
+					raise OutputException('Could not read image ' + node.value + '.')
+
+				self.__writeContent('OEBPS/images/' + node.value, imageData)
+				self.__images[node.value] = (
+					'\t\t<item id="image-' + os.path.splitext(node.value)[0] +
+					'" href="images/' + node.value + '" media-type="' +
+					self.imageMediaTypes[extension] + '" />\n'
+				)
+
+			nodes.extend(reversed(node.children))
+
+	##########################################################################
+
+	# Outputs every part and chapter in the book. The table of contents is
+	# always built in order up front, since that's what ties the chapters
+	# together. The chapters themselves are independent of each other, so if
+	# more than one job was requested, they're rendered in a pool of worker
+	# processes and then written out in their original order.
+	def __transformSections(self, DOMRoot):
+
+		filenames = []
+		sectionNodes = []
+
+		for child in DOMRoot.children:
+
+			if 'part' == child.nodeType:
+
+				filenames.append(self.__logPart(child))
+				sectionNodes.append(child)
+
+				for chapter in child.children:
+					filenames.append(self.__logChapter(chapter, 1))
+					sectionNodes.append(chapter)
+
+			else:
+				filenames.append(self.__logChapter(child, 0))
+				sectionNodes.append(child)
+
+		# Worker processes inherit the DOM instead of having it pickled and
+		# sent to them, which is only possible on platforms that can fork.
+		# Everywhere else, we just render the chapters one at a time.
+		if (
+			self.__jobs > 1 and len(sectionNodes) > 1 and
+			'fork' in multiprocessing.get_all_start_methods()
+		):
+
+			with concurrent.futures.ProcessPoolExecutor(
+				max_workers = self.__jobs,
+				mp_context = multiprocessing.get_context('fork'),
+				initializer = _initRenderWorker,
+				initargs = (self, sectionNodes)
+			) as executor:
+
+				renderedSections = executor.map(
+					_renderSectionInWorker,
+					range(len(sectionNodes)),
+					chunksize = max(1, len(sectionNodes) // (self.__jobs * 4))
+				)
+
+				for chapterFilename, outputXHTML in zip(filenames, renderedSections):
+					self.__writeContent(chapterFilename, outputXHTML)
+
+		else:
+			for chapterFilename, sectionNode in zip(filenames, sectionNodes):
+				self.__writeContent(chapterFilename, self._renderSection(sectionNode))
+
+	##########################################################################
+
+	# Outputs parts and chapters as they're produced by an input driver's
+	# stream(). If more than one job was requested, chapters are sent to a
+	# pool of worker processes as they arrive and written out in order, with
+	# only a few chapters per worker in flight at any given time. Unlike
+	# self.__transformSections, each chapter has to be pickled to get it to a
+	# worker, but chapters coming from a stream aren't attached to the rest of
+	# the book, so that's cheap.
+	def __transformSectionStream(self, events):
+
+		executor = None
+
+		if self.__jobs > 1 and 'fork' in multiprocessing.get_all_start_methods():
+			executor = concurrent.futures.ProcessPoolExecutor(
+				max_workers = self.__jobs,
+				mp_context = multiprocessing.get_context('fork'),
+				initializer = _initRenderWorker,
+				initargs = (self, None)
+			)
+
+		try:
+
+			inProgress = collections.deque()
+
+			for depth, sectionNode in events:
+
+				if 'part' == sectionNode.nodeType:
+					chapterFilename = self.__logPart(sectionNode)
+
+				else:
+					chapterFilename = self.__logChapter(sectionNode, depth)
+
+				if not executor:
+					self.__writeContent(chapterFilename, self._renderSection(sectionNode))
+					continue
+
+				# Parts don't have to be rendered by a worker, but they still
+				# have to be written out in order.
+				if 'part' == sectionNode.nodeType:
+					inProgress.append((chapterFilename, self._renderSection(sectionNode)))
+				else:
+					inProgress.append((chapterFilename, executor.submit(_renderNodeInWorker, sectionNode)))
+
+				while len(inProgress) > self.__jobs * 2:
+					self.__writeRenderedSection(*inProgress.popleft())
+
+			while inProgress:
+				self.__writeRenderedSection(*inProgress.popleft())
+
+		finally:
+			if executor:
+				executor.shutdown(cancel_futures = True)
+
+	##########################################################################
+
+	# Writes a part, chapter or the cover into the book. In deterministic mode,
+	# everything written through here goes into the hash that the book's UID
+	# is derived from.
+	def __writeContent(self, path, data):
+
+		if isinstance(data, str):
+			data = data.encode('utf-8')
+
+		if self.__contentHash:
+			self.__contentHash.update(path.encode('utf-8') + b'\0' + str(len(data)).encode('ascii') + b'\0')
+			self.__contentHash.update(data)
+
+		self.__container.write(path, data)
+
+	##########################################################################
+
+	# Writes out a section rendered by self.__transformSectionStream, waiting
+	# for its worker to finish if necessary.
+	def __writeRenderedSection(self, chapterFilename, rendered):
+
+		if isinstance(rendered, concurrent.futures.Future):
+			rendered = rendered.result()
+
+		self.__writeContent(chapterFilename, rendered)
 
 	##########################################################################
 
 	# Constructor
 	def __init__(self, bookLang, bookPublisher, bookAuthor, bookTitle, pubDate,
-	copyrightYear, includeCopyright, isFiction, coverPath, tmpLocation = '/tmp'):
+	copyrightYear, includeCopyright, isFiction, coverPath, tmpLocation = '/tmp',
+	stageOnDisk = False, jobs = 1, incremental = False,
+	coverMaxDimension = COVER_MAX_DIMENSION, coverMaxSize = COVER_MAX_SIZE,
+	compression = 'default', deterministic = False):
 
 		super().__init__(bookLang, bookPublisher, bookAuthor, bookTitle,
 			pubDate, copyrightYear, includeCopyright, isFiction, coverPath)
 
 		# Generate a unique ID that can be used in /tmp to avoid collisions
 		# during concurrently running instances. The Epub driver will also use
-		# this for the book's UID.
+		# this for the book's UID, unless it's in deterministic mode.
 		self.__uid = str(binascii.hexlify(os.urandom(16))).replace("'", '')[1:]
 		self.__tmpOutputDir = tmpLocation + '/' + self.__uid
 
-		# List of chapters processed. Used to create the manifest.
-		self.__chapterLog = []
-
-		# Points to the root of the table of contents unless adding a part to
-		# the book which will itself contain chapters, and determines where in
-		# the TOC a chapter will be listed.
-		self.__curTOCPart = self.__chapterLog
-
-		# Used to enumerate chapter files
-		self.__curChapterIndex = 1
+		# By default, the book's files are streamed directly into the output
+		# archive. If stageOnDisk is True, they're written out to a directory
+		# in tmpLocation first and then zipped, which is slower but makes it
+		# easier to inspect the book's contents when debugging.
+		self.__stageOnDisk = stageOnDisk
+
+		# Number of worker processes used to render chapters. A value less
+		# than 1 means one worker per CPU core.
+		self.__jobs = jobs if jobs >= 1 else (os.cpu_count() or 1)
+
+		# If True and the output file already exists, anything that hasn't
+		# changed since it was built is copied over from it as-is instead of
+		# being compressed all over again. Only works when the book isn't
+		# staged on disk.
+		self.__incremental = incremental
+
+		# Covers supplied by the user are scaled down to fit within
+		# coverMaxDimension pixels and recompressed to fit within
+		# coverMaxSize bytes.
+		self.__coverMaxDimension = coverMaxDimension
+		self.__coverMaxSize = coverMaxSize
+
+		# How hard to compress the book: a preset name ("fast", "default" or
+		# "max") or a zlib compression level from 0 to 9. Files are compressed
+		# by as many threads as there are chapter rendering jobs.
+		self.__compressLevel = compressionLevel(compression)
+
+		# In deterministic mode, building the same book twice produces the
+		# exact same file: the book's UID is derived from its contents
+		# instead of being random, and every file in the archive gets the
+		# same timestamp and attributes (see drivers/output/container.py.)
+		# If the output file already exists and hasn't changed, it's left
+		# alone, so that anything downstream can tell it doesn't need to
+		# publish it again.
+		self.__deterministic = deterministic
+		self.__contentHash = hashlib.sha256() if deterministic else None
+
+		# Where the book's files are written to (see drivers/output/container.py)
+		self.__container = None
+
+		# Parts and chapters processed, in order (see drivers/output/toc.py.)
+		# Used to create the manifest and table of contents.
+		self.__toc = TableOfContents()
+
+		# Manifest entries for every image written into the book so far, by
+		# filename (see self.__addImages)
+		self.__images = {}
 
 		# Setup epub template variables
 		self.__initTemplateVars()
 
 	##########################################################################
 
-	# Transforms the DOM-like representation of the e-book into the EPUB format.
-	def transform(self, DOMRoot, filename):
+	# Creates the container the book will be written to, along with the files
+	# that don't depend on the book's contents.
+	def __beginBook(self, filename):
+
+		# Creating the container also writes out the book's mimetype
+		if self.__stageOnDisk:
+			self.__container = DirectoryContainer(filename, self.__tmpOutputDir,
+				self.__compressLevel, self.__jobs, self.__deterministic)
+		elif self.__incremental and os.path.isfile(filename):
+			self.__container = ZipContainer(filename, self.__uid, filename,
+				self.__compressLevel, self.__jobs, self.__deterministic)
+		else:
+			self.__container = ZipContainer(filename, self.__uid, None,
+				self.__compressLevel, self.__jobs, self.__deterministic)
 
-		# Create the book's directory structure
-		try:
-			os.mkdir(self.__tmpOutputDir)
-			os.mkdir(self.__tmpOutputDir + '/OEBPS')
-			os.mkdir(self.__tmpOutputDir + '/META-INF')
+		# Write out the book's meta info
+		self.__container.write('META-INF/container.xml', self.__hydrate('container.xml'))
+
+	##########################################################################
 
-		except:
-			raise OutputException('Failed to create temporary output directory.')
+	# Copies the cover into the book, or generates one if requested.
+	def __addCover(self):
 
-		# Write out the book's mimetype and meta info
 		try:
-			mimetypeFile = open(self.__tmpOutputDir + '/mimetype', 'w')
-			mimetypeFile.write('application/epub+zip')
-			mimetypeFile.close()
-			shutil.copyfile(__file__[:-3] + '/templates/container.xml', self.__tmpOutputDir + '/META-INF/container.xml')
 
-		except:
-			raise OutputException('Failed to write mimetype.')
+			# If user specified that they wanted to generate a cover, do so here.
+			# This is useful if, say, you want to create an ARC or you want to
+			# test the e-book, but no cover has been designed yet.
+			if 'generate' == self._coverPath:
+				coverImage = cover.generateCover(self._bookTitle, self._bookAuthor,
+					GENERATED_COVER_WIDTH, GENERATED_COVER_HEIGHT)
+				coverFormat = 'JPEG'
 
-		# Output parts and chapters
-		for child in DOMRoot.children:
+			# The user provided a cover image, so use it, making sure it's in
+			# a format e-readers can display and isn't too big for them.
+			else:
+				coverImage, coverFormat = cover.processCover(self._coverPath,
+					self.__coverMaxDimension, self.__coverMaxSize)
 
-			if 'part' == child.nodeType:
+			extension, mediaType = cover.imageFormats[coverFormat]
+			coverFilename = 'Cover.' + extension
 
-				self.__transformPart(chapterNode)
+			self.__templateVars['%coverImageFilename'] = coverFilename
+			self.__templateVars['%coverImageManifestEntry'] = '<item id="cover-image" href="' + coverFilename + '" media-type="' + mediaType + '" properties="cover-image" />'
 
-				for chapter in chapterNode.children:
-					self.__transformChapter(chapter)
+			self.__writeContent('OEBPS/' + coverFilename, coverImage)
 
-			else:
-				self.__transformChapter(child)
+		except Exception as e:
+
+			raise OutputException('Could not copy or generate cover: ' + str(e))
+
+	##########################################################################
+
+	# Writes out everything that depends on the book's parts and chapters
+	# having already been output, and then finishes the container.
+	def __finishBook(self, filename):
 
 		self.__initChaptersTemplateVars()
 
+		# The cover's filename and format have to be known before the
+		# templates that refer to it can be filled in
+		with instrumentation.stage('cover'):
+			self.__addCover()
+
+		# Now that every part, chapter and the cover have been written, the
+		# UID can be derived from them, along with everything else that goes
+		# into the templates.
+		if self.__deterministic:
+
+			for templateVar, value in sorted(self.__templateVars.items()):
+				if '%uid' != templateVar:
+					self.__contentHash.update(templateVar.encode('utf-8') + b'\0' + value.encode('utf-8') + b'\0')
+
+			self.__templateVars['%uid'] = self.__uidPrefix + self.__contentHash.hexdigest()[:32]
+
 		# Write out filled-in templates
-		templates = ['style.css', 'book.opf', 'Cover.xhtml', 'toc.ncx', 'title.xhtml', 'toc.xhtml']
-		if self._includeCopyright:
-			templates.append('copyright.xhtml')
+		for templateName in self.templateNames:
 
-		for templateName in templates:
+			if 'copyright.xhtml' == templateName and not self._includeCopyright:
+				continue
 
-			try:
+			self.__container.write('OEBPS/' + templateName, self.__hydrate(templateName))
 
-				template = self.__hydrate(open(__file__[:-3] + '/templates/' + templateName, 'r').read())
+		# Finally, write the ePub file. Phew!
+		with instrumentation.stage('zip'):
+			self.__container.close()
 
-				try:
-					open(self.__tmpOutputDir + '/OEBPS/' + templateName, 'w').write(template)
-				except:
-					raise OutputException('Failed to write ' + templateName + '.')
+		if self.__incremental and not self.__stageOnDisk:
+			print('Reused ' + str(self.__container.reused) + ' of ' + str(self.__container.written) + ' files from the previous build.')
 
-			except:
-				print(__file__[:-3] + '/templates/' + templateName)
-				raise OutputException('Failed to read ' + templateName + ' template.')
+		if self.__container.unchanged:
+			print(filename + ' is unchanged.')
 
-		# Copy the cover (WARNING: should not exceed 1000 pixels in longest
-		# dimension to avoid crashing older e-readers.)
-		try:
+	##########################################################################
 
-			# If user specified that they wanted to generate a cover, do so here.
-			# This is useful if, say, you want to create an ARC or you want to
-			# test the e-book, but no cover has been designed yet.
-			if 'generate' == self._coverPath:
+	# Transforms the DOM-like representation of the e-book into the EPUB format.
+	def transform(self, DOMRoot, filename):
 
-				import shlex, subprocess
+		self.__beginBook(filename)
 
-				# Imagemagick is required to generate a cover, so make sure it exists
-				try:
-					subprocess.check_output(shlex.split('convert --version'))
-				except:
-					raise OutputException('Imagemagick must be installed before you can generate a cover.')
+		# Output parts and chapters
+		self.__transformSections(DOMRoot)
 
-				subprocess.check_call(shlex.split('convert -background black -size ' + str(GENERATED_COVER_WIDTH) + 'x' + str(GENERATED_COVER_HEIGHT / 2) + ' -fill "#ffffff" -pointsize 110 -gravity center label:"' + self._bookTitle + '" -pointsize 60 label:"' + self._bookAuthor + '" -append ' + self.__tmpOutputDir + '/OEBPS/Cover.jpg'))
+		self.__finishBook(filename)
 
-			# The user provided a cover image, so use it
-			else:
-				# TODO: actually do extensive validation of the image before just
-				# blindly copying it over ;)
-				shutil.copyfile(self._coverPath, self.__tmpOutputDir + '/OEBPS/Cover.jpg')
+	##########################################################################
 
-		except Exception as e:
+	# Same as transform(), except that parts and chapters are read from an
+	# input driver's stream() and written out as they arrive, so only a
+	# handful of chapters are ever held in memory at once.
+	def transformStream(self, events, filename):
 
-			raise OutputException('Could not copy or generate cover: ' + str(e))
+		self.__beginBook(filename)
 
-		# Finally, write the ePub file. Phew!
-		self.__zipBook(filename)
+		# Output parts and chapters
+		self.__transformSectionStream(events)
+
+		self.__finishBook(filename)
 
 	##########################################################################
 
 	# Cleans up the mess left behind after an e-book conversion.
 	def cleanup(self):
 
-		try:
-			shutil.rmtree(self.__tmpOutputDir)
-
-		# If this is on the backend of a server, I don't want people to get
-		# error messages about it. But /tmp should be monitored to make sure
-		# it's not filling up because this is silently failing.
-		except:
-			pass
-
+		if self.__container:
+			self.__container.cleanup()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+
+import re
+
+# A template compiled into alternating runs of literal text and placeholders,
+# so that it can be filled in with a single pass over the template instead of
+# one pass per variable. Placeholders are matched longest first, so that a
+# variable whose name starts with the name of another one (say, %titleSlug
+# and %title) is always matched in full, and values that happen to contain
+# the name of a placeholder are never expanded themselves.
+class Template:
+
+	# Constructor. variableNames is the list of every placeholder that may
+	# appear in the template, including the leading %.
+	def __init__(self, text, variableNames):
+
+		placeholderRegex = re.compile(
+			'(' + '|'.join(re.escape(name) for name in sorted(variableNames, key = len, reverse = True)) + ')'
+		)
+
+		# Even indices are literal text and odd indices are placeholders
+		self.__segments = placeholderRegex.split(text) if variableNames else [text]
+
+	##########################################################################
+
+	# Fills in the template with the given variables. Placeholders that don't
+	# have a value are left alone.
+	def render(self, variables):
+
+		segments = list(self.__segments)
+		segments[1::2] = [variables.get(name, name) for name in segments[1::2]]
+
+		return ''.join(segments)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# A book's table of contents, stored as a flat table of entries (parts and
+# chapters) in reading order instead of as a tree. Each column is a list with
+# one element per entry:
+#
+# depths:    how deeply the entry is nested (0 for the root of the table of
+#            contents, 1 for chapters inside of a part, and so on)
+# indices:   the entry's position in the book, starting at 1
+# slugs:     the entry's title with everything but letters and digits removed
+# titles:    the entry's title, already escaped for XHTML
+# filenames: the file the entry is written to, relative to OEBPS/
+#
+# Entries are added once, as parts and chapters are transformed, and every
+# listing of them (the OPF's manifest and spine, toc.ncx's navmap and
+# toc.xhtml) can then be written out with a single pass over the table.
+class TableOfContents:
+
+	# Constructor
+	def __init__(self):
+
+		self.depths = []
+		self.indices = []
+		self.slugs = []
+		self.titles = []
+		self.filenames = []
+
+	##########################################################################
+
+	# Returns the number of entries.
+	def __len__(self):
+
+		return len(self.depths)
+
+	##########################################################################
+
+	# Adds an entry to the end of the table of contents and returns the
+	# filename it should be written to.
+	def add(self, depth, title, slug):
+
+		index = len(self.depths) + 1
+		filename = str(index).zfill(3) + '_' + slug + '.xhtml'
+
+		self.depths.append(depth)
+		self.indices.append(index)
+		self.slugs.append(slug)
+		self.titles.append(title)
+		self.filenames.append(filename)
+
+		return filename
+
+	##########################################################################
+
+	# Walks the table of contents in order, yielding a tuple for each entry
+	# with its position in the table, whether the entries after it are nested
+	# inside of it, and the positions of the entries that contain it whose
+	# last nested entry it is, innermost first. That's enough to write out
+	# nested listings without recursion.
+	def walk(self):
+
+		ancestors = []
+		count = len(self.depths)
+
+		for position in range(count):
+
+			nextDepth = self.depths[position + 1] if position + 1 < count else -1
+
+			if nextDepth > self.depths[position]:
+				ancestors.append(position)
+				yield position, True, ()
+
+			else:
+
+				closed = []
+
+				while ancestors and self.depths[ancestors[-1]] >= nextDepth:
+					closed.append(ancestors.pop())
+
+				yield position, False, closed
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+
+# Accumulates text that's built up a piece at a time, like a chapter's XHTML
+# or the entries in the table of contents. Pieces are appended to a list and
+# joined together once when the text is complete, instead of copying
+# everything that's been written so far each time a piece is added with +=.
+# Builders that call each other (like the recursive paragraph renderer) share
+# a single TextWriter, so nested output is never copied at all.
+class TextWriter:
+
+	# Constructor
+	def __init__(self):
+
+		self.__pieces = []
+
+		# Appends a string. This is the list's own append() method, since
+		# it gets called for every tag and run of text in the book.
+		self.write = self.__pieces.append
+
+	##########################################################################
+
+	# Returns everything that's been written.
+	def getvalue(self):
+
+		return ''.join(self.__pieces)
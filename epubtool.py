@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys, argparse
-import util
+import sys, json, atexit, argparse
+import util, instrumentation
 
 import drivers.input
 import drivers.output
@@ -19,7 +19,6 @@ parser.add_argument(
 	'-I',
 	dest='INPUT_DRIVER',
 	nargs=1,
-	required=True,
 	help='Driver that knows how to read your input document (required)'
 )
 
@@ -35,7 +34,6 @@ parser.add_argument(
 	'--title',
 	dest='TITLE',
 	nargs=1,
-	required=True,
 	help='Title of the book (required)'
 )
 
@@ -43,7 +41,6 @@ parser.add_argument(
 	'--author',
 	dest='AUTHOR',
 	nargs=1,
-	required=True,
 	help='Author of the book (required)'
 )
 
@@ -58,7 +55,6 @@ parser.add_argument(
 	'--lang',
 	dest='LANGUAGE',
 	nargs=1,
-	required=True,
 	help='Language of the book (required, ex: en-US)'
 )
 
@@ -67,7 +63,6 @@ parser.add_argument(
 	dest='YEAR',
 	type=int,
 	nargs=1,
-	required=True,
 	help='Copyright year in YYYY format (required)'
 )
 
@@ -75,7 +70,6 @@ parser.add_argument(
 	'--pubDate',
 	dest='DATE',
 	nargs=1,
-	required=True,
 	help='Publication date in YYYY-MM-DD format (required)'
 )
 
@@ -83,7 +77,6 @@ parser.add_argument(
 	'--coverPath',
 	dest='COVER',
 	nargs=1,
-	required=True,
 	help='Path to cover image (required, "generate" = generate a test cover)'
 )
 
@@ -103,18 +96,290 @@ parser.add_argument(
 	help='Book is a work of fiction (default)'
 )
 
+parser.add_argument(
+	'--coverMaxDimension',
+	dest='COVER_MAX_DIMENSION',
+	type=int,
+	nargs=1,
+	default=[1000],
+	help='Scale the cover down so that neither its width nor its height exceeds this many pixels (default: 1000, requires Pillow)'
+)
+
+parser.add_argument(
+	'--coverMaxSize',
+	dest='COVER_MAX_SIZE',
+	type=int,
+	nargs=1,
+	default=[1024],
+	help='Recompress the cover as a JPEG no larger than this many kilobytes if it is bigger (default: 1024, requires Pillow)'
+)
+
+parser.add_argument(
+	'--compression',
+	dest='COMPRESSION',
+	nargs=1,
+	choices=list(drivers.output.container.COMPRESSION_PRESETS) + [str(level) for level in range(10)],
+	default=['default'],
+	help='How hard to compress the e-book: fast (for previews and ARCs), default, max (for store uploads) or a level from 0 to 9 (default: default)'
+)
+
+parser.add_argument(
+	'--deterministic',
+	action='store_true',
+	default=False,
+	help='Build the exact same file every time the same book is converted, and leave OUTPUT alone if it has not changed (timestamps are taken from SOURCE_DATE_EPOCH if it is set)'
+)
+
+parser.add_argument(
+	'--stageOnDisk',
+	action='store_true',
+	default=False,
+	help='Assemble the book in a temporary directory before zipping it (useful for debugging)'
+)
+
+parser.add_argument(
+	'--incremental',
+	action='store_true',
+	default=False,
+	help='If OUTPUT already exists, copy files that have not changed since it was built instead of compressing them again'
+)
+
+parser.add_argument(
+	'--stream',
+	action='store_true',
+	default=False,
+	help='Hand chapters to the output driver one at a time as they are parsed instead of parsing the whole book first (uses less memory on very large books)'
+)
+
+parser.add_argument(
+	'--jobs',
+	dest='JOBS',
+	type=int,
+	nargs=1,
+	default=[1],
+	help='Number of processes used to parse and render chapters (default: 1, 0 = one per CPU core)'
+)
+
+parser.add_argument(
+	'--persistentOffice',
+	action='store_true',
+	default=False,
+	help='Soffice driver only: convert documents with one long-running LibreOffice instance instead of starting a new one for each document (requires the uno module that comes with LibreOffice)'
+)
+
+parser.add_argument(
+	'--chapterCache',
+	dest='CHAPTER_CACHE',
+	nargs=1,
+	help='Scrivener driver only: cache parsed chapters in this directory so that unchanged chapters are not parsed again'
+)
+
+parser.add_argument(
+	'--chapterCacheSize',
+	dest='CHAPTER_CACHE_SIZE',
+	type=int,
+	nargs=1,
+	default=[512],
+	help='Maximum size of the chapter cache in megabytes (default: 512)'
+)
+
+parser.add_argument(
+	'--variant',
+	dest='VARIANTS',
+	action='append',
+	help='Also build another edition of the book from the same parse, described by a JSON object with its own output and any settings it changes, like {"output": "arc.epub", "coverPath": "generate", "options": {"compression": "fast"}} (see batch.py). Can be given more than once.'
+)
+
+parser.add_argument(
+	'--manifest',
+	dest='MANIFEST',
+	nargs=1,
+	help='Convert every book listed in a JSON lines manifest instead of a single INPUT and OUTPUT (see batch.py). Options given on the command line are used as defaults for every book, and --jobs sets how many books are converted at once.'
+)
+
+parser.add_argument(
+	'--serve',
+	dest='SERVE',
+	nargs=1,
+	help='Run a conversion service on this address (host:port or unix:/path/to/socket) instead of converting a single INPUT (see server.py). Options given on the command line are used as defaults for every book, and --jobs sets how many books are converted at once.'
+)
+
+parser.add_argument(
+	'--queueSize',
+	dest='QUEUE_SIZE',
+	type=int,
+	nargs=1,
+	default=[16],
+	help='With --serve: number of uploads that can wait for a free job before new ones are turned away (default: 16)'
+)
+
+parser.add_argument(
+	'--jobTimeout',
+	dest='JOB_TIMEOUT',
+	type=float,
+	nargs=1,
+	default=[600],
+	help='With --serve: maximum number of seconds a conversion may take (default: 600)'
+)
+
+parser.add_argument(
+	'--maxUploadSize',
+	dest='MAX_UPLOAD_SIZE',
+	type=int,
+	nargs=1,
+	default=[512],
+	help='With --serve: maximum size of an uploaded document in megabytes (default: 512)'
+)
+
+parser.add_argument(
+	'--trace',
+	dest='TRACE',
+	nargs=1,
+	help='Record how long each stage of the conversion takes and write the results to this file (see instrumentation.py)'
+)
+
+parser.add_argument(
+	'--traceFormat',
+	dest='TRACE_FORMAT',
+	nargs=1,
+	choices=instrumentation.Tracer.formats,
+	default=['json'],
+	help='Format of the file written by --trace: json or chrome, which can be loaded into chrome://tracing (default: json)'
+)
+
+parser.add_argument(
+	'--traceMemory',
+	action='store_true',
+	default=False,
+	help='Include the peak memory used by each stage in the trace (slows down the conversion)'
+)
+
 parser.add_argument(
 	'INPUT',
+	nargs='?',
 	help='Document input file (required)'
 )
 
 parser.add_argument(
 	'OUTPUT',
+	nargs='?',
 	help='E-book output file (required)'
 )
 
 args = parser.parse_args()
 
+# Options that only some input drivers understand are only passed along when
+# they're actually set, so that the other drivers don't have to accept them.
+inputOptions = {}
+inputOptionFlags = []
+
+if args.persistentOffice:
+	inputOptions['persistentOffice'] = True
+	inputOptionFlags.append('--persistentOffice')
+
+if args.CHAPTER_CACHE:
+	inputOptionFlags.append('--chapterCache')
+	inputOptions['chapterCachePath'] = args.CHAPTER_CACHE[0]
+	inputOptions['chapterCacheSize'] = args.CHAPTER_CACHE_SIZE[0] * 1024 * 1024
+
+# Options for the output driver
+outputOptions = {
+	'stageOnDisk': args.stageOnDisk,
+	'incremental': args.incremental,
+	'coverMaxDimension': args.COVER_MAX_DIMENSION[0],
+	'coverMaxSize': args.COVER_MAX_SIZE[0] * 1024,
+	'compression': args.COMPRESSION[0],
+	'deterministic': args.deterministic
+}
+
+# Write the trace however we exit, including when the conversion fails.
+if args.TRACE:
+	tracer = instrumentation.Tracer(args.TRACE[0], args.TRACE_FORMAT[0], args.traceMemory)
+	tracer.start()
+	atexit.register(tracer.finish)
+
+###############################################################################
+
+# Anything set on the command line applies to every book in a batch manifest
+# or converted by the server that doesn't override it.
+if args.MANIFEST or args.SERVE:
+
+	defaults = {
+		'inputDriver': args.INPUT_DRIVER,
+		'outputDriver': args.OUTPUT_DRIVER,
+		'title': args.TITLE,
+		'author': args.AUTHOR,
+		'publisher': args.PUBNAME,
+		'lang': args.LANGUAGE,
+		'copyrightYear': args.YEAR,
+		'pubDate': args.DATE,
+		'coverPath': args.COVER
+	}
+
+	defaults = {key: value[0] for key, value in defaults.items() if value}
+	defaults['includeCopyright'] = args.includeCopyright
+	defaults['isFiction'] = args.isFiction
+
+# Server mode: handle conversion requests until we're stopped.
+if args.SERVE:
+
+	from server import Server
+
+	server = Server(defaults, args.JOBS[0], args.QUEUE_SIZE[0], args.JOB_TIMEOUT[0],
+		args.MAX_UPLOAD_SIZE[0] * 1024 * 1024, inputOptions,
+		dict(outputOptions, incremental = False), args.stream)
+
+	try:
+		server.run(args.SERVE[0])
+	except KeyboardInterrupt:
+		pass
+	except (OSError, ValueError) as error:
+		util.eprint('\nCould not start server: ' + str(error) + '\n')
+		sys.exit(3)
+
+	sys.exit(0)
+
+# Batch mode: convert every book in the manifest, report how each one went and
+# exit with an error status if any of them failed.
+if args.MANIFEST:
+
+	from batch import Batch
+
+	def reportBook(result):
+
+		if result['success']:
+			print('Converted ' + str(result['input']) + ' to ' + str(result['output']) + '.')
+		else:
+			util.eprint('Failed to convert ' + str(result['input']) + ' (manifest line ' + str(result['line']) + '): ' + str(result['error']))
+
+	batch = Batch(defaults, args.JOBS[0], inputOptions, outputOptions, args.stream)
+
+	try:
+		batch.load(args.MANIFEST[0])
+	except (OSError, UnicodeDecodeError) as error:
+		util.eprint('\nCould not read manifest ' + args.MANIFEST[0] + ': ' + str(error) + '\n')
+		sys.exit(3)
+
+	results = batch.run(reportBook)
+	failures = len([result for result in results if not result['success']])
+
+	print('\n' + str(len(results) - failures) + ' of ' + str(len(results)) + ' books converted successfully.')
+	sys.exit(4 if failures else 0)
+
+# Outside of batch mode, everything that describes the book is required.
+missingArgs = [
+	name for name, value in [
+		('-I', args.INPUT_DRIVER), ('--title', args.TITLE),
+		('--author', args.AUTHOR), ('--lang', args.LANGUAGE),
+		('--copyrightYear', args.YEAR), ('--pubDate', args.DATE),
+		('--coverPath', args.COVER), ('INPUT', args.INPUT),
+		('OUTPUT', args.OUTPUT)
+	] if value is None
+]
+
+if missingArgs:
+	parser.error('the following arguments are required: ' + ', '.join(missingArgs))
+
 # If no publisher name is set, default to the author's name instead
 if None == args.PUBNAME:
 	args.PUBNAME = args.AUTHOR
@@ -126,34 +391,78 @@ if None == args.PUBNAME:
 try:
 
 	InputDriverClass = getattr(drivers.input, args.INPUT_DRIVER[0].lower().capitalize())
-	inputDriver = InputDriverClass()
+	inputDriver = InputDriverClass(jobs = args.JOBS[0], **inputOptions)
 
 except AttributeError as error:
 
 	util.eprint('\nInput driver ' + args.INPUT_DRIVER[0].lower().capitalize() + ' is not supported.\n')
 	sys.exit(3)
 
+except TypeError as error:
+
+	util.eprint('\nInput driver ' + args.INPUT_DRIVER[0].lower().capitalize() + ' does not support ' + ', '.join(inputOptionFlags) + '.\n')
+	sys.exit(3)
+
+# Every variant is another edition of the book, built from the same parse
+# (see batch.py)
+from batch import _validateVariants
+
 try:
+	variants = [json.loads(variant) for variant in args.VARIANTS] if args.VARIANTS else []
+	_validateVariants(variants, args.OUTPUT_DRIVER[0])
 
-	OutputDriverClass = getattr(drivers.output, args.OUTPUT_DRIVER[0].lower().capitalize())
-	outputDriver = OutputDriverClass(args.LANGUAGE[0], args.PUBNAME[0], args.AUTHOR[0],
-			args.TITLE[0], args.DATE[0], str(args.YEAR[0]), args.includeCopyright,
-			args.isFiction, args.COVER[0])
+except ValueError as error:
+	parser.error('invalid --variant: ' + str(error))
 
-except AttributeError as error:
+edition = {
+	'output': args.OUTPUT,
+	'outputDriver': args.OUTPUT_DRIVER[0],
+	'title': args.TITLE[0],
+	'author': args.AUTHOR[0],
+	'publisher': args.PUBNAME[0],
+	'lang': args.LANGUAGE[0],
+	'copyrightYear': args.YEAR[0],
+	'pubDate': args.DATE[0],
+	'coverPath': args.COVER[0],
+	'includeCopyright': args.includeCopyright,
+	'isFiction': args.isFiction
+}
 
-	util.eprint('\nOutput driver ' + args.OUTPUT_DRIVER[0].lower().capitalize() + ' is not supported.\n')
-	sys.exit(3)
+editions = [edition] + [dict(edition, **variant) for variant in variants]
+outputDrivers = []
+
+# Variants can override any output option, including --jobs
+editionOptions = dict(outputOptions, jobs = args.JOBS[0])
+
+for edition in editions:
+
+	try:
+
+		OutputDriverClass = getattr(drivers.output, edition['outputDriver'].lower().capitalize())
+		outputDrivers.append(OutputDriverClass(edition['lang'], edition['publisher'], edition['author'],
+			edition['title'], edition['pubDate'], str(edition['copyrightYear']), edition['includeCopyright'],
+			edition['isFiction'], edition['coverPath'],
+			**dict(editionOptions, **edition.get('options', {}))))
+
+	except AttributeError as error:
+
+		util.eprint('\nOutput driver ' + edition['outputDriver'].lower().capitalize() + ' is not supported.\n')
+		sys.exit(3)
+
+	# Option names were checked along with the variants, but their values
+	# can only be checked by the driver itself
+	except (TypeError, exception.OutputException) as error:
+		parser.error('invalid options for ' + edition['output'] + ': ' + str(error))
 
 ###############################################################################
 
 # Create the e-book :)
-process = Process(inputDriver, outputDriver)
+process = Process(inputDriver, outputDrivers, args.stream, args.JOBS[0])
 
 try:
 
 	process.open(args.INPUT)
-	process.convert(args.OUTPUT)
+	process.convert([edition['output'] for edition in editions])
 	process.cleanup()
 
 	sys.exit(0)
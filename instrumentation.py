@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -*-
+
+import os, json, time, threading, tracemalloc
+
+# Records where the time goes during a conversion. Interesting stages are
+# marked in the code like this:
+#
+# with instrumentation.stage('renderSection', title = sectionNode.value):
+# 	...
+#
+# and each time one finishes, a Tracer records how long it took (wall clock and
+# CPU time), and optionally the peak amount of memory allocated by Python while
+# it ran. When no Tracer has been started, stage() returns a shared object
+# that does nothing, so the hooks can stay in place at almost no cost.
+#
+# Stages run by worker processes forked after the Tracer was started (see the
+# --jobs option) are recorded as well, and written to the same trace.
+
+# The Tracer that's currently recording stages, if any
+_activeTracer = None
+
+##############################################################################
+
+# Returned by stage() when nothing is being traced.
+class _NullStage:
+
+	__slots__ = ()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+		return False
+
+_nullStage = _NullStage()
+
+##############################################################################
+
+# A single run of a stage while a Tracer is active.
+class _Stage:
+
+	__slots__ = ('tracer', 'name', 'args', 'start', 'cpuStart', 'peakMemory')
+
+	def __init__(self, tracer, name, args):
+
+		self.tracer = tracer
+		self.name = name
+		self.args = args
+
+	def __enter__(self):
+
+		self.tracer._begin(self)
+		return self
+
+	def __exit__(self, excType, excValue, traceback):
+
+		self.tracer._end(self, excType)
+		return False
+
+##############################################################################
+
+# Marks a stage of the conversion. Any keyword arguments (the title of the
+# chapter being parsed, for example) are included in the trace.
+def stage(name, **args):
+
+	if _activeTracer is None:
+		return _nullStage
+
+	return _Stage(_activeTracer, name, args)
+
+##############################################################################
+
+# Collects stages and writes them to a file once the conversion is finished,
+# either as JSON or in Chrome's trace event format, which can be loaded into
+# chrome://tracing or https://ui.perfetto.dev.
+#
+# The JSON format looks like this:
+#
+# {
+# 	"stages": [
+# 		{"name": "parseChapter", "args": {"title": "Chapter 1"}, "pid": 123,
+# 		"tid": 456, "start": 0.01, "wall": 0.25, "cpu": 0.24, "peakMemory": 123456},
+# 		...
+# 	],
+# 	"summary": {
+# 		"parseChapter": {"count": 20, "wall": 5.1, "cpu": 4.9, "peakMemory": 234567},
+# 		...
+# 	}
+# }
+#
+# where start is the number of seconds since the Tracer was started, CPU time
+# is measured for the thread that ran the stage, and peakMemory is only
+# included if traceMemory is True. Since tracemalloc only has one peak per
+# process, the peak of a stage that overlaps with stages in other threads
+# includes their allocations, too.
+class Tracer:
+
+	formats = ['json', 'chrome']
+
+	##########################################################################
+
+	# Constructor
+	def __init__(self, filename, traceFormat = 'json', traceMemory = False):
+
+		if traceFormat not in self.formats:
+			raise ValueError('Unsupported trace format ' + str(traceFormat) + '.')
+
+		self.__filename = filename
+		self.__format = traceFormat
+		self.__traceMemory = traceMemory
+		self.__startedTracemalloc = False
+
+		# Stages recorded by the process that started the Tracer. Worker
+		# processes append theirs to a spool file instead, which gets merged
+		# in when the trace is written.
+		self.__ownerPid = os.getpid()
+		self.__spoolFilename = filename + '.' + str(self.__ownerPid) + '.spool'
+		self.__stages = []
+
+		# Stages that haven't finished yet in the current process, so that an
+		# inner stage resetting tracemalloc's peak doesn't lose the outer
+		# stages' peaks
+		self.__pid = self.__ownerPid
+		self.__openStages = []
+		self.__lock = threading.Lock()
+
+		self.__origin = None
+
+	##########################################################################
+
+	# Starts recording stages.
+	def start(self):
+
+		global _activeTracer
+
+		if self.__traceMemory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.__startedTracemalloc = True
+
+		self.__origin = time.perf_counter()
+		_activeTracer = self
+
+	##########################################################################
+
+	# Called when a stage starts.
+	def _begin(self, stage):
+
+		# We're in a process that was forked after the Tracer was started. The
+		# lock might have been held by another thread at the time of the fork,
+		# and the open stages belong to the parent, so start over.
+		if os.getpid() != self.__pid:
+			self.__pid = os.getpid()
+			self.__openStages = []
+			self.__lock = threading.Lock()
+
+		stage.peakMemory = None
+
+		if tracemalloc.is_tracing():
+
+			with self.__lock:
+
+				peak = tracemalloc.get_traced_memory()[1]
+
+				for openStage in self.__openStages:
+					openStage.peakMemory = max(openStage.peakMemory or 0, peak)
+
+				tracemalloc.reset_peak()
+				self.__openStages.append(stage)
+
+			stage.peakMemory = 0
+
+		stage.cpuStart = time.thread_time()
+		stage.start = time.perf_counter()
+
+	##########################################################################
+
+	# Called when a stage finishes.
+	def _end(self, stage, excType):
+
+		end = time.perf_counter()
+		cpuEnd = time.thread_time()
+
+		record = {
+			'name': stage.name,
+			'args': stage.args,
+			'pid': os.getpid(),
+			'tid': threading.get_ident(),
+			'start': stage.start - self.__origin,
+			'wall': end - stage.start,
+			'cpu': cpuEnd - stage.cpuStart
+		}
+
+		if excType is not None:
+			record['error'] = excType.__name__
+
+		if stage.peakMemory is not None and tracemalloc.is_tracing():
+
+			with self.__lock:
+
+				peak = max(stage.peakMemory, tracemalloc.get_traced_memory()[1])
+
+				if stage in self.__openStages:
+					self.__openStages.remove(stage)
+
+				for openStage in self.__openStages:
+					openStage.peakMemory = max(openStage.peakMemory or 0, peak)
+
+			record['peakMemory'] = peak
+
+		if os.getpid() == self.__ownerPid:
+			self.__stages.append(record)
+
+		# A single write to a file opened for appending keeps records from
+		# different worker processes from getting mixed together.
+		else:
+
+			try:
+				spool = os.open(self.__spoolFilename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+				os.write(spool, (json.dumps(record, default = str) + '\n').encode('utf-8'))
+				os.close(spool)
+
+			# Tracing should never make a conversion fail
+			except OSError:
+				pass
+
+	##########################################################################
+
+	# Returns the stages recorded by worker processes and removes the spool
+	# file they were written to.
+	def __readSpool(self):
+
+		stages = []
+
+		try:
+
+			with open(self.__spoolFilename, 'r', encoding = 'utf-8') as spool:
+
+				for line in spool:
+
+					# A worker that was killed mid-write may have left a
+					# truncated line behind
+					try:
+						stages.append(json.loads(line))
+					except ValueError:
+						pass
+
+			os.remove(self.__spoolFilename)
+
+		except OSError:
+			pass
+
+		return stages
+
+	##########################################################################
+
+	# Returns the total time spent in and the overall peak memory of each
+	# stage.
+	def __summarize(self, stages):
+
+		summary = {}
+
+		for record in stages:
+
+			if record['name'] not in summary:
+				summary[record['name']] = {'count': 0, 'wall': 0, 'cpu': 0}
+
+			stageSummary = summary[record['name']]
+			stageSummary['count'] += 1
+			stageSummary['wall'] += record['wall']
+			stageSummary['cpu'] += record['cpu']
+
+			if 'peakMemory' in record:
+				stageSummary['peakMemory'] = max(stageSummary.get('peakMemory', 0), record['peakMemory'])
+
+		return summary
+
+	##########################################################################
+
+	# Converts stages to Chrome's trace event format, using complete ("X")
+	# events, which are timed in microseconds.
+	def __chromeTrace(self, stages):
+
+		events = []
+
+		for pid in sorted(set(record['pid'] for record in stages)):
+			events.append({
+				'name': 'process_name', 'ph': 'M', 'pid': pid,
+				'args': {'name': 'epubtools' if pid == self.__ownerPid else 'epubtools worker'}
+			})
+
+		for record in stages:
+
+			args = dict(record['args'])
+			args['cpu'] = record['cpu']
+
+			for key in ['peakMemory', 'error']:
+				if key in record:
+					args[key] = record[key]
+
+			events.append({
+				'name': record['name'],
+				'cat': 'epubtools',
+				'ph': 'X',
+				'ts': record['start'] * 1000000,
+				'dur': record['wall'] * 1000000,
+				'pid': record['pid'],
+				'tid': record['tid'],
+				'args': args
+			})
+
+		return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+	##########################################################################
+
+	# Stops recording stages and writes the trace. Does nothing if called from
+	# a worker process, or if the trace has already been written.
+	def finish(self):
+
+		global _activeTracer
+
+		if os.getpid() != self.__ownerPid or self.__origin is None:
+			return
+
+		if self is _activeTracer:
+			_activeTracer = None
+
+		if self.__startedTracemalloc:
+			tracemalloc.stop()
+			self.__startedTracemalloc = False
+
+		self.__origin = None
+
+		stages = sorted(self.__stages + self.__readSpool(), key = lambda record: record['start'])
+
+		if 'chrome' == self.__format:
+			trace = self.__chromeTrace(stages)
+		else:
+			trace = {'stages': stages, 'summary': self.__summarize(stages)}
+
+		with open(self.__filename, 'w', encoding = 'utf-8') as traceFile:
+			json.dump(trace, traceFile, indent = 1, default = str)
@@ -1,30 +1,127 @@
 # -*- coding: utf-8 -*-
 
+import os, multiprocessing, concurrent.futures
+
+import instrumentation
+from exception import OutputException
+
+# The output drivers, book and filenames being transformed by output worker
+# processes (see Process.__transformInParallel.)
+_outputState = None
+
+# Initializes an output worker process.
+def _initOutputWorker(outputDrivers, DOMRoot, filenames):
+
+	global _outputState
+	_outputState = (outputDrivers, DOMRoot, filenames)
+
+# Transforms the book with the output driver at the given index inside of a
+# worker process. The worker's copy of the driver is the one that did the
+# work, so it has to clean up after itself, too.
+def _transformInWorker(index):
+
+	outputDrivers, DOMRoot, filenames = _outputState
+
+	try:
+		with instrumentation.stage('transform', filename = filenames[index]):
+			outputDrivers[index].transform(DOMRoot, filenames[index])
+
+	finally:
+		outputDrivers[index].cleanup()
+
 class Process:
 
 	##########################################################################
 
-	# Constructor
-	def __init__(self, inputDriver, outputDriver):
+	# Constructor. outputDrivers can be a single output driver or a list of
+	# them, in which case the book is only parsed once and every output
+	# driver transforms the same DOM (for example, to build a store edition
+	# and an ARC of the same book with differently configured Epub drivers.)
+	# If jobs is greater than 1, up to that many output drivers transform the
+	# book at once, each in its own process.
+	#
+	# If streaming is True, chapters are handed from the input driver to the
+	# output driver one at a time instead of parsing the whole book before
+	# transforming it, which keeps memory use down for very large books. The
+	# input driver's DOMRoot isn't populated in that case. A stream can only be
+	# read once, so books with more than one output driver are always parsed
+	# in full.
+	def __init__(self, inputDriver, outputDrivers, streaming = False, jobs = 1):
+
+		if not isinstance(outputDrivers, (list, tuple)):
+			outputDrivers = [outputDrivers]
 
 		self.__inputDriver = inputDriver
-		self.__outputDriver = outputDriver
+		self.__outputDrivers = list(outputDrivers)
+		self.__streaming = streaming and 1 == len(self.__outputDrivers)
+		self.__jobs = jobs if jobs >= 1 else (os.cpu_count() or 1)
 
 	##########################################################################
 
 	# Tells the input driver to open the source for reading.
 	def open(self, filename):
 
-		self.__inputDriver.open(filename)
+		with instrumentation.stage('open', filename = filename):
+			self.__inputDriver.open(filename)
+
+	##########################################################################
+
+	# Transforms the book with each output driver in its own worker process.
+	# Forked workers get their own copy of the DOM, so none of them can
+	# affect the others.
+	def __transformInParallel(self, DOMRoot, filenames):
+
+		with concurrent.futures.ProcessPoolExecutor(
+			max_workers = min(self.__jobs, len(self.__outputDrivers)),
+			mp_context = multiprocessing.get_context('fork'),
+			initializer = _initOutputWorker,
+			initargs = (self.__outputDrivers, DOMRoot, filenames)
+		) as executor:
+
+			# Raises the first output driver's error, if any, once they've all
+			# finished
+			list(executor.map(_transformInWorker, range(len(self.__outputDrivers))))
 
 	##########################################################################
 
 	# Transform the input document to the appropriate output format and write it
-	# to the specified filename.
-	def convert(self, filename):
+	# to the specified filename, or to each filename in a list, in the same
+	# order as the output drivers. When streaming, parsing and transforming
+	# are interleaved, so they're traced as a single stage.
+	def convert(self, filenames):
+
+		if not isinstance(filenames, (list, tuple)):
+			filenames = [filenames]
+
+		if len(filenames) != len(self.__outputDrivers):
+			raise OutputException('Expected ' + str(len(self.__outputDrivers)) + ' output filenames but got ' + str(len(filenames)) + '.')
+
+		if self.__streaming:
+			with instrumentation.stage('parseAndTransform', filename = filenames[0]):
+				self.__outputDrivers[0].transformStream(self.__inputDriver.stream(), filenames[0])
 
-		self.__inputDriver.parse()
-		self.__outputDriver.transform(self.__inputDriver.DOMRoot, filename)
+		else:
+
+			with instrumentation.stage('parse'):
+				self.__inputDriver.parse()
+
+			DOMRoot = self.__inputDriver.DOMRoot
+
+			# Every output driver is handed the same DOM, so make sure none of
+			# them can change it out from under the others.
+			if len(self.__outputDrivers) > 1:
+				DOMRoot.freeze()
+
+			if (
+				self.__jobs > 1 and len(self.__outputDrivers) > 1 and
+				'fork' in multiprocessing.get_all_start_methods()
+			):
+				self.__transformInParallel(DOMRoot, filenames)
+
+			else:
+				for outputDriver, filename in zip(self.__outputDrivers, filenames):
+					with instrumentation.stage('transform', filename = filename):
+						outputDriver.transform(DOMRoot, filename)
 
 	##########################################################################
 
@@ -32,4 +129,6 @@ class Process:
 	def cleanup(self):
 
 		self.__inputDriver.cleanup()
-		self.__outputDriver.cleanup()
+
+		for outputDriver in self.__outputDrivers:
+			outputDriver.cleanup()
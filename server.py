@@ -0,0 +1,548 @@
+# -*- coding: utf-8 -*-
+
+import os, json, shutil, asyncio, tempfile, multiprocessing, urllib.parse, concurrent.futures
+
+import util
+from exception import InputException
+from batch import Batch, convertBook, _getDriverClasses, _getOptionNames
+from drivers.input.officeserver import OfficeServer, unoAvailable
+
+# A long-running conversion service. Clients upload a document over HTTP,
+# either on a TCP port or a Unix socket, and get the e-book back in the
+# response:
+#
+# curl --data-binary @novel.rtf -o novel.epub \
+# 	'http://localhost:8080/convert?inputDriver=rtf&filename=novel.rtf&title=...'
+#
+# Query parameters use the same names as the keys in a batch manifest (see
+# batch.py), plus filename, the name of the uploaded document, which input
+# drivers use to tell what kind of file it is. Any of them can be given
+# defaults when the server is started. For security, clients can't point the
+# server at files on its own disk: input and output are always temporary
+# files, coverPath can only be set to "generate" (otherwise, the default
+# given when the server was started is used), and options (a JSON object, as
+# in a manifest) can't include tmpLocation.
+#
+# Errors are reported as JSON objects with an "error" key, and the following
+# status codes:
+#
+# 400: The request was missing something or had an invalid value
+# 411: The request didn't say how big the upload is
+# 413: The upload was too big
+# 422: The document couldn't be converted
+# 503: The server is too busy to take on the job (try again later)
+# 504: The conversion took too long and was stopped
+#
+# Each job runs in its own process forked from the server, which inherits
+# anything drivers have already loaded (like templates) and can be killed if
+# it runs past the timeout. At most maxJobs conversions run at once, and
+# another queueSize uploads can wait for a turn. Anything beyond that is
+# turned away immediately rather than piling up. Everything a job writes,
+# including the RTF that documents read by the Soffice driver are converted
+# to, goes in its own temporary directory.
+#
+# Since job processes don't outlive their jobs, a persistent office instance
+# (the persistentOffice input option) belongs to the server instead: the
+# server converts documents to RTF with it before handing them to a job, so
+# the same instance is reused for every request.
+class Server:
+
+	# Size of the blocks uploads and e-books are read and written in
+	blockSize = 1024 * 1024
+
+	# Limits on the size of a request's headers, to keep a misbehaving client
+	# from using up memory
+	maxHeaderLineSize = 16 * 1024
+	maxHeaders = 100
+
+	# Messages for the status codes we send
+	statusMessages = {
+		200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+		411: 'Length Required', 413: 'Payload Too Large', 422: 'Unprocessable Entity',
+		500: 'Internal Server Error', 503: 'Service Unavailable', 504: 'Gateway Timeout'
+	}
+
+	##########################################################################
+
+	# Constructor. Defaults are applied to every book that doesn't set them
+	# itself. jobTimeout is in seconds and maxUploadSize is in bytes.
+	# inputOptions, outputOptions and streaming are passed along to every
+	# conversion, just like in batch.py.
+	def __init__(self, defaults = None, maxJobs = 1, queueSize = 16,
+	jobTimeout = 600, maxUploadSize = 512 * 1024 * 1024, inputOptions = None,
+	outputOptions = None, streaming = False, tmpLocation = '/tmp'):
+
+		self.__defaults = {'outputDriver': 'epub', 'includeCopyright': True, 'isFiction': True}
+		if defaults:
+			self.__defaults.update(defaults)
+
+		self.__maxJobs = maxJobs if maxJobs >= 1 else (os.cpu_count() or 1)
+		self.__queueSize = max(0, queueSize)
+		self.__jobTimeout = jobTimeout
+		self.__maxUploadSize = maxUploadSize
+		self.__inputOptions = dict(inputOptions) if inputOptions else {}
+		self.__outputOptions = outputOptions if outputOptions else {}
+		self.__streaming = streaming
+		self.__tmpLocation = tmpLocation
+
+		# The server's own office instance, if persistentOffice was set (see
+		# self.__convertToRTF.) Jobs never start one of their own.
+		self.__persistentOffice = self.__inputOptions.pop('persistentOffice', False)
+		self.__officeServer = None
+
+		if self.__persistentOffice and not unoAvailable:
+			util.eprint('Warning: the uno module is not installed, so a new soffice process will be started for each document.')
+			self.__persistentOffice = False
+
+		# Number of jobs that have been accepted and haven't finished yet,
+		# whether they're still uploading, waiting for a turn or running
+		self.__acceptedJobs = 0
+
+		# Created once the event loop is running
+		self.__jobSlots = None
+
+		# Where fork isn't available, jobs run in threads instead, which can't
+		# be stopped when they time out. The job's slot is freed up anyway,
+		# so they'll just queue up in the thread pool.
+		if 'fork' in multiprocessing.get_all_start_methods():
+			self.__forkContext = multiprocessing.get_context('fork')
+			self.__threadPool = None
+		else:
+			self.__forkContext = None
+			self.__threadPool = concurrent.futures.ThreadPoolExecutor(max_workers = self.__maxJobs)
+
+	##########################################################################
+
+	# Starts the server and handles requests until it's stopped. The address
+	# is either "host:port" or "unix:/path/to/socket".
+	def run(self, address):
+
+		asyncio.run(self.serve(address))
+
+	##########################################################################
+
+	# Same as run(), but as a coroutine.
+	async def serve(self, address):
+
+		self.__jobSlots = asyncio.Semaphore(self.__maxJobs)
+
+		if address.startswith('unix:'):
+			server = await asyncio.start_unix_server(self.__handleConnection, address[5:])
+
+		else:
+
+			host, separator, port = address.rpartition(':')
+
+			try:
+				port = int(port)
+			except ValueError:
+				raise ValueError('Invalid address ' + address + '. Use host:port or unix:/path/to/socket.')
+
+			server = await asyncio.start_server(self.__handleConnection, host if separator else None, port)
+
+		print('Listening on ' + address + '...')
+
+		async with server:
+			await server.serve_forever()
+
+	##########################################################################
+
+	# Reads the request line and headers. Returns the method, path, query
+	# string parameters and headers (with lowercase names), or None if the
+	# request was malformed.
+	async def __readRequest(self, reader):
+
+		try:
+
+			requestLine = (await reader.readuntil(b'\n')).decode('latin-1').split()
+
+			if 3 != len(requestLine):
+				return None
+
+			headers = {}
+
+			while True:
+
+				line = await reader.readuntil(b'\n')
+
+				if len(line) > self.maxHeaderLineSize or len(headers) > self.maxHeaders:
+					return None
+
+				line = line.decode('latin-1').strip()
+
+				if not line:
+					break
+
+				name, separator, value = line.partition(':')
+
+				if not separator:
+					return None
+
+				headers[name.strip().lower()] = value.strip()
+
+		except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+			return None
+
+		url = urllib.parse.urlsplit(requestLine[1])
+		query = dict(urllib.parse.parse_qsl(url.query))
+
+		return requestLine[0].upper(), url.path, query, headers
+
+	##########################################################################
+
+	# Sends a response whose body is a JSON object.
+	async def __sendJSON(self, writer, status, body, extraHeaders = None):
+
+		content = json.dumps(body).encode('utf-8')
+
+		headers = {'Content-Type': 'application/json', 'Content-Length': str(len(content))}
+		if extraHeaders:
+			headers.update(extraHeaders)
+
+		self.__writeHead(writer, status, headers)
+		writer.write(content)
+		await writer.drain()
+
+	##########################################################################
+
+	# Writes a response's status line and headers.
+	def __writeHead(self, writer, status, headers):
+
+		head = 'HTTP/1.1 ' + str(status) + ' ' + self.statusMessages[status] + '\r\n'
+		headers = dict(headers, Connection = 'close')
+
+		for name, value in headers.items():
+			head += name + ': ' + value + '\r\n'
+
+		writer.write((head + '\r\n').encode('latin-1'))
+
+	##########################################################################
+
+	# Handles a single request. Connections aren't kept alive, so there's
+	# exactly one request per connection.
+	async def __handleConnection(self, reader, writer):
+
+		try:
+
+			request = await self.__readRequest(reader)
+
+			if not request:
+				await self.__sendJSON(writer, 400, {'error': 'Malformed request.'})
+
+			else:
+
+				method, path, query, headers = request
+
+				if '/convert' != path:
+					await self.__sendJSON(writer, 404, {'error': 'Not found.'})
+				elif 'POST' != method:
+					await self.__sendJSON(writer, 405, {'error': 'Use POST to convert a document.'}, {'Allow': 'POST'})
+				else:
+					await self.__handleConvert(reader, writer, query, headers)
+
+		# The client went away, so there's no one to report anything to.
+		except ConnectionError:
+			pass
+
+		except Exception as error:
+
+			util.eprint('Unexpected error while handling a request: ' + str(error))
+
+			try:
+				await self.__sendJSON(writer, 500, {'error': 'Internal server error.'})
+			except Exception:
+				pass
+
+		finally:
+
+			writer.close()
+
+			try:
+				await writer.wait_closed()
+			except Exception:
+				pass
+
+	##########################################################################
+
+	# Builds the description of a book from the request's query string (see
+	# batch.py for what it contains.) Returns the book and an error message,
+	# one of which will be None.
+	def __getBook(self, query, jobPath):
+
+		book = dict(self.__defaults)
+
+		for key, value in query.items():
+
+			if key in ['input', 'output', 'line', 'filename', 'variants']:
+				continue
+
+			if 'coverPath' == key and 'generate' != value:
+				continue
+
+			if key in ['includeCopyright', 'isFiction']:
+				value = value.lower() in ['1', 'true', 'yes']
+
+			# Options for the output driver are a JSON object, just like in a
+			# batch manifest
+			if 'options' == key:
+
+				try:
+					value = json.loads(value)
+				except ValueError:
+					value = None
+
+				if not isinstance(value, dict):
+					return None, 'options must be a JSON object.'
+
+			book[key] = value
+
+		# Only the filename itself is used, so clients can't write anywhere
+		# else
+		filename = os.path.basename(query.get('filename', '')) or 'input'
+
+		book['input'] = os.path.join(jobPath, filename)
+		book['output'] = os.path.join(jobPath, 'output.epub')
+
+		missingKeys = [key for key in Batch.requiredKeys if not book.get(key)]
+
+		if missingKeys:
+			return None, 'Missing ' + ', '.join(missingKeys) + '.'
+
+		try:
+			driverClasses = _getDriverClasses(book)
+		except ValueError as error:
+			return None, str(error)
+
+		if 'options' in query:
+
+			optionNames = _getOptionNames(driverClasses[1])
+			unknownOptions = sorted(
+				option for option in book['options']
+				if 'tmpLocation' == option or optionNames is not None and option not in optionNames
+			)
+
+			if unknownOptions:
+				return None, 'Unsupported options: ' + ', '.join(unknownOptions) + '.'
+
+		# Anything a driver loads while warming up is inherited by the job
+		# processes, so it only has to happen once for the whole server.
+		try:
+			for DriverClass in driverClasses:
+				DriverClass.warmup()
+		except Exception as error:
+			return None, str(error)
+
+		return book, None
+
+	##########################################################################
+
+	# Converts an uploaded document and sends back the e-book.
+	async def __handleConvert(self, reader, writer, query, headers):
+
+		if self.__acceptedJobs >= self.__maxJobs + self.__queueSize:
+			await self.__sendJSON(writer, 503, {'error': 'Too many jobs in progress. Try again later.'}, {'Retry-After': '5'})
+			return
+
+		if 'content-length' not in headers or 'transfer-encoding' in headers:
+			await self.__sendJSON(writer, 411, {'error': 'Content-Length is required.'})
+			return
+
+		try:
+			uploadSize = int(headers['content-length'])
+			if uploadSize < 0:
+				raise ValueError()
+		except ValueError:
+			await self.__sendJSON(writer, 400, {'error': 'Invalid Content-Length.'})
+			return
+
+		if uploadSize > self.__maxUploadSize:
+			await self.__sendJSON(writer, 413, {'error': 'Uploads are limited to ' + str(self.__maxUploadSize) + ' bytes.'})
+			return
+
+		self.__acceptedJobs += 1
+		jobPath = tempfile.mkdtemp(prefix = 'epubtools-job-', dir = self.__tmpLocation)
+
+		try:
+
+			book, error = self.__getBook(query, jobPath)
+
+			if error:
+				await self.__sendJSON(writer, 400, {'error': error})
+				return
+
+			# Clients sending large uploads may wait to be told to go ahead
+			if '100-continue' == headers.get('expect', '').lower():
+				writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+				await writer.drain()
+
+			# Read the upload in blocks, so that it never has to be held in
+			# memory all at once
+			try:
+
+				with open(book['input'], 'wb') as inputFile:
+
+					remaining = uploadSize
+
+					while remaining > 0:
+						block = await asyncio.wait_for(reader.read(min(remaining, self.blockSize)), self.__jobTimeout)
+						if not block:
+							raise ConnectionError('Upload ended early.')
+						inputFile.write(block)
+						remaining -= len(block)
+
+			except asyncio.TimeoutError:
+				await self.__sendJSON(writer, 504, {'error': 'Timed out waiting for the upload.'})
+				return
+
+			inputFilename = os.path.basename(book['input'])
+
+			async with self.__jobSlots:
+
+				try:
+					result = await self.__convertToRTF(book)
+					if not result:
+						result = await self.__runJob(book, jobPath)
+				except asyncio.TimeoutError:
+					result = None
+
+			if not result:
+				print('Timed out converting ' + inputFilename + '.')
+				await self.__sendJSON(writer, 504, {'error': 'Conversion took longer than ' + str(self.__jobTimeout) + ' seconds.'})
+
+			elif not result['success']:
+				print('Failed to convert ' + inputFilename + ': ' + str(result['error']))
+				await self.__sendJSON(writer, 422, {'error': result['error']})
+
+			else:
+				print('Converted ' + inputFilename + '.')
+				await self.__sendFile(writer, book['output'], os.path.splitext(inputFilename)[0] + '.epub')
+
+		finally:
+			self.__acceptedJobs -= 1
+			shutil.rmtree(jobPath, ignore_errors = True)
+
+	##########################################################################
+
+	# Streams the finished e-book back to the client a block at a time,
+	# waiting for the client to catch up whenever its buffer is full.
+	async def __sendFile(self, writer, path, filename):
+
+		self.__writeHead(writer, 200, {
+			'Content-Type': 'application/epub+zip',
+			'Content-Length': str(os.path.getsize(path)),
+			'Content-Disposition': 'attachment; filename="' + filename.replace('"', '') + '"'
+		})
+
+		with open(path, 'rb') as epubFile:
+
+			for block in iter(lambda: epubFile.read(self.blockSize), b''):
+				writer.write(block)
+				await writer.drain()
+
+	##########################################################################
+
+	# If the server has its own office instance and the book is read by the
+	# Soffice driver, converts the upload to an RTF in the job's directory
+	# and points the book at it, so that the job doesn't have to start an
+	# office instance of its own. Returns a failed result (see
+	# batch.convertBook) if the document couldn't be converted, or None
+	# otherwise. Raises asyncio.TimeoutError if it took too long.
+	async def __convertToRTF(self, book):
+
+		if (
+			not self.__persistentOffice or 'soffice' != book['inputDriver'].lower() or
+			book['input'].lower().endswith('.rtf')
+		):
+			return None
+
+		# Started the first time it's needed, so that the server doesn't
+		# start LibreOffice unless it actually has to
+		if not self.__officeServer:
+			self.__officeServer = OfficeServer(self.__tmpLocation)
+
+		rtfPath = os.path.splitext(book['input'])[0] + '.rtf'
+
+		try:
+			await asyncio.wait_for(
+				asyncio.get_running_loop().run_in_executor(None, self.__officeServer.convert, book['input'], rtfPath),
+				self.__jobTimeout
+			)
+
+		except InputException as error:
+			return {'success': False, 'error': str(error)}
+
+		book['input'] = rtfPath
+
+		return None
+
+	##########################################################################
+
+	# Returns the input driver options for a job. Documents the Soffice
+	# driver converts are written to the job's directory instead of being
+	# mixed in with every other job's.
+	def __getInputOptions(self, book, jobPath):
+
+		if 'soffice' == book['inputDriver'].lower():
+			return dict(self.__inputOptions, tmpLocation = jobPath)
+
+		return self.__inputOptions
+
+	##########################################################################
+
+	# Runs a conversion and returns its result (see batch.convertBook), or
+	# raises asyncio.TimeoutError if it took too long.
+	async def __runJob(self, book, jobPath):
+
+		loop = asyncio.get_running_loop()
+		inputOptions = self.__getInputOptions(book, jobPath)
+
+		if not self.__forkContext:
+			return await asyncio.wait_for(
+				loop.run_in_executor(self.__threadPool, convertBook, book, inputOptions, self.__outputOptions, self.__streaming),
+				self.__jobTimeout
+			)
+
+		resultConnection, childConnection = self.__forkContext.Pipe(False)
+		process = self.__forkContext.Process(target = _runJob, args = (
+			childConnection, book, inputOptions, self.__outputOptions, self.__streaming
+		))
+
+		process.start()
+		childConnection.close()
+
+		try:
+
+			# Wait for the result without tying up a thread
+			resultReady = loop.create_future()
+			loop.add_reader(resultConnection.fileno(), lambda: resultReady.done() or resultReady.set_result(None))
+
+			try:
+				await asyncio.wait_for(resultReady, self.__jobTimeout)
+			finally:
+				loop.remove_reader(resultConnection.fileno())
+
+			try:
+				return resultConnection.recv()
+
+			# The process died without sending anything back
+			except EOFError:
+				return {'success': False, 'error': 'Conversion process exited unexpectedly.'}
+
+		except asyncio.TimeoutError:
+			process.kill()
+			raise
+
+		finally:
+			resultConnection.close()
+			await loop.run_in_executor(None, process.join)
+
+##############################################################################
+
+# Runs a single conversion in a forked process and sends the result back to
+# the server.
+def _runJob(connection, book, inputOptions, outputOptions, streaming):
+
+	try:
+		connection.send(convertBook(book, inputOptions, outputOptions, streaming))
+	finally:
+		connection.close()
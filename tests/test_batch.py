@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Runs batches of books and checks how their results are reported. Run with:
+# python -m unittest discover tests
+
+import os, sys, json, shutil, tempfile, unittest, multiprocessing
+from unittest import mock
+
+# Let the tests be run from anywhere, just like epubtool.py
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+import batch
+
+###############################################################################
+
+# Stands in for batch.convertBook. The process converting crash.rtf dies
+# outright, the way it would if it were killed or a native library crashed.
+def convertOrCrash(book, inputOptions = None, outputOptions = None, streaming = False):
+
+	if 'crash.rtf' == book['input']:
+		os._exit(1)
+
+	return batch._bookResult(book)
+
+###############################################################################
+
+class BatchTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.tmpPath = tempfile.mkdtemp(prefix = 'epubtools-test-')
+
+	##########################################################################
+
+	def tearDown(self):
+
+		shutil.rmtree(self.tmpPath, ignore_errors = True)
+
+	##########################################################################
+
+	# Writes a manifest with one book for each input and returns its path.
+	def writeManifest(self, inputs):
+
+		manifestPath = os.path.join(self.tmpPath, 'manifest.jsonl')
+
+		with open(manifestPath, 'w') as manifest:
+			for inputPath in inputs:
+				manifest.write(json.dumps({
+					'input': inputPath, 'output': inputPath + '.epub', 'inputDriver': 'rtf',
+					'title': 'Test', 'author': 'Jane Doe', 'lang': 'en-US',
+					'copyrightYear': 2020, 'pubDate': '2020-01-01', 'coverPath': 'generate'
+				}) + '\n')
+
+		return manifestPath
+
+	##########################################################################
+
+	# Only the book whose process crashed should fail
+	@unittest.skipUnless('fork' in multiprocessing.get_all_start_methods(), 'requires fork')
+	def testCrashedBookDoesNotFailOthers(self):
+
+		inputs = ['one.rtf', 'two.rtf', 'crash.rtf', 'four.rtf', 'five.rtf']
+
+		bookBatch = batch.Batch(jobs = 2)
+		bookBatch.load(self.writeManifest(inputs))
+
+		with mock.patch.object(batch, 'convertBook', convertOrCrash):
+			results = bookBatch.run()
+
+		self.assertEqual([result['input'] for result in results], inputs)
+
+		for result in results:
+			if 'crash.rtf' == result['input']:
+				self.assertFalse(result['success'])
+				self.assertIn('Worker process failed', result['error'])
+			else:
+				self.assertTrue(result['success'], result['error'])
+
+###############################################################################
+
+if __name__ == '__main__':
+	unittest.main()
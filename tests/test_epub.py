@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Builds small books with the Epub output driver and checks what ends up in
+# them. Run with: python -m unittest discover tests
+
+import os, sys, shutil, zipfile, tempfile, unittest
+import xml.etree.ElementTree as ElementTree
+
+# Let the tests be run from anywhere, just like epubtool.py
+repoPath = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repoPath)
+
+from drivers.domnode import EbookNode
+from drivers.output import Epub
+
+# A 1x1 transparent PNG
+PNG_DATA = bytes.fromhex(
+	'89504e470d0a1a0a0000000d4948445200000001000000010806000000' +
+	'1f15c4890000000d49444154789c6360000002000001e221bc330000' +
+	'000049454e44ae426082'
+)
+
+###############################################################################
+
+class EpubTest(unittest.TestCase):
+
+	def setUp(self):
+
+		self.tmpPath = tempfile.mkdtemp(prefix = 'epubtools-test-')
+
+	##########################################################################
+
+	def tearDown(self):
+
+		shutil.rmtree(self.tmpPath, ignore_errors = True)
+
+	##########################################################################
+
+	# Returns a book with a single chapter whose only paragraph contains an
+	# image, named the way input drivers name the pictures they extract.
+	def newBookWithImage(self):
+
+		imageName = 'a' * 64 + '.png'
+
+		with open(os.path.join(self.tmpPath, imageName), 'wb') as imageFile:
+			imageFile.write(PNG_DATA)
+
+		paragraphNode = EbookNode('paragraph')
+		paragraphNode.appendChild(EbookNode('text', 'Before the picture. '))
+		paragraphNode.appendChild(EbookNode('image', imageName,
+			{'path': os.path.join(self.tmpPath, imageName)}))
+
+		chapterNode = EbookNode('chapter', 'Chapter One')
+		chapterNode.appendChild(paragraphNode)
+
+		DOMRoot = EbookNode('ebook')
+		DOMRoot.appendChild(chapterNode)
+
+		return DOMRoot, imageName
+
+	##########################################################################
+
+	def newEpub(self, **options):
+
+		return Epub('en-US', 'Test Press', 'Jane Doe', 'Test', '2020-01-01',
+			'2020', True, True, 'generate', tmpLocation = self.tmpPath, **options)
+
+	##########################################################################
+
+	# Staging a book on disk has to create OEBPS/images/ for its pictures
+	def testStageOnDiskWithImage(self):
+
+		DOMRoot, imageName = self.newBookWithImage()
+		epubPath = os.path.join(self.tmpPath, 'test.epub')
+
+		driver = self.newEpub(stageOnDisk = True)
+
+		try:
+			driver.transform(DOMRoot, epubPath)
+		finally:
+			driver.cleanup()
+
+		with zipfile.ZipFile(epubPath) as epubFile:
+			self.assertIsNone(epubFile.testzip())
+			self.assertEqual(epubFile.read('OEBPS/images/' + imageName), PNG_DATA)
+			self.assertIn('images/' + imageName, epubFile.read('OEBPS/book.opf').decode('utf-8'))
+
+	##########################################################################
+
+	# Metadata ends up in attributes as well as text, so characters that are
+	# special in either have to be escaped
+	def testMetadataIsEscaped(self):
+
+		DOMRoot, imageName = self.newBookWithImage()
+		epubPath = os.path.join(self.tmpPath, 'test.epub')
+
+		driver = Epub('en-US', 'Smith & Sons', 'Jane "JD" Doe', 'The "Big" <One>',
+			'2020-01-01', '2020', True, True, 'generate', tmpLocation = self.tmpPath)
+
+		try:
+			driver.transform(DOMRoot, epubPath)
+		finally:
+			driver.cleanup()
+
+		with zipfile.ZipFile(epubPath) as epubFile:
+			for name in epubFile.namelist():
+				if os.path.splitext(name)[1] in ('.xhtml', '.opf', '.ncx'):
+					with self.subTest(name = name):
+						ElementTree.fromstring(epubFile.read(name))
+
+			coverXHTML = epubFile.read('OEBPS/Cover.xhtml').decode('utf-8')
+			self.assertIn('alt="The &quot;Big&quot; &lt;One&gt;"', coverXHTML)
+
+###############################################################################
+
+if __name__ == '__main__':
+	unittest.main()